@@ -0,0 +1 @@
+from pbshm.admission.admission import *
\ No newline at end of file
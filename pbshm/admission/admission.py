@@ -0,0 +1,170 @@
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import Blueprint, current_app, g, jsonify, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from pbshm.authentication import authenticate_request
+
+#Create the Admission Blueprint
+bp = Blueprint("admission", __name__)
+
+#Controllers
+controllers_lock = threading.Lock()
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the number of requests running at once. Requests over the cap wait
+    up to a timeout for a slot and are rejected when none frees up.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+
+class TokenBucket:
+    """
+    Per-client token buckets refilled at rate tokens per second up to burst.
+    Once every refill period buckets which have refilled to burst are
+    dropped, as a missing bucket starts full, so idle clients do not
+    accumulate.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.swept = time.monotonic()
+
+    def sweep(self, now):
+        self.buckets = {
+            client: (tokens, updated) for client, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate < self.burst
+        }
+        self.swept = now
+
+    def take(self, client):
+        """
+        Takes a token for the client. Returns 0 when allowed, otherwise the
+        number of seconds until a token is available.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.swept >= self.burst / self.rate:
+                self.sweep(now)
+            tokens, updated = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self.buckets[client] = (tokens - 1, now)
+                return 0
+            self.buckets[client] = (tokens, now)
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+
+
+def endpoint_controller(endpoint, concurrency, rate, burst):
+    """
+    Returns the limiter and bucket of an endpoint for this process, creating
+    them on first use. ADMISSION_LIMITS in the configuration overrides the
+    limits given to the decorator per endpoint.
+    """
+    controllers = current_app.extensions.setdefault("pbshm_admission", {})
+    if endpoint not in controllers:
+        with controllers_lock:
+            if endpoint not in controllers:
+                limits = {"concurrency": concurrency, "rate": rate, "burst": burst}
+                limits.update(current_app.config["ADMISSION_LIMITS"].get(endpoint, {}))
+                controllers[endpoint] = {
+                    "limiter": ConcurrencyLimiter(limits["concurrency"]) if limits["concurrency"] is not None else None,
+                    "bucket": TokenBucket(limits["rate"], limits["burst"] if limits["burst"] is not None else max(1, limits["rate"])) if limits["rate"] is not None else None
+                }
+    return controllers[endpoint]
+
+
+#Admission Control
+def admission_control(concurrency=None, rate=None, burst=None, timeout=None):
+    """
+    View decorator limiting an expensive endpoint to concurrency requests at
+    once per process, queueing others for up to timeout seconds before
+    answering 503, and each user to rate requests per second with bursts of
+    up to burst before answering 429. Both responses carry Retry-After.
+    """
+    def view_decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            controller = endpoint_controller(request.endpoint, concurrency, rate, burst)
+            #Per User Rate Limit
+            if controller["bucket"] is not None:
+                client = g.user["_id"] if g.get("user") is not None else request.remote_addr
+                retry_after = controller["bucket"].take(client)
+                if retry_after > 0:
+                    raise TooManyRequests(description="Too many requests, please retry shortly", retry_after=math.ceil(retry_after))
+            #Concurrency Cap
+            limiter = controller["limiter"]
+            if limiter is None:
+                return view(*args, **kwargs)
+            if not limiter.acquire(timeout if timeout is not None else current_app.config["ADMISSION_QUEUE_TIMEOUT"]):
+                raise ServiceUnavailable(description="This service is busy, please retry shortly", retry_after=current_app.config["ADMISSION_RETRY_AFTER"])
+            try:
+                return view(*args, **kwargs)
+            finally:
+                limiter.release()
+        return wrapped
+    return view_decorator
+
+
+def admission_metrics(app=None):
+    """
+    Returns the in-flight, queued, admitted and rejected counts of every
+    controlled endpoint in this process.
+    """
+    controllers = (app or current_app).extensions.get("pbshm_admission", {})
+    metrics = {}
+    for endpoint, controller in list(controllers.items()):
+        limiter, bucket = controller["limiter"], controller["bucket"]
+        metrics[endpoint] = {
+            "concurrency": limiter.limit if limiter is not None else None,
+            "in_flight": limiter.in_flight if limiter is not None else 0,
+            "queue_depth": limiter.waiting if limiter is not None else 0,
+            "admitted": limiter.admitted if limiter is not None else 0,
+            "rejected_saturated": limiter.rejected if limiter is not None else 0,
+            "rejected_rate_limited": bucket.rejected if bucket is not None else 0
+        }
+    return metrics
+
+
+#Metrics View
+@bp.route("/metrics")
+@authenticate_request("admission-metrics")
+def metrics():
+    return jsonify(admission_metrics())
@@ -5,7 +5,7 @@ from typing import Mapping, Any
 from flask import Flask, Blueprint
 from werkzeug.exceptions import Unauthorized
 
-from pbshm import authentication, initialisation, layout, mechanic, timekeeper
+from pbshm import admission, assets, authentication, correlation, downsample, features, graphs, incremental, initialisation, jobs, layout, live, logs, mechanic, response, similarity, timekeeper
 
 
 def create_app(
@@ -22,6 +22,74 @@ def create_app(
         LOGIN_MESSAGE="Welcome to the Dynamics Research Group PBSHM Core, please enter your authentication credentials below.",
         FOOTER_MESSAGE="PBSHM Core © Dynamics Research Group 2022 - 2026",
         NAVIGATION_MODE="text",
+        SILOS={},
+        READ_PROFILES={
+            "analytics": {
+                "read_preference": "secondaryPreferred",
+                "read_concern": "local",
+                "max_staleness": 120,
+                "max_time_ms": 60000
+            }
+        },
+        DIAGNOSTICS_READ_PROFILE="analytics",
+        ASSETS_FINGERPRINT=True,
+        ASSETS_PRECOMPRESS=True,
+        ASSETS_MAX_AGE=31536000,
+        ASSETS_VENDOR_BOOTSTRAP=False,
+        COMPRESSION_ENABLED=True,
+        COMPRESSION_MIN_SIZE=1024,
+        COMPRESSION_MIMETYPES=["application/json", "text/html", "text/css", "text/plain", "application/javascript"],
+        COMPRESSION_GZIP_LEVEL=6,
+        COMPRESSION_ZSTD_LEVEL=3,
+        CACHES={},
+        QUERY_CACHE_ENABLED=True,
+        QUERY_CACHE_BACKEND="memory",
+        QUERY_CACHE_FILENAME="query-cache.sqlite",
+        QUERY_CACHE_SHARED_FILENAME="query-cache.mmap",
+        QUERY_CACHE_SHARED_SLOTS=4096,
+        QUERY_CACHE_MAX_BYTES=64 * 1024 * 1024,
+        QUERY_CACHE_TTL=300,
+        QUERY_CACHE_VERSION_CHECK=True,
+        LOG_LEVEL="INFO",
+        LOG_JSON=True,
+        LOG_FILENAME=None,
+        LOG_QUEUE_SIZE=10000,
+        LOG_ACCESS=True,
+        LOG_ACCESS_SAMPLE_RATE=1.0,
+        ADMISSION_LIMITS={},
+        ADMISSION_QUEUE_TIMEOUT=2.0,
+        ADMISSION_RETRY_AFTER=5,
+        PIPELINE_EXPLAIN_CHECK=False,
+        QUERY_BUDGET=50,
+        QUERY_COUNT_HEADER=False,
+        DOWNSAMPLE_MAX_POINTS=10000,
+        DOWNSAMPLE_LTTB_OVERSAMPLING=4,
+        FEATURE_COLLECTION="features",
+        FEATURE_CHECKPOINT_COLLECTION="feature_checkpoints",
+        FEATURE_WINDOWS_PER_TASK=64,
+        INCREMENTAL_COLLECTION="incremental",
+        INCREMENTAL_WATERMARK_COLLECTION="incremental_watermarks",
+        INCREMENTAL_WINDOWS_PER_LOAD=64,
+        CORRELATION_COLLECTION="correlations",
+        CORRELATION_TOTAL_COLLECTION="correlation_totals",
+        CORRELATION_BLOCK_SIZE=256,
+        GRAPH_INVARIANT_COLLECTION="graph_invariants",
+        MECHANIC_CHECKPOINT_COLLECTION="mechanic_checkpoints",
+        MECHANIC_PARTITIONS=64,
+        MECHANIC_BATCH_SIZE=1000,
+        JOBS_COLLECTION="jobs",
+        JOBS_IN_PROCESS_WORKERS=0,
+        JOBS_POLL_INTERVAL=1.0,
+        JOBS_STALE_SECONDS=300,
+        LIVE_CHANGE_STREAMS=True,
+        LIVE_POLL_INTERVAL=2.0,
+        LIVE_POLL_OVERLAP=60.0,
+        LIVE_QUEUE_SIZE=100,
+        LIVE_HEARTBEAT=15.0,
+        SIMILARITY_FILENAME="similarity-{feature}-{window}.npz",
+        SIMILARITY_BLOCK_SIZE=65536,
+        SIMILARITY_DEFAULT_K=10,
+        SIMILARITY_WATERMARK_OVERLAP=300,
         NAVIGATION=[
             {
                 "title": "Modules",
@@ -33,12 +101,16 @@ def create_app(
             }
         ],
     )
+    default_read_profiles = app.config["READ_PROFILES"]
     (
         app.config.from_file("config.json", load=json.load, silent=True)
         if test_config is None
         else app.config.from_mapping(test_config)
     )
 
+    # Merge Configured Read Profiles over the Defaults
+    app.config["READ_PROFILES"] = {**default_read_profiles, **app.config["READ_PROFILES"]}
+
     # Ensure Instance Folder
     try:
         os.makedirs(app.instance_path)
@@ -46,10 +118,22 @@ def create_app(
         pass
 
     # Add Functionality Blueprints
+    app.register_blueprint(logs.bp)  ## Logs
     app.register_blueprint(initialisation.bp)  ## Initialisation
     app.register_blueprint(mechanic.bp)  ## Mechanic
+    app.register_blueprint(features.bp)  ## Features
+    app.register_blueprint(graphs.bp)  ## Graphs
+    app.register_blueprint(incremental.bp)  ## Incremental
+    app.register_blueprint(jobs.bp, url_prefix="/jobs")  ## Jobs
+    app.register_blueprint(live.bp, url_prefix="/live")  ## Live
+    app.register_blueprint(similarity.bp, url_prefix="/similarity")  ## Similarity
+    app.register_blueprint(correlation.bp, url_prefix="/correlation")  ## Correlation
     app.register_blueprint(timekeeper.bp, url_prefix="/timekeeper")  ## Timekeeper
     app.register_blueprint(authentication.bp, url_prefix="/authentication")  ## Authentication
+    app.register_blueprint(admission.bp, url_prefix="/admission")  ## Admission
+    app.register_blueprint(assets.bp, url_prefix="/assets")  ## Assets
+    app.register_blueprint(response.bp)  ## Response
+    app.register_blueprint(downsample.bp, url_prefix="/downsample")  ## Downsample
 
     # Register Exceptions
     app.register_error_handler(Unauthorized, authentication.handle_unauthorised_request)
@@ -0,0 +1 @@
+from pbshm.assets.assets import *
\ No newline at end of file
@@ -0,0 +1,219 @@
+import gzip
+import hashlib
+import mimetypes
+import threading
+from base64 import b64encode
+from os import makedirs, walk
+from os.path import basename, isdir, isfile, join, relpath, splitext
+from urllib.request import urlopen
+
+import click
+from flask import Blueprint, abort, current_app, request, send_file, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#Constants
+BOOTSTRAP_VERSION = "5.3.8"
+BOOTSTRAP_URL = "https://cdn.jsdelivr.net/npm/bootstrap@{version}/dist/{path}"
+BOOTSTRAP_FILES = {
+    "css/bootstrap.min.css": "sha384-sRIl4kxILFvY47J16cr9ZwB07vP4J8+LH7qKQnuqkuIAvNWLzeN8tE5YBujZqJLB",
+    "js/bootstrap.bundle.min.js": "sha384-FKyoEForCGlyvwx9Hj09JcYn3nv7wiPVlz7YYwJrWVcXK/BmnVDxM+D2scQbITxI"
+}
+COMPRESSIBLE_EXTENSIONS = [".css", ".js", ".svg", ".json", ".html", ".txt", ".map"]
+FINGERPRINT_LENGTH = 12
+
+#Create the Assets Blueprint
+bp = Blueprint("assets", __name__, cli_group="assets")
+manifest_lock = threading.Lock()
+
+
+def asset_sources(app):
+    """
+    Returns a dictionary of static endpoint names to the folders they serve from.
+    """
+    sources = {}
+    if app.static_folder is not None and isdir(app.static_folder):
+        sources["static"] = app.static_folder
+    for name, blueprint in app.blueprints.items():
+        if blueprint.static_folder is not None and isdir(blueprint.static_folder):
+            sources[f"{name}.static"] = blueprint.static_folder
+    sources["assets.vendor"] = join(app.instance_path, "vendor")
+    return sources
+
+
+def fingerprint_filename(filename, digest):
+    """
+    Inserts the content digest before the file extension: style.css -> style.<digest>.css
+    """
+    stem, extension = splitext(filename)
+    return f"{stem}.{digest[:FINGERPRINT_LENGTH]}{extension}"
+
+
+def precompress_asset(source_path, target_path):
+    """
+    Writes gzip (and brotli when available) variants of a file next to target_path.
+    Existing variants are kept, as the fingerprint in the filename guarantees they are current.
+    """
+    with open(source_path, "rb") as file:
+        content = file.read()
+    if not isfile(target_path + ".gz"):
+        with open(target_path + ".gz", "wb") as file:
+            file.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None and not isfile(target_path + ".br"):
+        with open(target_path + ".br", "wb") as file:
+            file.write(brotli.compress(content, quality=11))
+
+
+def build_asset_manifest(app):
+    """
+    Content-hashes every static file the app serves and returns a manifest of
+    endpoint -> filename -> fingerprinted filename. When ASSETS_PRECOMPRESS is
+    enabled, compressed variants are written into the instance assets folder.
+    """
+    manifest = {}
+    output_root = join(app.instance_path, "assets")
+    for endpoint, folder in asset_sources(app).items():
+        manifest[endpoint] = {}
+        if not isdir(folder):
+            continue
+        for directory, _, filenames in walk(folder):
+            for filename in filenames:
+                source_path = join(directory, filename)
+                relative_path = relpath(source_path, folder).replace("\\", "/")
+                with open(source_path, "rb") as file:
+                    digest = hashlib.sha256(file.read()).hexdigest()
+                fingerprinted = fingerprint_filename(relative_path, digest)
+                manifest[endpoint][relative_path] = fingerprinted
+                #Precompress Text Assets
+                if app.config["ASSETS_PRECOMPRESS"] and splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                    target_path = join(output_root, endpoint, fingerprinted)
+                    makedirs(join(output_root, endpoint, relpath(directory, folder)), exist_ok=True)
+                    precompress_asset(source_path, target_path)
+    return manifest
+
+
+def asset_manifest():
+    """
+    Returns the asset manifest for the current app, building it on first use.
+    """
+    manifest = current_app.extensions.get("pbshm_assets")
+    if manifest is None:
+        with manifest_lock:
+            manifest = current_app.extensions.get("pbshm_assets")
+            if manifest is None:
+                manifest = build_asset_manifest(current_app._get_current_object())
+                #Reverse lookup for the fingerprinted view, stored before the manifest is published
+                current_app.extensions["pbshm_asset_originals"] = {
+                    endpoint: {fingerprint: filename for filename, fingerprint in files.items()}
+                    for endpoint, files in manifest.items()
+                }
+                current_app.extensions["pbshm_assets"] = manifest
+    return manifest
+
+
+def asset_originals():
+    """
+    Returns endpoint -> fingerprinted filename -> filename, the reverse of the asset manifest.
+    """
+    asset_manifest()
+    return current_app.extensions["pbshm_asset_originals"]
+
+
+def asset_url_for(endpoint, **values):
+    """
+    Drop-in replacement for url_for which rewrites static endpoints into
+    fingerprinted URLs served with immutable caching.
+    """
+    if current_app.config["ASSETS_FINGERPRINT"] and "filename" in values:
+        if endpoint.startswith("."):
+            endpoint = f"{request.blueprint}{endpoint}" if request.blueprint else endpoint[1:]
+        files = asset_manifest().get(endpoint)
+        if files is not None and values["filename"] in files:
+            values["filename"] = files[values["filename"]]
+            return url_for("assets.fingerprinted", source=endpoint, **values)
+    return url_for(endpoint, **values)
+
+
+@bp.record_once
+def register_functions(state):
+    state.app.jinja_env.globals["url_for"] = asset_url_for
+
+
+#Fingerprinted View
+@bp.route("/<source>/<path:filename>")
+def fingerprinted(source, filename):
+    #Resolve Fingerprinted Filename
+    original = asset_originals().get(source, {}).get(filename)
+    if original is None:
+        abort(404)
+    source_path = join(asset_sources(current_app)[source], original)
+    #Select Encoding
+    compressed_path, encoding = None, None
+    accepted = request.accept_encodings
+    for extension, name in ((".br", "br"), (".gz", "gzip")):
+        candidate = join(current_app.instance_path, "assets", source, filename + extension)
+        if accepted[name] and isfile(candidate):
+            compressed_path, encoding = candidate, name
+            break
+    #Send Asset
+    response = send_file(
+        compressed_path if compressed_path is not None else source_path,
+        mimetype=mimetypes.guess_type(basename(original))[0] or "application/octet-stream",
+        download_name=basename(filename),
+        conditional=True,
+        etag=filename + (f".{encoding}" if encoding else ""),
+        max_age=current_app.config["ASSETS_MAX_AGE"]
+    )
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = True
+    return response
+
+
+#Vendor View
+@bp.route("/vendor/<path:filename>")
+def vendor(filename):
+    return send_from_directory(join(current_app.instance_path, "vendor"), filename)
+
+
+#Build Assets
+@bp.cli.command("build")
+def assets_build():
+    manifest = build_asset_manifest(current_app)
+    for endpoint in manifest:
+        for filename, fingerprinted_name in manifest[endpoint].items():
+            print("{endpoint}: {filename} -> {fingerprinted}".format(endpoint=endpoint, filename=filename, fingerprinted=fingerprinted_name))
+    print("Complete")
+
+
+#Vendor Bootstrap
+@bp.cli.command("vendor-bootstrap")
+@click.option("--version", default=BOOTSTRAP_VERSION)
+def assets_vendor_bootstrap(version):
+    #The layout pins the integrity hashes of BOOTSTRAP_VERSION, so browsers would block any other build
+    if version != BOOTSTRAP_VERSION:
+        print("Sorry, only Bootstrap {supported} can be vendored, as the layout pins its integrity hashes".format(supported=BOOTSTRAP_VERSION))
+        return
+    vendor_folder = join(current_app.instance_path, "vendor")
+    makedirs(vendor_folder, exist_ok=True)
+    for path, integrity in BOOTSTRAP_FILES.items():
+        #Download File
+        download_url = BOOTSTRAP_URL.format(version=version, path=path)
+        print("Downloading {url}".format(url=download_url))
+        with urlopen(download_url) as response:
+            if response.getcode() != 200:
+                print("An error occured while trying to download {url}".format(url=download_url))
+                return
+            content = response.read()
+        #Verify Integrity
+        algorithm, expected = integrity.split("-", 1)
+        if b64encode(hashlib.new(algorithm, content).digest()).decode() != expected:
+            print("Integrity check failed for {url}".format(url=download_url))
+            return
+        with open(join(vendor_folder, basename(path)), "wb") as file:
+            file.write(content)
+    print("Complete")
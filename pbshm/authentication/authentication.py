@@ -2,12 +2,11 @@ from functools import wraps
 import hashlib
 import hmac
 
-from bson import ObjectId
 from flask import Blueprint, g, render_template, request, session, redirect, url_for, current_app
 from werkzeug.exceptions import Unauthorized
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from pbshm.db import user_collection
+from pbshm.db import user_collection, user_document
 
 #Create the Authentication Blueprint
 bp = Blueprint("authentication", __name__, template_folder="templates")
@@ -91,11 +90,8 @@ def load_user_data():
     user_id = session.get("user_id")
     if user_id is None: g.user = None
     else:
-        user = user_collection().find_one(
-            { "_id": ObjectId(user_id) },
-            { "_id": 1, "firstName": 1, "secondName": 1 }
-        )
-        g.user = { "_id": str(user["_id"]), "firstName": user["firstName"], "secondName": user["secondName"] }
+        user = user_document(user_id)
+        g.user = None if user is None else { "_id": str(user["_id"]), "firstName": user["firstName"], "secondName": user["secondName"] }
 
 #Authenticate Request
 def authenticate_request(permission=None):
@@ -104,11 +100,9 @@ def authenticate_request(permission=None):
         def wrapped(*args, **kwargs):
             if g.user is None: raise Unauthorized(description="Please login to perform this action")
             else:
-                user = user_collection().find_one(
-                    { "_id": ObjectId(g.user["_id"]), "enabled": True } if permission is None else { "_id": ObjectId(g.user["_id"]), "enabled": True, "permissions": { "$in": [permission, "root"] } },
-                    { "_id": 1 }
-                )
-                if user is None or g.user["_id"] != str(user["_id"]): raise Unauthorized(description="You do not have permission to perform this action")
+                user = user_document(g.user["_id"])
+                permitted = user is not None and user.get("enabled") == True and (permission is None or any(name in user.get("permissions", []) for name in [permission, "root"]))
+                if not permitted or g.user["_id"] != str(user["_id"]): raise Unauthorized(description="You do not have permission to perform this action")
             return view(*args, **kwargs)
         return wrapped
     return view_decorator
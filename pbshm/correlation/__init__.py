@@ -0,0 +1 @@
+from pbshm.correlation.correlation import *
\ No newline at end of file
@@ -0,0 +1,385 @@
+import hashlib
+import json
+import time
+import warnings
+from concurrent.futures import as_completed
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import pymongo
+from bson import Binary
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from pbshm.authentication import authenticate_request
+from pbshm.db import db_connect, default_collection, load_channel_arrays, register_index, worker_collections, worker_pool
+from pbshm.jobs import register_job_type
+
+#Create the Correlation Blueprint
+bp = Blueprint("correlation", __name__, cli_group="correlation")
+
+#Moment matrices stored for every window
+MOMENTS = ("count", "mean", "m2", "comoment")
+
+#Correlation Indexes
+register_index("CORRELATION_COLLECTION", [
+    ("query", pymongo.ASCENDING), ("start", pymongo.ASCENDING)
+], "pbshm_correlation_windows")
+
+
+def correlation_query(population, window, step, structures=None, channels=None, statistic="mean"):
+    """
+    Returns the canonical form of a correlation query: the channels of the
+    given structures (every structure in the population by default) aligned
+    onto a grid of step nanoseconds within windows of window nanoseconds.
+    """
+    return {
+        "population": population,
+        "structures": sorted(structures) if structures is not None else None,
+        "channels": sorted(channels) if channels is not None else None,
+        "statistic": statistic,
+        "window": int(window),
+        "step": int(step)
+    }
+
+
+def query_key(query):
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def empty_moments(size):
+    return {
+        "count": np.zeros((size, size)),
+        "mean": np.zeros((size, size)),
+        "m2": np.zeros((size, size)),
+        "comoment": np.zeros((size, size))
+    }
+
+
+def block_moments(shifted_a, valid_a, shifted_b, valid_b):
+    """
+    Returns the pairwise count, sum, sum of squares and cross product of two
+    blocks of centred columns over the rows where both columns are finite.
+    """
+    return (
+        valid_a.T @ valid_b,
+        shifted_a.T @ valid_b,
+        valid_a.T @ shifted_b,
+        (shifted_a * shifted_a).T @ valid_b,
+        valid_a.T @ (shifted_b * shifted_b),
+        shifted_a.T @ shifted_b
+    )
+
+
+def window_moments(matrix, block_size=256):
+    """
+    Computes the pairwise moments of the columns of a (rows, columns) matrix,
+    using for each pair only the rows where both values are finite. count,
+    mean and m2 hold the count, mean and sum of squared deviations of column
+    i over the rows shared with column j; comoment holds the sum of products
+    of deviations. Column pairs are computed in blocks of block_size columns
+    as matrix products, and only blocks on or above the diagonal are computed.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    columns = matrix.shape[1]
+    moments = empty_moments(columns)
+    valid = np.isfinite(matrix)
+    #Centre each column on its mean to keep the sums small and precise
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        shift = np.nan_to_num(np.nanmean(matrix, axis=0)) if matrix.shape[0] > 0 else np.zeros(columns)
+    shifted = np.where(valid, matrix - shift, 0.0)
+    valid = valid.astype(np.float64)
+    for lower_a in range(0, columns, block_size):
+        a = slice(lower_a, lower_a + block_size)
+        for lower_b in range(lower_a, columns, block_size):
+            b = slice(lower_b, lower_b + block_size)
+            count, sum_a, sum_b, square_a, square_b, product = block_moments(shifted[:, a], valid[:, a], shifted[:, b], valid[:, b])
+            safe = np.where(count > 0, count, 1.0)
+            mean_a, mean_b = sum_a / safe, sum_b / safe
+            moments["count"][a, b] = count
+            moments["mean"][a, b] = mean_a + shift[a, None]
+            moments["m2"][a, b] = np.maximum(square_a - sum_a * mean_a, 0.0)
+            moments["comoment"][a, b] = product - sum_a * mean_b
+            if lower_b != lower_a:
+                moments["count"][b, a] = count.T
+                moments["mean"][b, a] = mean_b.T + shift[b, None]
+                moments["m2"][b, a] = np.maximum(square_b - sum_b * mean_b, 0.0).T
+                moments["comoment"][b, a] = moments["comoment"][a, b].T
+    return moments
+
+
+def merge_moments(first, second):
+    """
+    Combines the pairwise moments of two sets of rows (Chan et al. parallel
+    update), so windows can be accumulated without revisiting their data.
+    """
+    count = first["count"] + second["count"]
+    safe = np.where(count > 0, count, 1.0)
+    weight = first["count"] * second["count"] / safe
+    delta = second["mean"] - first["mean"]
+    return {
+        "count": count,
+        "mean": first["mean"] + delta * second["count"] / safe,
+        "m2": first["m2"] + second["m2"] + delta * delta * weight,
+        "comoment": first["comoment"] + second["comoment"] + delta * delta.T * weight
+    }
+
+
+def moments_matrix(moments, kind="correlation"):
+    """
+    Returns the pairwise Pearson correlation or sample covariance matrix from
+    accumulated moments, NaN where a pair shares fewer than two rows.
+    """
+    count = moments["count"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if kind == "covariance":
+            matrix = moments["comoment"] / (count - 1)
+        else:
+            matrix = moments["comoment"] / np.sqrt(moments["m2"] * moments["m2"].T)
+            matrix = np.clip(matrix, -1.0, 1.0)
+    return np.where(count >= 2, matrix, np.nan)
+
+
+def encode_moments(moments):
+    return {name: Binary(np.ascontiguousarray(moments[name], dtype=np.float64).tobytes()) for name in MOMENTS}
+
+
+def decode_moments(document):
+    size = len(document["columns"])
+    return {name: np.frombuffer(document["moments"][name], dtype=np.float64).reshape(size, size) for name in MOMENTS}
+
+
+def query_structures(collection, query):
+    if query["structures"] is not None:
+        return query["structures"]
+    return sorted(collection.distinct("name", {"population": query["population"]}))
+
+
+def query_windows(collection, query, structures, start=None, end=None):
+    """
+    Returns the starts of the windows holding any of the query's data from
+    start to end, aligned to multiples of the window size so reruns produce
+    the same windows. Only timestamps within the range are read, through the
+    pbshm_framework_channel index, and windows without data are skipped.
+    """
+    match = {"population": query["population"], "name": {"$in": structures}}
+    if start is not None or end is not None:
+        match["timestamp"] = {}
+        if start is not None: match["timestamp"]["$gte"] = start - start % query["window"]
+        if end is not None: match["timestamp"]["$lt"] = end
+    return [document["_id"] for document in collection.aggregate([
+        {"$match": match},
+        {"$project": {"_id": 0, "timestamp": 1}},
+        {"$group": {"_id": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", query["window"]]}]}}},
+        {"$sort": {"_id": 1}}
+    ], allowDiskUse=True)]
+
+
+def pad_moments(moments, size):
+    padded = empty_moments(size)
+    current = len(moments["count"])
+    for name in MOMENTS:
+        padded[name][:current, :current] = moments[name]
+    return padded
+
+
+def accumulate_moments(documents, columns=None, total=None):
+    """
+    Merges stored windows into a total, optionally continuing an existing
+    total over the given columns. Columns first seen in a window are appended.
+    Returns the columns, the total and the start of the last window merged.
+    """
+    columns = [list(column) for column in columns] if columns is not None else []
+    positions = {tuple(column): position for position, column in enumerate(columns)}
+    total = total if total is not None else empty_moments(len(columns))
+    last = None
+    for document in documents:
+        for column in document["columns"]:
+            if tuple(column) not in positions:
+                positions[tuple(column)] = len(columns)
+                columns.append(list(column))
+        if len(columns) > len(total["count"]):
+            total = pad_moments(total, len(columns))
+        indices = np.array([positions[tuple(column)] for column in document["columns"]], dtype=np.int64)
+        window = empty_moments(len(columns))
+        for name, values in decode_moments(document).items():
+            window[name][np.ix_(indices, indices)] = values
+        total = merge_moments(total, window)
+        last = document["start"]
+    return columns, total, last
+
+
+def merge_completed_windows(key, query, correlations, totals):
+    """
+    Merges the stored windows after the running total of a query into it,
+    except the latest window which may still be incomplete, so neither an
+    update nor a view revisits windows merged before. Returns the start of
+    the last window merged, or None when there was nothing to merge.
+    """
+    total_document = totals.find_one({"_id": key})
+    latest = correlations.find_one({"query": key}, {"_id": 0, "start": 1}, sort=[("start", pymongo.DESCENDING)])
+    if latest is None:
+        return None
+    match = {"query": key, "start": {"$lt": latest["start"]}}
+    if total_document is not None:
+        match["start"]["$gt"] = total_document["merged"]
+    columns, total, last = accumulate_moments(
+        correlations.find(match, {"_id": 0, "start": 1, "columns": 1, "moments": 1}).sort("start", pymongo.ASCENDING),
+        total_document["columns"] if total_document is not None else None,
+        decode_moments(total_document) if total_document is not None else None
+    )
+    if last is None:
+        return None
+    totals.replace_one({"_id": key}, {
+        "_id": key,
+        "definition": query,
+        "merged": last,
+        "updated": datetime.now(timezone.utc),
+        "columns": columns,
+        "moments": encode_moments(total)
+    }, upsert=True)
+    return last
+
+
+def correlate_window(key, query, structures, window_start, block_size):
+    """
+    Loads every structure's channels for one window onto the common grid,
+    computes their pairwise moments and upserts them. Returns the column count.
+    """
+    columns, arrays = [], []
+    for name in structures:
+        _, values = load_channel_arrays(
+            query["population"], name, window_start, window_start + query["window"], query["channels"],
+            query["statistic"], query["step"], collection=worker_collections["collection"]
+        )
+        for channel in sorted(values):
+            if np.isfinite(values[channel]).any():
+                columns.append([name, channel])
+                arrays.append(values[channel])
+    rows = len(arrays[0]) if len(arrays) > 0 else 0
+    moments = window_moments(np.column_stack(arrays) if len(arrays) > 0 else np.empty((rows, 0)), block_size)
+    document_id = {"query": key, "start": window_start}
+    worker_collections["correlation_collection"].replace_one({"_id": document_id}, {
+        "_id": document_id,
+        "query": key,
+        "definition": query,
+        "start": window_start,
+        "end": window_start + query["window"],
+        "computed": datetime.now(timezone.utc),
+        "columns": columns,
+        "moments": encode_moments(moments)
+    }, upsert=True)
+    return len(columns)
+
+
+def update_correlation(query, start=None, end=None, processes=None, progress=print):
+    """
+    Computes the windows of a correlation query holding data from its latest
+    stored window onwards across a process pool, recomputing the latest as it
+    may have been incomplete, then merges the completed windows into the
+    query's running total. Reruns therefore only cost the newly arrived
+    windows. Returns the query key and the number of windows computed.
+    """
+    key = query_key(query)
+    db = db_connect()
+    collection = default_collection()
+    correlations = db[current_app.config["CORRELATION_COLLECTION"]]
+    structures = query_structures(collection, query)
+    latest = correlations.find_one({"query": key}, {"_id": 0, "start": 1}, sort=[("start", pymongo.DESCENDING)])
+    if latest is not None:
+        start = latest["start"] if start is None else max(start, latest["start"])
+    pending = query_windows(collection, query, structures, start, end)
+    total = len(pending)
+    progress("Computing {total} windows of {structures} structures for correlation {key}".format(total=total, structures=len(structures), key=key))
+    if total > 0:
+        #Compute Windows
+        started = time.monotonic()
+        with worker_pool(processes, {"collection": current_app.config["DEFAULT_COLLECTION"], "correlation_collection": current_app.config["CORRELATION_COLLECTION"]}) as executor:
+            futures = [executor.submit(correlate_window, key, query, structures, window, current_app.config["CORRELATION_BLOCK_SIZE"]) for window in pending]
+            try:
+                for index, future in enumerate(as_completed(futures), start=1):
+                    future.result()
+                    elapsed = time.monotonic() - started
+                    progress("{index}/{total} windows, {rate:.1f} windows/s".format(index=index, total=total, rate=index / elapsed if elapsed > 0 else 0.0))
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    merge_completed_windows(key, query, correlations, db[current_app.config["CORRELATION_TOTAL_COLLECTION"]])
+    return key, total
+
+
+def correlation_matrix(key, start=None, end=None, kind="correlation"):
+    """
+    Returns the (structure, channel) columns, the correlation or covariance
+    matrix and the pairwise sample counts of a correlation query, or None
+    when no window is stored. Over the whole history only the windows after
+    the running total are merged into it; given start or end, the stored
+    windows starting within [start, end) are accumulated instead.
+    """
+    db = db_connect()
+    total_document, match = None, {"query": key}
+    if start is not None or end is not None:
+        match["start"] = {}
+        if start is not None: match["start"]["$gte"] = start
+        if end is not None: match["start"]["$lt"] = end
+    else:
+        total_document = db[current_app.config["CORRELATION_TOTAL_COLLECTION"]].find_one({"_id": key})
+        if total_document is not None:
+            match["start"] = {"$gt": total_document["merged"]}
+    columns, total, last = accumulate_moments(
+        db[current_app.config["CORRELATION_COLLECTION"]].find(match, {"_id": 0, "start": 1, "columns": 1, "moments": 1}).sort("start", pymongo.ASCENDING),
+        total_document["columns"] if total_document is not None else None,
+        decode_moments(total_document) if total_document is not None else None
+    )
+    if total_document is None and last is None:
+        return None
+    order = sorted(range(len(columns)), key=lambda position: tuple(columns[position]))
+    total = {name: total[name][np.ix_(order, order)] for name in MOMENTS}
+    return [tuple(columns[position]) for position in order], moments_matrix(total, kind), total["count"].astype(np.int64)
+
+
+#Correlation Matrix View
+@bp.route("/<key>")
+@authenticate_request("correlation-query")
+def matrix(key):
+    kind = request.args.get("kind", "correlation")
+    if kind not in ("correlation", "covariance"):
+        abort(400)
+    result = correlation_matrix(key, request.args.get("start", None, type=int), request.args.get("end", None, type=int), kind)
+    if result is None:
+        abort(404)
+    columns, values, counts = result
+    return jsonify({
+        "columns": [{"name": name, "channel": channel} for name, channel in columns],
+        kind: [[value if np.isfinite(value) else None for value in row] for row in values.tolist()],
+        "counts": counts.tolist()
+    })
+
+
+#Update Correlation Matrix
+@bp.cli.command("update")
+@click.argument("population")
+@click.option("--window", type=float, required=True, help="Window length in seconds")
+@click.option("--step", type=float, required=True, help="Grid step in seconds")
+@click.option("--structure", "structures", multiple=True, help="Structure to include, all by default")
+@click.option("--channel", "channels", multiple=True, help="Channel to include, all by default")
+@click.option("--statistic", default="mean")
+@click.option("--start", type=int, default=None, help="Start timestamp in nanoseconds since epoch")
+@click.option("--end", type=int, default=None, help="End timestamp in nanoseconds since epoch")
+@click.option("--processes", type=int, default=None)
+def correlation_update(population, window, step, structures, channels, statistic, start, end, processes):
+    query = correlation_query(
+        population, int(window * 1000000000), int(step * 1000000000),
+        list(structures) if len(structures) > 0 else None, list(channels) if len(channels) > 0 else None, statistic
+    )
+    key, computed = update_correlation(query, start, end, processes)
+    print("Computed {computed} windows, results available under key: {key}".format(computed=computed, key=key))
+
+
+#Register Background Jobs
+register_job_type(
+    "correlation.update",
+    lambda job: update_correlation(correlation_query(**job.parameters["query"]), job.parameters.get("start"), job.parameters.get("end"), progress=lambda message: None)[1],
+    concurrency=1
+)
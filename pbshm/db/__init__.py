@@ -0,0 +1,7 @@
+from pbshm.db.db import *
+from pbshm.db.cache import *
+from pbshm.db.loader import *
+from pbshm.db.indexes import *
+from pbshm.db.batch import *
+from pbshm.db.monitor import *
+from pbshm.db.pipeline import *
@@ -0,0 +1,113 @@
+from flask import g
+
+
+class Deferred:
+    """
+    Placeholder for a document requested through a BatchLoader. The first
+    access resolves every lookup queued on the loader in a single query.
+    """
+    def __init__(self, loader, value):
+        self.loader = loader
+        self.key = value
+
+    @property
+    def value(self):
+        return self.loader.resolve(self.key)
+
+    def __getitem__(self, field):
+        return self.value[field]
+
+    def get(self, field, default=None):
+        value = self.value
+        return default if value is None else value.get(field, default)
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __iter__(self):
+        return iter(self.value if self.value is not None else [])
+
+
+class BatchLoader:
+    """
+    Coalesces lookups of documents by one field into $in queries. load()
+    queues a value and returns a Deferred; load_many() resolves immediately.
+    Results are memoised, so each value is queried at most once. With many,
+    every matching document is returned as a list rather than the first.
+    """
+    def __init__(self, collection, field="_id", projection=None, many=False):
+        self.collection = collection
+        self.field = field
+        self.projection = projection
+        self.many = many
+        self.pending = {}
+        self.results = {}
+
+    def load(self, value):
+        if value not in self.results:
+            self.pending[value] = True
+        return Deferred(self, value)
+
+    def load_many(self, values):
+        for value in values:
+            self.load(value)
+        self.dispatch()
+        return [self.results[value] for value in values]
+
+    def prime(self, value, document):
+        self.results[value] = document
+
+    def dispatch(self):
+        """
+        Fetches every pending value in one query.
+        """
+        if len(self.pending) == 0:
+            return
+        pending, self.pending = list(self.pending), {}
+        projection = self.projection
+        if projection is not None and all(projection.values()) and self.field not in projection:
+            projection = {**projection, self.field: 1}
+        found = {value: [] for value in pending}
+        for document in self.collection.find({self.field: {"$in": pending}}, projection):
+            values = field_value(document, self.field)
+            for value in (values if isinstance(values, list) else [values]):
+                if value in found:
+                    found[value].append(document)
+        for value, documents in found.items():
+            self.results[value] = documents if self.many else (documents[0] if len(documents) > 0 else None)
+
+    def resolve(self, value):
+        if value not in self.results:
+            self.pending[value] = True
+            self.dispatch()
+        return self.results.get(value, [] if self.many else None)
+
+
+def field_value(document, path):
+    """
+    Returns the value of a dotted field, collecting it from every item of an
+    array along the way as MongoDB does when matching.
+    """
+    value = document
+    for part in path.split("."):
+        if isinstance(value, list):
+            value = [item[part] for item in value if isinstance(item, dict) and part in item]
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+def request_loader(collection, field="_id", projection=None, many=False):
+    """
+    Returns the BatchLoader for a collection, field and projection shared by
+    everything running in the current request, so lookups queued by different
+    views, decorators and templates are coalesced and memoised together.
+    """
+    if "batch_loaders" not in g:
+        g.batch_loaders = {}
+    key = (collection.full_name, field, tuple(sorted(projection.items())) if projection is not None else None, many)
+    if key not in g.batch_loaders:
+        g.batch_loaders[key] = BatchLoader(collection, field, projection, many)
+    return g.batch_loaders[key]
@@ -0,0 +1,420 @@
+import hashlib
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from functools import wraps
+from os.path import exists, join, splitext
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import bson
+from flask import current_app
+
+from pbshm.db.db import request_data_version
+
+#Shared Cache Layout: header (magic, slots, data size, head, generation) and slots (sequence, key hash, generation, position, version length, length, checksum, expires)
+SHARED_MAGIC = b"PBSHMQC1"
+SHARED_HEADER = struct.Struct("<8sQQQQ")
+SHARED_SLOT = struct.Struct("<Q16sQQIIId")
+SHARED_EMPTY_HASH = bytes(16)
+SHARED_PROBES = 4
+
+#Named Cache Defaults, overridden per cache through CACHES
+CACHE_DEFAULTS = {"backend": "memory", "max_bytes": 8 * 1024 * 1024, "slots": 1024, "ttl": 60}
+CACHE_EXTENSIONS = {"disk": ".sqlite", "shared": ".mmap"}
+caches_lock = threading.Lock()
+
+#Returned by QueryCache.get on a miss, so a cached None is still a hit
+CACHE_MISS = object()
+
+
+def shared_key_hash(key):
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+
+class MemoryCacheBackend:
+    """
+    In-process LRU cache bounded by the total size of the pickled entries.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, version, expires, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[2])
+            self.entries[key] = (version, expires, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[2])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DiskCacheBackend:
+    """
+    SQLite backed cache shared by every process using the same instance folder.
+    Entries are evicted least recently used first once max_bytes is exceeded.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        with closing(self.connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, version TEXT, expires REAL, accessed REAL, size INTEGER, value BLOB)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with closing(self.connect()) as connection, connection:
+            row = connection.execute("SELECT version, expires, value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row
+
+    def set(self, key, version, expires, value):
+        if len(value) > self.max_bytes:
+            return
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (key, version, expires, accessed, size, value) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, version, expires, time.time(), len(value), value)
+            )
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            while total > self.max_bytes:
+                row = connection.execute("SELECT key, size FROM cache ORDER BY accessed LIMIT 1").fetchone()
+                connection.execute("DELETE FROM cache WHERE key = ?", (row[0],))
+                total -= row[1]
+
+    def delete(self, key):
+        with closing(self.connect()) as connection, connection:
+            connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with closing(self.connect()) as connection, connection:
+            connection.execute("DELETE FROM cache")
+
+
+class SharedCacheBackend:
+    """
+    Cache held in a memory-mapped file shared by every process using the same
+    instance folder, so pre-forked workers share one copy of each entry.
+    Values are appended to a circular data area, overwriting the oldest, and
+    found through a table of slots. Reads take no lock: a slot is read between
+    two reads of its sequence number, which writers make odd while changing
+    it, and the value is checked against its checksum. Writers serialise with
+    a file lock. clear() bumps the generation in the header, invalidating
+    every entry in every process at once. The file name carries the slot
+    count and size, so workers started with a different layout map a new
+    file rather than resizing one which others still map.
+    """
+    def __init__(self, path, max_bytes, slots=4096):
+        root, extension = splitext(path)
+        self.path = "{root}-{slots}x{size}{extension}".format(root=root, slots=slots, size=max_bytes, extension=extension)
+        self.lock_path = path + ".lock"
+        self.slots = slots
+        self.data_size = max_bytes
+        self.data_offset = SHARED_HEADER.size + slots * SHARED_SLOT.size
+        self.thread_lock = threading.Lock()
+        self.lock_files = {}
+        open(self.lock_path, "ab").close()
+        with self.lock():
+            if not self.valid_file():
+                #Files may be mapped by running workers, so never resize one in place
+                temporary = "{path}.{pid}.tmp".format(path=self.path, pid=os.getpid())
+                with open(temporary, "wb") as handle:
+                    handle.truncate(self.data_offset + max_bytes)
+                    handle.write(SHARED_HEADER.pack(SHARED_MAGIC, slots, max_bytes, 0, 0))
+                os.replace(temporary, self.path)
+            with open(self.path, "r+b") as handle:
+                self.map = mmap.mmap(handle.fileno(), self.data_offset + max_bytes)
+
+    def valid_file(self):
+        """
+        Whether the file for this layout exists with the expected size and header.
+        """
+        if not exists(self.path) or os.path.getsize(self.path) != self.data_offset + self.data_size:
+            return False
+        with open(self.path, "rb") as handle:
+            header = handle.read(SHARED_HEADER.size)
+        return SHARED_HEADER.unpack(header)[:3] == (SHARED_MAGIC, self.slots, self.data_size)
+
+    @contextmanager
+    def lock(self):
+        """
+        Excludes other writers in this process and, through flock on a file
+        opened per process so forked workers do not share it, in others.
+        """
+        with self.thread_lock:
+            if fcntl is None:
+                yield
+                return
+            pid = os.getpid()
+            if pid not in self.lock_files:
+                self.lock_files = {pid: open(self.lock_path, "rb")}
+            fcntl.flock(self.lock_files[pid], fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_files[pid], fcntl.LOCK_UN)
+
+    def header(self):
+        return SHARED_HEADER.unpack_from(self.map, 0)
+
+    def slot_offset(self, slot):
+        return SHARED_HEADER.size + slot * SHARED_SLOT.size
+
+    def probe(self, key_hash):
+        first = int.from_bytes(key_hash[:8], "little") % self.slots
+        return [(first + step) % self.slots for step in range(SHARED_PROBES)]
+
+    def get(self, key):
+        key_hash = shared_key_hash(key)
+        for slot in self.probe(key_hash):
+            offset = self.slot_offset(slot)
+            sequence, slot_hash, generation, position, version_length, length, checksum, expires = SHARED_SLOT.unpack_from(self.map, offset)
+            if sequence % 2 == 1 or slot_hash != key_hash:
+                continue
+            start = self.data_offset + position % self.data_size
+            record = self.map[start:start + length]
+            _, _, _, head, current_generation = self.header()
+            #Discard the entry if the slot changed while reading, the data has been overwritten or the cache cleared
+            if SHARED_SLOT.unpack_from(self.map, offset)[0] != sequence:
+                return None
+            if head > position + self.data_size or generation != current_generation:
+                continue
+            if zlib.crc32(record) != checksum:
+                return None
+            return record[:version_length].decode("utf-8"), (expires if expires >= 0 else None), record[version_length:]
+        return None
+
+    def write_slot(self, slot, *fields):
+        offset = self.slot_offset(slot)
+        sequence = SHARED_SLOT.unpack_from(self.map, offset)[0]
+        SHARED_SLOT.pack_into(self.map, offset, sequence + 1, *SHARED_SLOT.unpack_from(self.map, offset)[1:])
+        SHARED_SLOT.pack_into(self.map, offset, sequence + 2, *fields)
+
+    def set(self, key, version, expires, value):
+        version = version.encode("utf-8")
+        record = version + value
+        if len(record) > self.data_size:
+            return
+        key_hash = shared_key_hash(key)
+        with self.lock():
+            magic, slots, data_size, head, generation = self.header()
+            #Records never wrap, skip to the start of the data area instead
+            if head % self.data_size + len(record) > self.data_size:
+                head += self.data_size - head % self.data_size
+            position = head
+            #Reserve the space before writing so readers of overwritten records discard them
+            SHARED_HEADER.pack_into(self.map, 0, magic, slots, data_size, position + len(record), generation)
+            start = self.data_offset + position % self.data_size
+            self.map[start:start + len(record)] = record
+            #Reuse the key's slot, else a free or stale one, else the oldest
+            candidates = self.probe(key_hash)
+            states = [SHARED_SLOT.unpack_from(self.map, self.slot_offset(slot)) for slot in candidates]
+            chosen = None
+            for slot, state in zip(candidates, states):
+                if state[1] == key_hash:
+                    chosen = slot
+                    break
+            if chosen is None:
+                stale = [slot for slot, state in zip(candidates, states) if state[1] == SHARED_EMPTY_HASH or state[2] != generation or position + len(record) > state[3] + self.data_size]
+                chosen = stale[0] if len(stale) > 0 else candidates[min(range(len(states)), key=lambda index: states[index][3])]
+            self.write_slot(chosen, key_hash, generation, position, len(version), len(record), zlib.crc32(record), expires if expires is not None else -1.0)
+
+    def delete(self, key):
+        key_hash = shared_key_hash(key)
+        with self.lock():
+            for slot in self.probe(key_hash):
+                if SHARED_SLOT.unpack_from(self.map, self.slot_offset(slot))[1] == key_hash:
+                    self.write_slot(slot, SHARED_EMPTY_HASH, 0, 0, 0, 0, 0, -1.0)
+
+    def clear(self):
+        with self.lock():
+            magic, slots, data_size, head, generation = self.header()
+            SHARED_HEADER.pack_into(self.map, 0, magic, slots, data_size, head, generation + 1)
+
+
+class QueryCache:
+    """
+    Result cache for collection queries. Entries carry the collection data
+    version they were computed against and a time to live, and are discarded
+    on read once either no longer holds.
+    """
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, default=None):
+        entry = self.backend.get(key)
+        if entry is not None:
+            entry_version, expires, value = entry
+            if entry_version == version and (expires is None or expires > time.time()):
+                self.hits += 1
+                return pickle.loads(value)
+            self.backend.delete(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, version, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        self.backend.set(key, version, expires, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_cache_backend(backend, path, max_bytes, slots=4096):
+    """
+    Creates a cache backend: "memory" held by each process, "disk" in an
+    SQLite file at path, or "shared" in a memory-mapped file at path which
+    every process using it reads and writes.
+    """
+    if backend == "disk":
+        return DiskCacheBackend(path, max_bytes)
+    elif backend == "shared":
+        return SharedCacheBackend(path, max_bytes, slots)
+    elif backend == "memory":
+        return MemoryCacheBackend(max_bytes)
+    raise ValueError("Unsupported cache backend: {backend}".format(backend=backend))
+
+
+def create_query_cache(app):
+    """
+    Creates the query cache described by the QUERY_CACHE_* configuration.
+    """
+    backend = app.config["QUERY_CACHE_BACKEND"]
+    filename = app.config["QUERY_CACHE_SHARED_FILENAME"] if backend == "shared" else app.config["QUERY_CACHE_FILENAME"]
+    return QueryCache(
+        create_cache_backend(backend, join(app.instance_path, filename), app.config["QUERY_CACHE_MAX_BYTES"], app.config["QUERY_CACHE_SHARED_SLOTS"]),
+        app.config["QUERY_CACHE_TTL"]
+    )
+
+
+#Query Cache
+def query_cache():
+    if "pbshm_query_cache" not in current_app.extensions:
+        current_app.extensions["pbshm_query_cache"] = create_query_cache(current_app)
+    return current_app.extensions["pbshm_query_cache"]
+
+
+def create_named_cache(app, name):
+    settings = {**CACHE_DEFAULTS, **app.config["CACHES"].get(name, {})}
+    path = join(app.instance_path, "{name}-cache{extension}".format(name=name, extension=CACHE_EXTENSIONS.get(settings["backend"], "")))
+    return QueryCache(create_cache_backend(settings["backend"], path, settings["max_bytes"], settings["slots"]), settings["ttl"])
+
+
+#Named Cache
+def named_cache(name):
+    """
+    Returns the cache called name for this process, created on first use
+    from CACHES[name] in the configuration (backend, max_bytes, slots and
+    ttl, see CACHE_DEFAULTS), so any core or module cache can opt in to the
+    disk or shared backend and keep one copy for every worker rather than
+    one per process. "query" is the query cache.
+    """
+    if name == "query":
+        return query_cache()
+    caches = current_app.extensions.setdefault("pbshm_caches", {})
+    if name not in caches:
+        with caches_lock:
+            if name not in caches:
+                caches[name] = create_named_cache(current_app, name)
+    return caches[name]
+
+
+def query_cache_key(collection, operation, *parts):
+    """
+    Returns a canonical key for a query: the collection namespace plus a hash
+    of the BSON encoding of the query, which preserves stage and field order.
+    """
+    digest = hashlib.sha256(bson.encode({"operation": operation, "parts": list(parts)})).hexdigest()
+    return f"{collection.full_name}:{digest}"
+
+
+def cached_query(collection, key, run, ttl=None, version=None, cache="query"):
+    """
+    Returns the cached result for key from the named cache, or runs the query
+    and caches it. The collection data version, checked once per request
+    (see request_data_version), is used for invalidation unless one is supplied.
+    """
+    if not current_app.config["QUERY_CACHE_ENABLED"]:
+        return run()
+    if version is None:
+        version = request_data_version(collection)[0] if current_app.config["QUERY_CACHE_VERSION_CHECK"] else ""
+    result = named_cache(cache).get(key, version, CACHE_MISS)
+    if result is CACHE_MISS:
+        result = run()
+        named_cache(cache).set(key, version, result, ttl)
+    return result
+
+
+#Cached Aggregate
+def cached_aggregate(collection, pipeline, ttl=None, version=None, cache="query", **kwargs):
+    key = query_cache_key(collection, "aggregate", pipeline, kwargs)
+    return cached_query(collection, key, lambda: list(collection.aggregate(pipeline, **kwargs)), ttl, version, cache)
+
+
+#Cached Find
+def cached_find(collection, filter=None, projection=None, ttl=None, version=None, **kwargs):
+    key = query_cache_key(collection, "find", filter or {}, projection or {}, kwargs)
+    return cached_query(collection, key, lambda: list(collection.find(filter, projection, **kwargs)), ttl, version)
+
+
+#Cache Query Decorator
+def cache_query(collection, ttl=None):
+    """
+    Decorator caching the return value of a function that queries the
+    collection returned by the collection callable. Arguments must be BSON
+    encodable, as they form part of the cache key.
+    """
+    def function_decorator(function):
+        @wraps(function)
+        def wrapped(*args, **kwargs):
+            target = collection()
+            key = query_cache_key(target, f"{function.__module__}.{function.__qualname__}", list(args), kwargs)
+            return cached_query(target, key, lambda: function(*args, **kwargs), ttl)
+        return wrapped
+    return function_decorator
@@ -0,0 +1,243 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import pymongo
+from bson import ObjectId
+from flask import current_app, g, has_request_context
+from werkzeug.exceptions import Unauthorized
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+
+from pbshm.db.batch import request_loader
+from pbshm.db.monitor import command_counter
+
+#Read Preference Modes
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest
+}
+
+#User Fields Loaded per Request
+USER_PROJECTION = {"_id": 1, "firstName": 1, "secondName": 1, "enabled": 1, "permissions": 1}
+
+#Shared Clients
+clients = {}
+clients_lock = threading.Lock()
+
+#Mongo Client
+def mongo_client(uri):
+    """
+    Returns the MongoClient (and so connection pool) for a cluster URI, created
+    on first use and shared by every request in this process. Commands issued
+    through it are counted by any active query counter.
+    """
+    key = (os.getpid(), uri)
+    client = clients.get(key)
+    if client is None:
+        with clients_lock:
+            client = clients.get(key)
+            if client is None:
+                client = pymongo.MongoClient(uri, event_listeners=[command_counter])
+                clients[key] = client
+    return client
+
+#Worker Process Collections
+worker_collections = {}
+
+def initialise_worker(uri, database, collections):
+    """
+    Process pool initializer resolving collections, a dictionary of role to
+    collection name (or None), through the worker's shared client so tasks
+    reach them as worker_collections[role].
+    """
+    database = mongo_client(uri)[database]
+    worker_collections.clear()
+    worker_collections.update({role: database[name] if name is not None else None for role, name in collections.items()})
+
+#Worker Pool
+def worker_pool(processes, collections):
+    """
+    Returns a spawned process pool whose workers resolve the given collections
+    of the app's database on start, see initialise_worker.
+    """
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=get_context("spawn"),
+        initializer=initialise_worker,
+        initargs=(current_app.config["MONGODB_URI"], current_app.config["PBSHM_DATABASE"], collections)
+    )
+
+#Connect
+def db_connect():
+    if "db" not in g:
+        g.db = mongo_client(current_app.config["MONGODB_URI"])[current_app.config["PBSHM_DATABASE"]]
+    return g.db
+
+#User Collection
+def user_collection():
+    if "user_collection" not in g:
+        g.user_collection = db_connect()[current_app.config["USER_COLLECTION"]]
+    return g.user_collection
+
+#User Document
+def user_document(user_id):
+    """
+    Returns a user's names, enabled flag and permissions through the request
+    loader, so the user is queried once per request however many views,
+    decorators and silo checks ask for them. Returns None for unknown users.
+    When a "users" cache is configured in CACHES, documents are also kept
+    across requests for its ttl, so a change of permissions or enabled flag
+    can take up to that long to apply.
+    """
+    if "users" not in current_app.config["CACHES"]:
+        return request_loader(user_collection(), "_id", USER_PROJECTION).load(ObjectId(user_id)).value
+    #Imported here as the cache module builds on this one
+    from pbshm.db.cache import CACHE_MISS, named_cache
+    documents = g.setdefault("user_documents", {})
+    if str(user_id) not in documents:
+        document = named_cache("users").get(str(user_id), "", CACHE_MISS)
+        if document is CACHE_MISS:
+            document = request_loader(user_collection(), "_id", USER_PROJECTION).load(ObjectId(user_id)).value
+            named_cache("users").set(str(user_id), "", document)
+        documents[str(user_id)] = document
+    return documents[str(user_id)]
+
+#Default Collection
+def default_collection(profile=None):
+    if profile is not None:
+        if "profiled_collections" not in g:
+            g.profiled_collections = {}
+        if profile not in g.profiled_collections:
+            g.profiled_collections[profile] = profile_collection(db_connect()[current_app.config["DEFAULT_COLLECTION"]], profile)
+        return g.profiled_collections[profile]
+    if "default_collection" not in g:
+        g.default_collection = db_connect()[current_app.config["DEFAULT_COLLECTION"]]
+    return g.default_collection
+
+#Silo Registry
+def silo_registry():
+    """
+    Returns the configured data silos, each resolved to a uri, database,
+    collection and the permission granting access. The default collection is
+    always available as the "default" silo.
+    """
+    silos = {"default": {
+        "uri": current_app.config["MONGODB_URI"],
+        "database": current_app.config["PBSHM_DATABASE"],
+        "collection": current_app.config["DEFAULT_COLLECTION"],
+        "permission": None
+    }}
+    for name, silo in current_app.config["SILOS"].items():
+        silos[name] = {
+            "uri": silo.get("uri", current_app.config["MONGODB_URI"]),
+            "database": silo.get("database", current_app.config["PBSHM_DATABASE"]),
+            "collection": silo["collection"],
+            "permission": silo.get("permission", "silo-{name}".format(name=name))
+        }
+    return silos
+
+#User Silos
+def user_silos():
+    """
+    Returns the names of the silos the current user can access, resolved from
+    their permissions once per request.
+    """
+    if "user_silos" not in g:
+        silos = silo_registry()
+        permissions = []
+        if g.get("user") is not None:
+            user = user_document(g.user["_id"])
+            permissions = user.get("permissions", []) if user is not None and user.get("enabled") else []
+        g.user_silos = [
+            name for name, silo in silos.items()
+            if silo["permission"] is None or "root" in permissions or silo["permission"] in permissions
+        ]
+    return g.user_silos
+
+#Silo Collection
+def silo_collection(name, profile=None):
+    """
+    Returns the structure collection of a silo through the shared connection
+    pool of its cluster, raising Unauthorized when the user lacks access.
+    """
+    if name not in user_silos():
+        raise Unauthorized(description="You do not have permission to access this data silo")
+    if "silo_collections" not in g:
+        g.silo_collections = {}
+    if (name, profile) not in g.silo_collections:
+        silo = silo_registry()[name]
+        collection = mongo_client(silo["uri"])[silo["database"]][silo["collection"]]
+        g.silo_collections[(name, profile)] = profile_collection(collection, profile) if profile is not None else collection
+    return g.silo_collections[(name, profile)]
+
+#Read Profile
+def read_profile(profile):
+    """
+    Returns the named read profile from READ_PROFILES in the configuration.
+    A profile may set read_preference, read_concern, max_staleness (seconds)
+    and max_time_ms.
+    """
+    profiles = current_app.config["READ_PROFILES"]
+    if profile not in profiles:
+        raise KeyError("No read profile configured with name: {profile}".format(profile=profile))
+    return profiles[profile]
+
+#Profile Collection
+def profile_collection(collection, profile):
+    """
+    Returns the collection with the read preference and read concern of the profile.
+    """
+    settings = read_profile(profile)
+    options = {}
+    if "read_preference" in settings:
+        mode = READ_PREFERENCES[settings["read_preference"]]
+        if mode is Primary:
+            options["read_preference"] = Primary()
+        else:
+            options["read_preference"] = mode(max_staleness=settings.get("max_staleness", -1))
+    if "read_concern" in settings:
+        options["read_concern"] = ReadConcern(settings["read_concern"])
+    return collection.with_options(**options)
+
+#Read Profile Options
+def read_profile_options(profile):
+    """
+    Returns the per-operation options of a profile to pass to find or aggregate.
+    """
+    settings = read_profile(profile) if profile is not None else {}
+    return {"maxTimeMS": settings["max_time_ms"]} if settings.get("max_time_ms") else {}
+
+#Collection Data Version
+def collection_data_version(collection):
+    """
+    Cheap signal which changes whenever documents are inserted into or removed
+    from the collection, without scanning it. Returns a tuple of the version
+    and the creation time of the newest document (or None if empty). In-place
+    updates of existing documents are not reflected.
+    """
+    latest = collection.find_one({}, {"_id": 1}, sort=[("_id", pymongo.DESCENDING)])
+    if latest is None:
+        return "empty", None
+    version = "{count}-{latest}".format(count=collection.estimated_document_count(), latest=latest["_id"])
+    return version, latest["_id"].generation_time if isinstance(latest["_id"], ObjectId) else None
+
+#Request Data Version
+def request_data_version(collection):
+    """
+    collection_data_version memoised for the current request, so the cached
+    queries of a request check each collection once. The trade-off is that
+    documents inserted or removed later in the same request are not seen by
+    its cached queries until the next request. Outside a request the version
+    is checked every time, as app contexts of jobs and commands live long.
+    """
+    if not has_request_context():
+        return collection_data_version(collection)
+    versions = g.setdefault("data_versions", {})
+    if collection.full_name not in versions:
+        versions[collection.full_name] = collection_data_version(collection)
+    return versions[collection.full_name]
@@ -0,0 +1,147 @@
+import pymongo
+from flask import current_app
+
+from pbshm.db.db import db_connect
+
+#Declared Indexes
+INDEXES = []
+
+
+def register_index(collection, keys, name, **options):
+    """
+    Declares an index required by core or a module. collection is either a
+    configuration key holding a collection name (such as "USER_COLLECTION")
+    or a literal collection name. Options are passed to create_index.
+    """
+    INDEXES.append({"collection": collection, "keys": [tuple(key) for key in keys], "name": name, "options": options})
+
+
+def resolve_collection_name(collection):
+    return current_app.config.get(collection, collection)
+
+
+def index_drift(declared, existing):
+    """
+    Compares declared indexes with index_information() output for one
+    collection. Returns (missing, drifted, undeclared): declared indexes with
+    no index on the same keys, declared indexes whose name or options differ
+    from the index on the same keys, and existing indexes nobody declared.
+    """
+    existing_by_keys = {tuple(tuple(key) for key in information["key"]): (name, information) for name, information in existing.items()}
+    missing, drifted, matched = [], [], set()
+    for index in declared:
+        keys = tuple(index["keys"])
+        if keys not in existing_by_keys:
+            missing.append(index)
+            continue
+        name, information = existing_by_keys[keys]
+        matched.add(name)
+        differences = []
+        if name != index["name"]:
+            differences.append("name is {actual}, declared {declared}".format(actual=name, declared=index["name"]))
+        for option, value in index["options"].items():
+            if option == "background":
+                continue
+            if information.get(option, False) != value:
+                differences.append("{option} is {actual}, declared {declared}".format(option=option, actual=information.get(option), declared=value))
+        if len(differences) > 0:
+            drifted.append((index, differences))
+    undeclared = [name for name in existing if name not in matched and name != "_id_"]
+    return missing, drifted, undeclared
+
+
+def sync_indexes(collections=None, report=print):
+    """
+    Creates every declared index which does not yet exist and reports drift
+    between declared and existing indexes.
+    collections optionally limits the sync to the given collection keys or names.
+    """
+    db = db_connect()
+    grouped = {}
+    for index in INDEXES:
+        if collections is None or index["collection"] in collections:
+            grouped.setdefault(resolve_collection_name(index["collection"]), []).append(index)
+    for collection_name, declared in grouped.items():
+        existing = db[collection_name].index_information() if collection_name in db.list_collection_names() else {}
+        missing, drifted, undeclared = index_drift(declared, existing)
+        for index in missing:
+            report("{collection}: creating {name}".format(collection=collection_name, name=index["name"]))
+            db[collection_name].create_index(index["keys"], name=index["name"], **index["options"])
+        for index, differences in drifted:
+            report("{collection}: {name} has drifted ({differences})".format(collection=collection_name, name=index["name"], differences="; ".join(differences)))
+        for name in undeclared:
+            report("{collection}: {name} is not declared by core or any module".format(collection=collection_name, name=name))
+
+
+def create_declared_indexes(collection, target=None):
+    """
+    Creates the indexes declared for a collection key or name, optionally on
+    another collection such as a newly installed structure collection.
+    """
+    target = db_connect()[target if target is not None else resolve_collection_name(collection)]
+    for index in INDEXES:
+        if index["collection"] == collection:
+            target.create_index(index["keys"], name=index["name"], **index["options"])
+
+
+def redundant_indexes(indexes, unique=()):
+    """
+    Returns (name, covering name) pairs for non-unique indexes whose keys are a
+    prefix of another index's keys, so the longer index already serves them.
+    indexes maps index names to their key lists.
+    """
+    redundant = []
+    for name, keys in indexes.items():
+        if name == "_id_" or name in unique:
+            continue
+        for other_name, other_keys in indexes.items():
+            if other_name != name and len(other_keys) > len(keys) and list(other_keys[:len(keys)]) == list(keys):
+                redundant.append((name, other_name))
+                break
+    return redundant
+
+
+def index_usage(collection_name):
+    """
+    Returns the $indexStats usage of every index on a collection as a
+    dictionary of name to operation count, key and the time counting began.
+    """
+    return {
+        statistics["name"]: {
+            "ops": statistics["accesses"]["ops"],
+            "since": statistics["accesses"]["since"],
+            "key": list(statistics["key"].items())
+        }
+        for statistics in db_connect()[collection_name].aggregate([{"$indexStats": {}}])
+    }
+
+
+def report_index_usage(collections=None, report=print):
+    """
+    Reports unused indexes (no operations since statistics began) and
+    redundant prefix indexes for the declared collections.
+    """
+    names = {resolve_collection_name(index["collection"]) for index in INDEXES}
+    if collections is not None:
+        names = {resolve_collection_name(collection) for collection in collections}
+    existing = db_connect().list_collection_names()
+    for collection_name in sorted(names):
+        if collection_name not in existing:
+            continue
+        usage = index_usage(collection_name)
+        unique = {name for name, information in db_connect()[collection_name].index_information().items() if information.get("unique")}
+        for name, statistics in usage.items():
+            if statistics["ops"] == 0 and name != "_id_" and name not in unique:
+                report("{collection}: {name} unused since {since}".format(collection=collection_name, name=name, since=statistics["since"].isoformat()))
+        for name, covering in redundant_indexes({name: statistics["key"] for name, statistics in usage.items()}, unique):
+            report("{collection}: {name} is redundant with {covering}".format(collection=collection_name, name=name, covering=covering))
+
+
+#Core Indexes
+register_index("USER_COLLECTION", [("emailAddress", pymongo.ASCENDING)], "emailAddress_1", unique=True)
+register_index("DEFAULT_COLLECTION", [
+    ("population", pymongo.ASCENDING),
+    ("name", pymongo.ASCENDING),
+    ("timestamp", pymongo.ASCENDING),
+    ("channels.name", pymongo.ASCENDING)
+], "pbshm_framework_channel", unique=True)
@@ -0,0 +1,106 @@
+from array import array
+from numbers import Real
+
+import numpy as np
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from pbshm.db.db import default_collection
+
+
+def channel_query_pipeline(population, structure, start=None, end=None, channels=None):
+    """
+    Builds the pipeline used to load channel values for a structure. The match
+    and sort are served by the pbshm_framework_channel index and only the
+    timestamp plus the requested channel names and values leave the server.
+    """
+    match = {"population": population, "name": structure}
+    if start is not None or end is not None:
+        match["timestamp"] = {}
+        if start is not None: match["timestamp"]["$gte"] = start
+        if end is not None: match["timestamp"]["$lt"] = end
+    if channels is not None:
+        match["channels.name"] = {"$in": list(channels)}
+    source = "$channels" if channels is None else {"$filter": {
+        "input": "$channels",
+        "cond": {"$in": ["$$this.name", list(channels)]}
+    }}
+    return [
+        {"$match": match},
+        {"$sort": {"timestamp": 1}},
+        {"$project": {
+            "_id": 0,
+            "timestamp": 1,
+            "channels": {"$map": {
+                "input": source,
+                "in": {"name": "$$this.name", "value": "$$this.value"}
+            }}
+        }}
+    ]
+
+
+def channel_value(value, statistic):
+    """
+    Returns the numeric value of a channel, selecting the given statistic when
+    the value is a summary object (min, max, mean, std).
+    """
+    if isinstance(value, Real):
+        return float(value)
+    if isinstance(value, (dict, RawBSONDocument)) and statistic in value and isinstance(value[statistic], Real):
+        return float(value[statistic])
+    return np.nan
+
+
+def align_channels(timestamps, values, step, start=None, end=None):
+    """
+    Linearly interpolates every channel onto a common time grid with the given
+    step in nanoseconds. Grid points outside a channel's samples are NaN.
+    """
+    start = int(timestamps[0]) if start is None and len(timestamps) > 0 else start
+    end = int(timestamps[-1]) + 1 if end is None and len(timestamps) > 0 else end
+    if start is None or end is None:
+        return np.empty(0, dtype=np.int64), {name: np.empty(0) for name in values}
+    grid = np.arange(start, end, step, dtype=np.int64)
+    #Interpolate relative to the grid origin to keep nanosecond precision in float64
+    grid_offsets = (grid - start).astype(np.float64)
+    sample_offsets = (timestamps - start).astype(np.float64)
+    aligned = {}
+    for name, channel in values.items():
+        mask = np.isfinite(channel)
+        if not mask.any():
+            aligned[name] = np.full(len(grid), np.nan)
+        else:
+            aligned[name] = np.interp(grid_offsets, sample_offsets[mask], channel[mask], left=np.nan, right=np.nan)
+    return grid, aligned
+
+
+def load_channel_arrays(population, structure, start=None, end=None, channels=None, statistic="mean", step=None, collection=None):
+    """
+    Loads channel values for a structure into dense NumPy arrays. Returns an
+    int64 vector of timestamps and a dictionary of channel name to float64
+    array, with NaN where a document does not contain the channel. When step
+    is given, every channel is aligned onto a common grid via align_channels.
+    """
+    collection = default_collection() if collection is None else collection
+    raw_collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    timestamps = array("q")
+    buffers = {name: array("d") for name in channels} if channels is not None else {}
+    #Decode straight from the raw BSON buffers into typed arrays
+    for document in raw_collection.aggregate(channel_query_pipeline(population, structure, start, end, channels)):
+        row = len(timestamps)
+        timestamps.append(document["timestamp"])
+        for channel in document["channels"]:
+            name = channel["name"]
+            if name not in buffers:
+                buffers[name] = array("d", [np.nan]) * row
+            buffer = buffers[name]
+            if len(buffer) == row:
+                buffer.append(channel_value(channel["value"], statistic))
+        for buffer in buffers.values():
+            if len(buffer) == row:
+                buffer.append(np.nan)
+    timestamp_vector = np.frombuffer(timestamps, dtype=np.int64) if len(timestamps) > 0 else np.empty(0, dtype=np.int64)
+    values = {name: np.frombuffer(buffer, dtype=np.float64) if len(buffer) > 0 else np.empty(0) for name, buffer in buffers.items()}
+    if step is not None:
+        return align_channels(timestamp_vector, values, step, start, end)
+    return timestamp_vector, values
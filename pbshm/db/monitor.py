@@ -0,0 +1,117 @@
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+#Commands which are not issued by application code
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "authenticate", "endSessions", "killCursors"}
+
+#Modules skipped when resolving the call site of a command
+INTERNAL_MODULES = ("pymongo", "bson", "pbshm.db", "contextlib")
+
+#Active Counters
+active_counters = ContextVar("pbshm_query_counters", default=())
+
+
+class QueryCounter:
+    """
+    Counts the database commands issued while active, by collection and by the
+    first calling frame outside pymongo and pbshm.db.
+    """
+    def __init__(self):
+        self.total = 0
+        self.collections = Counter()
+        self.call_sites = Counter()
+
+    def record(self, collection, call_site):
+        self.total += 1
+        self.collections[collection] += 1
+        self.call_sites[call_site] += 1
+
+    def summary(self):
+        return "; ".join([str(self.total)] + [
+            "{collection}={count}".format(collection=collection, count=count)
+            for collection, count in self.collections.most_common()
+        ])
+
+
+def call_site():
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if not module.startswith(INTERNAL_MODULES):
+            return "{module}:{function}:{line}".format(module=module, function=frame.f_code.co_name, line=frame.f_lineno)
+        frame = frame.f_back
+    return "unknown"
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Listener attached to every shared client which records each command on
+    the counters active in the calling context. Commands are published on the
+    thread issuing them, so the context is that of the request or test.
+    """
+    def started(self, event):
+        counters = active_counters.get()
+        if len(counters) == 0 or event.command_name in IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        collection = collection if isinstance(collection, str) else event.database_name
+        site = call_site()
+        for counter in counters:
+            counter.record(collection, site)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+#Shared Listener
+command_counter = CommandCounter()
+
+
+def start_counting():
+    """
+    Activates a new counter in the current context. Returns the counter and
+    the token to pass to stop_counting.
+    """
+    counter = QueryCounter()
+    return counter, active_counters.set(active_counters.get() + (counter,))
+
+
+def stop_counting(token):
+    try:
+        active_counters.reset(token)
+    except ValueError:
+        pass
+
+
+@contextmanager
+def count_queries():
+    """
+    Counts the database commands issued within the block.
+    """
+    counter, token = start_counting()
+    try:
+        yield counter
+    finally:
+        stop_counting(token)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """
+    Fails with a breakdown by collection and call site when the block issues
+    more than limit database commands, for example around a test client request.
+    """
+    with count_queries() as counter:
+        yield counter
+    if counter.total > limit:
+        raise AssertionError("{total} database commands issued, expected at most {limit}: {sites}".format(
+            total=counter.total, limit=limit,
+            sites=", ".join("{site} x{count}".format(site=site, count=count) for site, count in counter.call_sites.most_common())
+        ))
@@ -0,0 +1,318 @@
+from copy import deepcopy
+
+from flask import current_app
+
+from pbshm.db.cache import cached_aggregate
+
+#Match Operators which combine other queries
+LOGICAL_OPERATORS = ("$and", "$or", "$nor")
+
+#Stages which replace the document, ending the fields required from the source
+REPLACING_STAGES = ("$group", "$count", "$replaceRoot", "$replaceWith", "$bucket", "$bucketAuto", "$sortByCount")
+
+#Index expected to serve structure data pipelines
+CHANNEL_INDEX = "pbshm_framework_channel"
+
+
+def field_root(path):
+    return path.split(".")[0]
+
+
+def expression_fields(expression):
+    """
+    Returns the root fields referenced by an aggregation expression, or None
+    when it references the whole document ($$ROOT or $$CURRENT).
+    """
+    fields = set()
+    if isinstance(expression, str):
+        if expression in ("$$ROOT", "$$CURRENT") or expression.startswith(("$$ROOT.", "$$CURRENT.")):
+            return None
+        if expression.startswith("$") and not expression.startswith("$$"):
+            fields.add(field_root(expression[1:]))
+    elif isinstance(expression, dict):
+        #Accumulators such as $top and $topN name their sort fields without a $ prefix
+        if isinstance(expression.get("sortBy"), dict):
+            fields |= {field_root(key) for key in expression["sortBy"]}
+        for key, value in expression.items():
+            if key == "sortBy":
+                continue
+            nested = expression_fields(value)
+            if nested is None:
+                return None
+            fields |= nested
+    elif isinstance(expression, (list, tuple)):
+        for value in expression:
+            nested = expression_fields(value)
+            if nested is None:
+                return None
+            fields |= nested
+    return fields
+
+
+def match_fields(query):
+    """
+    Returns the root fields a $match query filters on, or None when it uses an
+    operator which must not be moved ($text, $where and the like).
+    """
+    fields = set()
+    for key, value in query.items():
+        if key in LOGICAL_OPERATORS:
+            for clause in value:
+                nested = match_fields(clause)
+                if nested is None:
+                    return None
+                fields |= nested
+        elif key == "$expr":
+            nested = expression_fields(value)
+            if nested is None:
+                return None
+            fields |= nested
+        elif key == "$comment":
+            continue
+        elif key.startswith("$"):
+            return None
+        else:
+            fields.add(field_root(key))
+    return fields
+
+
+def passes(fields, stage):
+    """
+    Whether a $match on the given root fields returns the same documents when
+    moved ahead of the stage.
+    """
+    (name, specification), = stage.items()
+    if name == "$sort":
+        return True
+    if name == "$project":
+        exclusion = all(value in (0, False) for key, value in specification.items() if key != "_id")
+        for root in fields:
+            entries = {key: value for key, value in specification.items() if field_root(key) == root}
+            if exclusion and len(entries) > 0:
+                return False
+            if not exclusion and entries != {root: 1} and entries != {root: True} and not (root == "_id" and len(entries) == 0):
+                return False
+        return True
+    if name in ("$addFields", "$set"):
+        return not any(field_root(key) in fields for key in specification)
+    if name == "$unset":
+        return not any(field_root(key) in fields for key in ([specification] if isinstance(specification, str) else specification))
+    if name == "$unwind":
+        options = {"path": specification} if isinstance(specification, str) else specification
+        unwound = {field_root(options["path"].lstrip("$"))}
+        if "includeArrayIndex" in options:
+            unwound.add(field_root(options["includeArrayIndex"]))
+        return len(unwound & fields) == 0
+    return False
+
+
+def merge_matches(first, second):
+    if len(set(first) & set(second)) == 0:
+        return {**first, **second}
+    return {"$and": [first, second]}
+
+
+def hoist_matches(stages):
+    """
+    Moves every $match as early as it can go without changing the result,
+    merging adjacent matches, so the leading match can use an index.
+    """
+    stages = list(stages)
+    index = 0
+    while index < len(stages):
+        if "$match" in stages[index]:
+            fields = match_fields(stages[index]["$match"])
+            position = index
+            while fields is not None and position > 0 and ("$match" in stages[position - 1] or passes(fields, stages[position - 1])):
+                if "$match" in stages[position - 1]:
+                    stages[position - 1] = {"$match": merge_matches(stages[position - 1]["$match"], stages[position]["$match"])}
+                    del stages[position]
+                else:
+                    stages[position - 1], stages[position] = stages[position], stages[position - 1]
+                position -= 1
+            index = position
+        index += 1
+    return stages
+
+
+def required_fields(stages):
+    """
+    Returns the root fields the stages read from their input documents, or
+    None when the whole document reaches the output or cannot be analysed.
+    """
+    fields = set()
+    for stage in stages:
+        (name, specification), = stage.items()
+        if name == "$match":
+            nested = match_fields(specification)
+        elif name == "$sort":
+            nested = {field_root(key) for key in specification}
+        elif name in ("$limit", "$skip"):
+            nested = set()
+        elif name == "$unwind":
+            nested = {field_root((specification if isinstance(specification, str) else specification["path"]).lstrip("$"))}
+        elif name in ("$addFields", "$set"):
+            nested = expression_fields(list(specification.values()))
+        elif name == "$lookup":
+            nested = expression_fields(specification.get("let", {}))
+            if nested is not None and "localField" in specification:
+                nested.add(field_root(specification["localField"]))
+        elif name == "$project":
+            if all(value in (0, False) for value in specification.values()):
+                return None
+            nested = expression_fields([value for value in specification.values() if value not in (0, 1, True, False)])
+            if nested is None:
+                return None
+            nested |= {field_root(key) for key, value in specification.items() if value in (1, True)}
+            if specification.get("_id", 1) not in (0, False):
+                nested.add("_id")
+            return fields | nested
+        elif name in REPLACING_STAGES:
+            nested = expression_fields(specification)
+            return None if nested is None else fields | nested
+        else:
+            return None
+        if nested is None:
+            return None
+        fields |= nested
+    return None
+
+
+def push_down_projection(stages):
+    """
+    Inserts a projection of only the fields later stages read directly after
+    the leading $match and $sort stages, so unused fields such as channel
+    values are dropped as early as possible.
+    """
+    leading = 0
+    while leading < len(stages) and ("$match" in stages[leading] or "$sort" in stages[leading]):
+        leading += 1
+    if leading < len(stages) and "$project" in stages[leading]:
+        return stages
+    fields = required_fields(stages[leading:])
+    if fields is None or len(fields) == 0:
+        return stages
+    projection = {field: 1 for field in sorted(fields)}
+    if "_id" not in fields:
+        projection["_id"] = 0
+    return stages[:leading] + [{"$project": projection}] + stages[leading:]
+
+
+def plan_summary(plan):
+    """
+    Returns whether an explain output contains a collection scan and the names
+    of the indexes it uses.
+    """
+    collection_scan, indexes = False, set()
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            collection_scan = True
+        if "indexName" in plan:
+            indexes.add(plan["indexName"])
+        values = plan.values()
+    elif isinstance(plan, list):
+        values = plan
+    else:
+        values = []
+    for value in values:
+        nested_scan, nested_indexes = plan_summary(value)
+        collection_scan, indexes = collection_scan or nested_scan, indexes | nested_indexes
+    return collection_scan, indexes
+
+
+class Pipeline:
+    """
+    Builds an aggregation pipeline over structure documents. Stages are
+    optimised when built: matches are moved ahead of stages they do not
+    depend on, a projection of only the fields used is pushed down and
+    channel selections are turned into an indexable match plus a filter.
+    """
+    def __init__(self, stages=None):
+        self.stages = list(stages) if stages is not None else []
+
+    def stage(self, stage):
+        self.stages.append(stage)
+        return self
+
+    def match(self, query=None, **fields):
+        return self.stage({"$match": {**(query or {}), **fields}})
+
+    def structures(self, population=None, names=None):
+        query = {}
+        if population is not None:
+            query["population"] = population
+        if names is not None:
+            query["name"] = names if isinstance(names, str) else {"$in": list(names)}
+        return self.match(query)
+
+    def time_range(self, start=None, end=None):
+        """
+        Filters on the nanosecond timestamp, start inclusive and end exclusive.
+        """
+        query = {}
+        if start is not None: query["$gte"] = start
+        if end is not None: query["$lt"] = end
+        return self.match({"timestamp": query}) if len(query) > 0 else self
+
+    def channels(self, names):
+        """
+        Keeps only documents recording the named channels and reduces their
+        channels array to those names.
+        """
+        names = list(names)
+        self.match({"channels.name": {"$in": names}})
+        return self.stage({"$set": {"channels": {"$filter": {"input": "$channels", "cond": {"$in": ["$$this.name", names]}}}}})
+
+    def project(self, specification):
+        return self.stage({"$project": specification})
+
+    def unwind(self, path):
+        return self.stage({"$unwind": path})
+
+    def group(self, identifier, **accumulators):
+        return self.stage({"$group": {"_id": identifier, **accumulators}})
+
+    def sort(self, specification=None, **fields):
+        return self.stage({"$sort": {**(specification or {}), **fields}})
+
+    def limit(self, count):
+        return self.stage({"$limit": count})
+
+    def build(self, optimise=True):
+        stages = deepcopy(self.stages)
+        if optimise:
+            stages = push_down_projection(hoist_matches(stages))
+        return stages
+
+    def explain(self, collection):
+        return collection.database.command(
+            "explain", {"aggregate": collection.name, "pipeline": self.build(), "cursor": {}},
+            verbosity="queryPlanner"
+        )
+
+    def check_plan(self, collection, index=CHANNEL_INDEX):
+        """
+        Explains the pipeline and logs a warning when it scans the collection
+        instead of using the expected index. Returns (collection scan, indexes).
+        """
+        collection_scan, indexes = plan_summary(self.explain(collection))
+        if collection_scan or (index is not None and index not in indexes):
+            current_app.logger.warning(
+                "Pipeline on %s %s instead of using %s: %s", collection.name,
+                "scans the collection" if collection_scan else "uses {indexes}".format(indexes=", ".join(sorted(indexes)) or "no index"),
+                index, self.build()
+            )
+        return collection_scan, indexes
+
+    def aggregate(self, collection, cache=True, version=None, **kwargs):
+        """
+        Runs the optimised pipeline, through the query cache (or the named
+        cache given as cache) unless disabled, against the given collection
+        data version when already known.
+        The plan is checked first when PIPELINE_EXPLAIN_CHECK is enabled.
+        """
+        if current_app.config["PIPELINE_EXPLAIN_CHECK"]:
+            self.check_plan(collection)
+        if cache:
+            return cached_aggregate(collection, self.build(), version=version, cache=cache if isinstance(cache, str) else "query", **kwargs)
+        return collection.aggregate(self.build(), **kwargs)
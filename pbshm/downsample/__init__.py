@@ -0,0 +1 @@
+from pbshm.downsample.downsample import *
\ No newline at end of file
@@ -0,0 +1,180 @@
+import math
+
+import numpy as np
+import pymongo
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from pbshm.authentication import authenticate_request
+from pbshm.db import default_collection, cached_aggregate
+
+#Create the Downsample Blueprint
+bp = Blueprint("downsample", __name__)
+
+
+def channel_time_range(population, structure, collection=None):
+    """
+    Returns the first and last timestamp (inclusive) recorded for a structure,
+    or None when it has no documents.
+    """
+    collection = default_collection() if collection is None else collection
+    bounds = []
+    for direction in (pymongo.ASCENDING, pymongo.DESCENDING):
+        document = collection.find_one(
+            {"population": population, "name": structure},
+            {"_id": 0, "timestamp": 1},
+            sort=[("timestamp", direction)]
+        )
+        if document is None:
+            return None
+        bounds.append(document["timestamp"])
+    return bounds[0], bounds[1]
+
+
+def bucket_pipeline(population, structure, channel, start, end, buckets, statistic="mean"):
+    """
+    Builds a pipeline which splits [start, end) into equal width buckets over
+    the timestamp field and returns the min, max, mean and count of the channel
+    value within each non-empty bucket.
+    """
+    width = max(1, math.ceil((end - start) / buckets))
+    offset = {"$subtract": ["$timestamp", start]}
+    return [
+        {"$match": {
+            "population": population,
+            "name": structure,
+            "timestamp": {"$gte": start, "$lt": end},
+            "channels.name": channel
+        }},
+        {"$project": {
+            "_id": 0,
+            "timestamp": 1,
+            "value": {"$let": {
+                "vars": {"channel": {"$arrayElemAt": [
+                    {"$filter": {"input": "$channels", "cond": {"$eq": ["$$this.name", channel]}}}, 0
+                ]}},
+                "in": {"$cond": [
+                    {"$isNumber": "$$channel.value"},
+                    "$$channel.value",
+                    f"$$channel.value.{statistic}"
+                ]}
+            }}
+        }},
+        {"$match": {"value": {"$type": "number"}}},
+        {"$group": {
+            "_id": {"$toLong": {"$divide": [{"$subtract": [offset, {"$mod": [offset, width]}]}, width]}},
+            "min": {"$min": "$value"},
+            "max": {"$max": "$value"},
+            "mean": {"$avg": "$value"},
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {
+            "_id": 0,
+            "timestamp": {"$add": [start, {"$multiply": ["$_id", width]}, width // 2]},
+            "min": 1,
+            "max": 1,
+            "mean": 1,
+            "count": 1
+        }}
+    ]
+
+
+def downsample_buckets(population, structure, channel, start, end, buckets, statistic="mean", collection=None):
+    """
+    Returns a dictionary of arrays (timestamp, min, max, mean, count) with one
+    entry per non-empty bucket, computed on the server and cached per range and
+    resolution.
+    """
+    collection = default_collection() if collection is None else collection
+    return bucket_arrays(cached_aggregate(collection, bucket_pipeline(population, structure, channel, start, end, buckets, statistic)))
+
+
+def bucket_arrays(documents):
+    return {
+        "timestamp": np.array([document["timestamp"] for document in documents], dtype=np.int64),
+        "min": np.array([document["min"] for document in documents], dtype=np.float64),
+        "max": np.array([document["max"] for document in documents], dtype=np.float64),
+        "mean": np.array([document["mean"] for document in documents], dtype=np.float64),
+        "count": np.array([document["count"] for document in documents], dtype=np.int64)
+    }
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets reduction of the series (x, y) to threshold
+    points. Returns the indices of the selected points, always including the
+    first and last.
+    """
+    length = len(x)
+    if threshold >= length:
+        return np.arange(length)
+    if threshold < 3:
+        return np.array([0, length - 1], dtype=np.int64)[:max(threshold, 0)]
+    x = np.asarray(x, dtype=np.float64) - float(x[0])
+    y = np.asarray(y, dtype=np.float64)
+    #Bucket edges over the interior points
+    edges = np.linspace(1, length - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, length - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        lower, upper = edges[bucket], edges[bucket + 1]
+        #Average of the next bucket (or the last point for the final bucket)
+        next_upper = edges[bucket + 2] if bucket + 2 < len(edges) else length
+        next_x, next_y = x[upper:next_upper].mean(), y[upper:next_upper].mean()
+        #Pick the point forming the largest triangle with the previous selection and next average
+        areas = np.abs(
+            (x[previous] - next_x) * (y[lower:upper] - y[previous])
+            - (x[previous] - x[lower:upper]) * (next_y - y[previous])
+        )
+        previous = lower + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample_channel(population, structure, channel, start=None, end=None, points=1000, method="lttb", statistic="mean", collection=None):
+    """
+    Returns at most points samples of a channel over [start, end), either as
+    server-side min/max/mean buckets (method="bucket") or as an LTTB reduction
+    of finer server-side buckets (method="lttb").
+    """
+    if method not in ("bucket", "lttb"):
+        raise ValueError("Unsupported downsampling method: {method}".format(method=method))
+    if start is None or end is None:
+        bounds = channel_time_range(population, structure, collection)
+        if bounds is not None:
+            start = bounds[0] if start is None else start
+            end = bounds[1] + 1 if end is None else end
+    #An empty structure has the same keys as any other, with empty arrays
+    if start is None or end is None:
+        buckets = bucket_arrays([])
+    elif method == "bucket":
+        buckets = downsample_buckets(population, structure, channel, start, end, points, statistic, collection)
+    else:
+        buckets = downsample_buckets(
+            population, structure, channel, start, end,
+            points * current_app.config["DOWNSAMPLE_LTTB_OVERSAMPLING"], statistic, collection
+        )
+    if method == "bucket":
+        return buckets
+    indices = lttb(buckets["timestamp"], buckets["mean"], points)
+    return {"timestamp": buckets["timestamp"][indices], "value": buckets["mean"][indices]}
+
+
+#Downsample View
+@bp.route("/<population>/<structure>/<channel>")
+@authenticate_request("downsample-channel")
+def channel(population, structure, channel):
+    start = request.args.get("start", type=int)
+    end = request.args.get("end", type=int)
+    points = request.args.get("points", default=1000, type=int)
+    method = request.args.get("method", default="lttb")
+    statistic = request.args.get("statistic", default="mean")
+    if points < 1 or points > current_app.config["DOWNSAMPLE_MAX_POINTS"] or method not in ["bucket", "lttb"]:
+        abort(400)
+    if statistic not in ["min", "max", "mean", "std"]:
+        abort(400)
+    if start is not None and end is not None and end <= start:
+        abort(400)
+    series = downsample_channel(population, structure, channel, start, end, points, method, statistic)
+    return jsonify({key: series[key].tolist() for key in series})
@@ -0,0 +1 @@
+from pbshm.features.features import *
\ No newline at end of file
@@ -0,0 +1,188 @@
+import time
+from concurrent.futures import as_completed
+
+import click
+import numpy as np
+import pymongo
+from flask import Blueprint, current_app
+from pymongo import UpdateOne
+
+from pbshm.db import db_connect, default_collection, load_channel_arrays, register_index, worker_collections, worker_pool
+
+#Create the Features Blueprint
+bp = Blueprint("features", __name__, cli_group="features")
+
+#Registered Features
+FEATURES = {}
+
+#Features Indexes
+register_index("FEATURE_COLLECTION", [
+    ("feature", pymongo.ASCENDING), ("window", pymongo.ASCENDING), ("extracted", pymongo.ASCENDING)
+], "pbshm_features_window_extracted")
+
+
+def register_feature(name, function, channels=None, statistic="mean", version=1):
+    """
+    Registers a feature function for extraction across populations. The
+    function receives the int64 timestamps and a dictionary of channel arrays
+    for one structure and time window, and returns a dictionary of feature
+    values. It must be defined at module level so worker processes can import it.
+    """
+    FEATURES[name] = {"function": function, "channels": channels, "statistic": statistic, "version": version}
+    return function
+
+
+def feature(name, channels=None, statistic="mean", version=1):
+    """
+    Decorator form of register_feature.
+    """
+    def function_decorator(function):
+        return register_feature(name, function, channels, statistic, version)
+    return function_decorator
+
+
+def feature_partitions(collection, window, population=None, start=None, end=None, windows_per_task=64):
+    """
+    Splits the work into tasks of consecutive time windows per structure,
+    aligned to multiples of the window size so reruns produce the same windows.
+    """
+    match = {} if population is None else {"population": population}
+    tasks = []
+    for structure in collection.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"population": "$population", "name": "$name"},
+            "start": {"$min": "$timestamp"},
+            "end": {"$max": "$timestamp"}
+        }},
+        {"$sort": {"_id.population": 1, "_id.name": 1}}
+    ], allowDiskUse=True):
+        first = max(structure["start"], start) if start is not None else structure["start"]
+        last = min(structure["end"], end - 1) if end is not None else structure["end"]
+        windows = list(range(first - first % window, last + 1, window))
+        for index in range(0, len(windows), windows_per_task):
+            tasks.append({
+                "population": structure["_id"]["population"],
+                "name": structure["_id"]["name"],
+                "windows": windows[index:index + windows_per_task]
+            })
+    return tasks
+
+
+def task_key(feature_name, window, task):
+    return {
+        "feature": feature_name,
+        "window": window,
+        "population": task["population"],
+        "name": task["name"],
+        "start": task["windows"][0]
+    }
+
+
+def extract_task(feature_name, definition, window, task):
+    """
+    Loads the span of one task once, evaluates the feature for every window
+    and bulk-writes the results. Returns the number of windows processed.
+    """
+    start, end = task["windows"][0], task["windows"][-1] + window
+    timestamps, values = load_channel_arrays(
+        task["population"], task["name"], start, end,
+        definition["channels"], definition["statistic"], collection=worker_collections["collection"]
+    )
+    operations = []
+    for window_start in task["windows"]:
+        lower, upper = np.searchsorted(timestamps, [window_start, window_start + window], side="left")
+        if upper <= lower:
+            continue
+        result = definition["function"](timestamps[lower:upper], {name: channel[lower:upper] for name, channel in values.items()})
+        if result is None:
+            continue
+        key = {"feature": feature_name, "window": window, "population": task["population"], "name": task["name"], "start": window_start}
+        #The server stamps extracted as each write lands, so it orders writes across workers
+        operations.append(UpdateOne({"_id": key}, {
+            "$set": {
+                **key,
+                "end": window_start + window,
+                "version": definition["version"],
+                "values": {name: float(value) for name, value in result.items()}
+            },
+            "$currentDate": {"extracted": True}
+        }, upsert=True))
+    if len(operations) > 0:
+        worker_collections["feature_collection"].bulk_write(operations, ordered=False)
+    return len(task["windows"])
+
+
+def run_feature_extraction(feature_name, window, population=None, start=None, end=None, processes=None, resume=True, progress=print):
+    """
+    Runs a registered feature over every structure (optionally of one
+    population) in the default collection across a process pool. Completed
+    tasks are checkpointed so an interrupted run resumes where it stopped.
+    Returns the number of windows processed.
+    """
+    if feature_name not in FEATURES:
+        raise KeyError("No feature registered with name: {name}".format(name=feature_name))
+    definition = FEATURES[feature_name]
+    db = db_connect()
+    checkpoints = db[current_app.config["FEATURE_CHECKPOINT_COLLECTION"]]
+    tasks = feature_partitions(default_collection(), window, population, start, end, current_app.config["FEATURE_WINDOWS_PER_TASK"])
+    #Skip Completed Tasks
+    if resume:
+        completed = {
+            (document["_id"]["population"], document["_id"]["name"], document["_id"]["start"])
+            for document in checkpoints.find({"_id.feature": feature_name, "_id.window": window, "version": definition["version"]}, {"_id": 1})
+        }
+        tasks = [task for task in tasks if (task["population"], task["name"], task["windows"][0]) not in completed]
+    else:
+        checkpoints.delete_many({"_id.feature": feature_name, "_id.window": window})
+    total = len(tasks)
+    progress("Processing {total} tasks for feature {name}".format(total=total, name=feature_name))
+    #Run Tasks
+    processed, started = 0, time.monotonic()
+    with worker_pool(processes, {"collection": current_app.config["DEFAULT_COLLECTION"], "feature_collection": current_app.config["FEATURE_COLLECTION"]}) as executor:
+        futures = {executor.submit(extract_task, feature_name, definition, window, task): task for task in tasks}
+        try:
+            for index, future in enumerate(as_completed(futures), start=1):
+                task = futures[future]
+                processed += future.result()
+                checkpoints.replace_one(
+                    {"_id": task_key(feature_name, window, task)},
+                    {"_id": task_key(feature_name, window, task), "version": definition["version"]},
+                    upsert=True
+                )
+                elapsed = time.monotonic() - started
+                progress("{index}/{total} tasks, {processed} windows, {rate:.1f} windows/s".format(
+                    index=index, total=total, processed=processed, rate=processed / elapsed if elapsed > 0 else 0.0
+                ))
+        except BaseException:
+            #Fail fast rather than waiting for every queued task, completed ones stay checkpointed
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return processed
+
+
+#List Features
+@bp.cli.command("list")
+def features_list():
+    for name, definition in FEATURES.items():
+        print("Feature: {name}\t\tVersion: {version}\t\tChannels: {channels}".format(
+            name=name, version=definition["version"],
+            channels="all" if definition["channels"] is None else ", ".join(definition["channels"])
+        ))
+
+
+#Run Feature Extraction
+@bp.cli.command("run")
+@click.argument("name")
+@click.option("--window", type=float, required=True, help="Window length in seconds")
+@click.option("--population", default=None)
+@click.option("--start", type=int, default=None, help="Start timestamp in nanoseconds since epoch")
+@click.option("--end", type=int, default=None, help="End timestamp in nanoseconds since epoch")
+@click.option("--processes", type=int, default=None)
+@click.option("--resume/--restart", default=True)
+def features_run(name, window, population, start, end, processes, resume):
+    if name not in FEATURES:
+        print("Sorry, no feature is registered with the name: {name}".format(name=name))
+        return
+    run_feature_extraction(name, int(window * 1000000000), population, start, end, processes, resume)
+    print("Complete")
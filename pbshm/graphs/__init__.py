@@ -0,0 +1 @@
+from pbshm.graphs.graphs import *
\ No newline at end of file
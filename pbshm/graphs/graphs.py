@@ -0,0 +1,260 @@
+import hashlib
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import click
+from flask import Blueprint, current_app
+from pymongo import ReplaceOne
+
+from pbshm.db import db_connect, default_collection
+
+#Create the Graphs Blueprint
+bp = Blueprint("graphs", __name__, cli_group="graphs")
+
+#Constants
+INVARIANTS_VERSION = 2
+
+
+def model_hash(model):
+    """
+    Returns a stable hash of a structure model document, used as the key of
+    its cached invariants.
+    """
+    return hashlib.sha256(json.dumps(model, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def nested_type(element, field):
+    """
+    The type of a nested element field, or "" when the field is missing or not a document.
+    """
+    value = element.get(field)
+    return value.get("type", "") if isinstance(value, dict) else ""
+
+
+def element_label(element):
+    return "element:{type}:{contextual}:{geometry}:{material}".format(
+        type=element.get("type", ""),
+        contextual=nested_type(element, "contextual"),
+        geometry=nested_type(element, "geometry"),
+        material=nested_type(element, "material")
+    )
+
+
+def model_graph(model):
+    """
+    Converts an irreducible element model into a labelled bipartite graph:
+    one node per element, one node per relationship, and an edge between a
+    relationship and each element it relates. Elements and relationships are
+    read from the model's irreducibleElement as in PBSHM Schema, or from the
+    model itself. Returns (labels, edges).
+    """
+    model = model.get("irreducibleElement", model)
+    elements = model.get("elements", [])
+    names = {element.get("name"): index for index, element in enumerate(elements)}
+    labels = [element_label(element) for element in elements]
+    edges = []
+    for relationship in model.get("relationships", []):
+        node = len(labels)
+        labels.append("relationship:{type}".format(type=relationship.get("type", "")))
+        for member in relationship.get("elements", []):
+            name = member.get("name") if isinstance(member, dict) else member
+            if name in names:
+                edges.append((names[name], node))
+    return labels, edges
+
+
+def adjacency_lists(size, edges):
+    adjacency = [set() for _ in range(size)]
+    for a, b in edges:
+        adjacency[a].add(b)
+        adjacency[b].add(a)
+    return adjacency
+
+
+def refine_colours(labels, adjacency):
+    """
+    Weisfeiler-Lehman colour refinement until the partition is stable. Colours
+    are hashes of a node's colour and the multiset of its neighbours' colours,
+    so they are independent of node order and comparable across graphs.
+    """
+    colours = [hashlib.sha1(label.encode("utf-8")).hexdigest()[:16] for label in labels]
+    classes = len(set(colours))
+    for _ in range(len(labels)):
+        colours = [
+            hashlib.sha1((colour + "|" + ",".join(sorted(colours[neighbour] for neighbour in adjacency[node]))).encode("utf-8")).hexdigest()[:16]
+            for node, colour in enumerate(colours)
+        ]
+        if len(set(colours)) == classes:
+            break
+        classes = len(set(colours))
+    return colours
+
+
+def model_invariants(model):
+    """
+    Computes the labelled graph and cheap invariants of a model: node and edge
+    type histograms, the element degree sequence and the hash of the stable
+    colour refinement. Isomorphic models always share every invariant, but
+    the refinement hash is not a canonical form: some non-isomorphic models
+    (such as regular graphs of equal degree) share it too, which is why
+    candidates sharing a key are matched exactly by isomorphic.
+    """
+    labels, edges = model_graph(model)
+    adjacency = adjacency_lists(len(labels), edges)
+    colours = refine_colours(labels, adjacency)
+    elements = [index for index, label in enumerate(labels) if label.startswith("element:")]
+    relationships = [index for index, label in enumerate(labels) if label.startswith("relationship:")]
+    return {
+        "version": INVARIANTS_VERSION,
+        "element_count": len(elements),
+        "relationship_count": len(relationships),
+        "element_types": dict(sorted(Counter(labels[index] for index in elements).items())),
+        "relationship_types": dict(sorted(Counter(labels[index] for index in relationships).items())),
+        "degree_sequence": sorted((len(adjacency[index]) for index in elements), reverse=True),
+        "colour_hash": hashlib.sha256(",".join(sorted(colours)).encode("utf-8")).hexdigest(),
+        "labels": labels,
+        "edges": [list(edge) for edge in edges],
+        "colours": colours
+    }
+
+
+def invariant_key(invariants):
+    """
+    The key under which candidate pairs are grouped; only models sharing a key
+    can be isomorphic.
+    """
+    return (invariants["colour_hash"], invariants["element_count"], invariants["relationship_count"], tuple(invariants["degree_sequence"]))
+
+
+def cached_invariants(models, collection=None):
+    """
+    Returns the invariants of each model, reading them from the invariant
+    collection by document hash and computing and storing any missing (or
+    computed by an older version) in one bulk write.
+    """
+    collection = db_connect()[current_app.config["GRAPH_INVARIANT_COLLECTION"]] if collection is None else collection
+    hashes = [model_hash(model) for model in models]
+    cached = {
+        document["_id"]: document
+        for document in collection.find({"_id": {"$in": list(set(hashes))}, "version": INVARIANTS_VERSION})
+    }
+    operations = []
+    for model, digest in zip(models, hashes):
+        if digest not in cached:
+            cached[digest] = {"_id": digest, **model_invariants(model)}
+            operations.append(ReplaceOne({"_id": digest}, cached[digest], upsert=True))
+    if len(operations) > 0:
+        collection.bulk_write(operations, ordered=False)
+    return [cached[digest] for digest in hashes]
+
+
+def isomorphic(a, b):
+    """
+    Exact isomorphism test of two model graphs given their invariants, by
+    backtracking over nodes of equal refined colour. The refinement leaves few
+    candidates per node, so this is only expensive for highly symmetric models.
+    The search keeps an explicit stack rather than recursing, so model size is
+    not bounded by the interpreter's recursion limit.
+    """
+    if invariant_key(a) != invariant_key(b) or sorted(a["colours"]) != sorted(b["colours"]):
+        return False
+    adjacency_a = adjacency_lists(len(a["labels"]), a["edges"])
+    adjacency_b = adjacency_lists(len(b["labels"]), b["edges"])
+    candidates = {}
+    for node, colour in enumerate(b["colours"]):
+        candidates.setdefault(colour, []).append(node)
+    order = sorted(range(len(a["labels"])), key=lambda node: (len(candidates[a["colours"][node]]), node))
+    mapping, used = {}, set()
+
+    def consistent(node, candidate):
+        #The matched neighbours of each node must correspond exactly
+        matched = [neighbour for neighbour in adjacency_a[node] if neighbour in mapping]
+        return all(mapping[neighbour] in adjacency_b[candidate] for neighbour in matched) and \
+            len(matched) == sum(1 for neighbour in adjacency_b[candidate] if neighbour in used)
+
+    #The index of the next candidate to try for each node matched so far
+    stack = [0]
+    while len(stack) > 0:
+        position = len(stack) - 1
+        if position == len(order):
+            return True
+        node = order[position]
+        #Undo the previous choice of this node when backtracking into it
+        if node in mapping:
+            used.discard(mapping.pop(node))
+        options, index = candidates[a["colours"][node]], stack[-1]
+        while index < len(options) and (options[index] in used or not consistent(node, options[index])):
+            index += 1
+        if index == len(options):
+            stack.pop()
+            continue
+        mapping[node] = options[index]
+        used.add(options[index])
+        stack[-1] = index + 1
+        stack.append(0)
+    return False
+
+
+def compare_group(group):
+    """
+    Splits a group of (key, invariants) sharing an invariant key into classes
+    of isomorphic models. Returns a list of lists of keys.
+    """
+    classes = []
+    for key, invariants in group:
+        for members in classes:
+            if isomorphic(members[0][1], invariants):
+                members.append((key, invariants))
+                break
+        else:
+            classes.append([(key, invariants)])
+    return [[key for key, _ in members] for members in classes]
+
+
+def population_models(population, collection=None):
+    """
+    Returns ((structure name, model name), model) pairs for every model of a population.
+    """
+    collection = default_collection() if collection is None else collection
+    models = []
+    for document in collection.find({"population": population, "models": {"$exists": True}}, {"_id": 0, "name": 1, "models": 1}):
+        for index, model in enumerate(document["models"] if isinstance(document["models"], list) else [document["models"]]):
+            models.append(((document["name"], model.get("name", str(index))), model))
+    return models
+
+
+def compare_population(population, processes=None):
+    """
+    Groups every model of a population into classes of isomorphic models. The
+    cached invariants prune candidates to models sharing an invariant key and
+    the exact matching of each group runs across a process pool. Returns the
+    classes as lists of (structure name, model name) keys, largest first.
+    """
+    models = population_models(population)
+    invariants = cached_invariants([model for _, model in models])
+    groups = {}
+    for (key, _), model_invariant in zip(models, invariants):
+        groups.setdefault(invariant_key(model_invariant), []).append((key, model_invariant))
+    singles = [[group[0][0]] for group in groups.values() if len(group) == 1]
+    candidates = [group for group in groups.values() if len(group) > 1]
+    classes = []
+    if len(candidates) > 0:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn")) as executor:
+            for group_classes in executor.map(compare_group, candidates):
+                classes.extend(group_classes)
+    return sorted(classes + singles, key=lambda members: (-len(members), members[0]))
+
+
+#Compare Population
+@bp.cli.command("compare")
+@click.argument("population")
+@click.option("--processes", type=int, default=None)
+def graphs_compare(population, processes):
+    classes = compare_population(population, processes)
+    print("{count} classes of isomorphic models in {population}".format(count=len(classes), population=population))
+    for index, members in enumerate(classes, start=1):
+        print("Class {index}: {members}".format(index=index, members=", ".join(
+            "{structure}/{model}".format(structure=structure, model=model) for structure, model in members
+        )))
@@ -0,0 +1 @@
+from pbshm.incremental.incremental import *
\ No newline at end of file
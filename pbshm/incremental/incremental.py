@@ -0,0 +1,228 @@
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import pymongo
+from flask import Blueprint, current_app
+from pymongo import ReplaceOne
+
+from pbshm.db import db_connect, default_collection, load_channel_arrays, register_index
+from pbshm.jobs import register_job_type
+
+#Create the Incremental Blueprint
+bp = Blueprint("incremental", __name__, cli_group="incremental")
+
+#Registered Computations
+COMPUTATIONS = {}
+
+#Incremental Indexes
+register_index("INCREMENTAL_COLLECTION", [
+    ("computation", pymongo.ASCENDING), ("population", pymongo.ASCENDING), ("name", pymongo.ASCENDING), ("start", pymongo.ASCENDING)
+], "pbshm_incremental_windows")
+
+
+def register_computation(name, function, window, channels=None, statistic="mean", version=1, lateness=0):
+    """
+    Registers a computation run incrementally over consecutive time windows of
+    window nanoseconds per structure. The function receives the int64
+    timestamps and a dictionary of channel arrays for one window and returns a
+    dictionary of BSON encodable results, or None to store nothing. A window
+    is only computed once the structure has data lateness nanoseconds past its
+    end; raising the version recomputes every window.
+    """
+    COMPUTATIONS[name] = {
+        "function": function, "window": int(window), "channels": channels,
+        "statistic": statistic, "version": version, "lateness": int(lateness)
+    }
+    return function
+
+
+def computation(name, window, channels=None, statistic="mean", version=1, lateness=0):
+    """
+    Decorator form of register_computation.
+    """
+    def function_decorator(function):
+        return register_computation(name, function, window, channels, statistic, version, lateness)
+    return function_decorator
+
+
+def pending_windows(watermark, first, latest, window, lateness=0):
+    """
+    Returns the starts of the complete windows after the watermark, aligned to
+    multiples of the window size. Without a watermark windows start from the
+    structure's first timestamp. A window is complete once the latest
+    timestamp is at least lateness past its end.
+    """
+    origin = watermark if watermark is not None else first - first % window
+    last = latest - lateness - window
+    if last < origin:
+        return []
+    return list(range(origin, last - (last - origin) % window + 1, window))
+
+
+def structure_latest(collection, population=None):
+    """
+    Returns the latest timestamp of every structure, optionally of one
+    population. Walking the pbshm_framework_channel index backwards lets the
+    server jump from structure to structure (DISTINCT_SCAN) instead of
+    reading every document.
+    """
+    latest = collection.aggregate([
+        {"$match": {} if population is None else {"population": population}},
+        {"$sort": {"population": -1, "name": -1, "timestamp": -1}},
+        {"$group": {"_id": {"population": "$population", "name": "$name"}, "latest": {"$first": "$timestamp"}}}
+    ])
+    return sorted(
+        [(document["_id"]["population"], document["_id"]["name"], document["latest"]) for document in latest],
+        key=lambda structure: structure[:2]
+    )
+
+
+def structure_first(collection, population, name):
+    document = collection.find_one({"population": population, "name": name}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", pymongo.ASCENDING)])
+    return document["timestamp"] if document is not None else None
+
+
+def watermark_key(computation_name, population, name):
+    return {"computation": computation_name, "population": population, "name": name}
+
+
+def read_watermarks(watermarks, computation_name, version):
+    """
+    Returns the watermark of every structure for a computation, ignoring those
+    written by a different version so its windows are recomputed.
+    """
+    return {
+        (document["_id"]["population"], document["_id"]["name"]): document["watermark"]
+        for document in watermarks.find({"_id.computation": computation_name, "version": version}, {"_id": 1, "watermark": 1})
+    }
+
+
+def compute_windows(computation_name, definition, population, name, windows, collection):
+    """
+    Loads the span of the windows once, evaluates the computation for each
+    window and returns the result documents, keyed by computation, structure
+    and window start so upserting them replaces rather than duplicates.
+    """
+    window = definition["window"]
+    timestamps, values = load_channel_arrays(
+        population, name, windows[0], windows[-1] + window,
+        definition["channels"], definition["statistic"], collection=collection
+    )
+    documents, computed = [], datetime.now(timezone.utc)
+    for window_start in windows:
+        lower, upper = np.searchsorted(timestamps, [window_start, window_start + window], side="left")
+        if upper <= lower:
+            continue
+        result = definition["function"](timestamps[lower:upper], {channel: array[lower:upper] for channel, array in values.items()})
+        if result is None:
+            continue
+        key = {"computation": computation_name, "population": population, "name": name, "start": window_start}
+        documents.append({
+            "_id": key,
+            **key,
+            "end": window_start + window,
+            "version": definition["version"],
+            "computed": computed,
+            "values": result
+        })
+    return documents
+
+
+def run_computation(computation_name, population=None, progress=print):
+    """
+    Runs a registered computation over the windows of every structure (or
+    those of one population) which completed since its watermark. Results are
+    written before the watermark advances, in batches of
+    INCREMENTAL_WINDOWS_PER_LOAD windows, so an interrupted run resumes where
+    it stopped and a rerun without new data does no work. Returns the number
+    of windows processed.
+    """
+    if computation_name not in COMPUTATIONS:
+        raise KeyError("No computation registered with name: {name}".format(name=computation_name))
+    definition = COMPUTATIONS[computation_name]
+    db = db_connect()
+    collection = default_collection()
+    results = db[current_app.config["INCREMENTAL_COLLECTION"]]
+    watermarks = db[current_app.config["INCREMENTAL_WATERMARK_COLLECTION"]]
+    current = read_watermarks(watermarks, computation_name, definition["version"])
+    windows_per_load = current_app.config["INCREMENTAL_WINDOWS_PER_LOAD"]
+    processed = 0
+    for structure_population, name, latest in structure_latest(collection, population):
+        watermark = current.get((structure_population, name))
+        #The first timestamp is only needed before the first run
+        first = structure_first(collection, structure_population, name) if watermark is None else None
+        windows = pending_windows(watermark, first, latest, definition["window"], definition["lateness"])
+        for index in range(0, len(windows), windows_per_load):
+            batch = windows[index:index + windows_per_load]
+            documents = compute_windows(computation_name, definition, structure_population, name, batch, collection)
+            if len(documents) > 0:
+                results.bulk_write([ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents], ordered=False)
+            watermarks.update_one({"_id": watermark_key(computation_name, structure_population, name)}, {"$set": {
+                "watermark": batch[-1] + definition["window"],
+                "version": definition["version"],
+                "updated": datetime.now(timezone.utc)
+            }}, upsert=True)
+            processed += len(batch)
+        if len(windows) > 0:
+            progress("{population}/{name}: {count} windows".format(population=structure_population, name=name, count=len(windows)))
+    return processed
+
+
+def reset_computation(computation_name, population=None, results=False):
+    """
+    Removes the watermarks of a computation, optionally of one population, so
+    the next run starts from the beginning. Stored results are kept and
+    replaced as windows are recomputed unless results is set.
+    """
+    db = db_connect()
+    query = {"_id.computation": computation_name}
+    if population is not None:
+        query["_id.population"] = population
+    removed = db[current_app.config["INCREMENTAL_WATERMARK_COLLECTION"]].delete_many(query).deleted_count
+    if results:
+        db[current_app.config["INCREMENTAL_COLLECTION"]].delete_many(
+            {"computation": computation_name, **({} if population is None else {"population": population})}
+        )
+    return removed
+
+
+#List Computations
+@bp.cli.command("list")
+def incremental_list():
+    watermarks = db_connect()[current_app.config["INCREMENTAL_WATERMARK_COLLECTION"]]
+    for name, definition in COMPUTATIONS.items():
+        print("Computation: {name}\t\tVersion: {version}\t\tWindow: {window}s\t\tStructures: {structures}".format(
+            name=name, version=definition["version"], window=definition["window"] / 1000000000,
+            structures=watermarks.count_documents({"_id.computation": name, "version": definition["version"]})
+        ))
+
+
+#Run Computation
+@bp.cli.command("run")
+@click.argument("name")
+@click.option("--population", default=None)
+def incremental_run(name, population):
+    if name not in COMPUTATIONS:
+        print("Sorry, no computation is registered with the name: {name}".format(name=name))
+        return
+    processed = run_computation(name, population)
+    print("Complete, {processed} windows processed".format(processed=processed))
+
+
+#Reset Computation
+@bp.cli.command("reset")
+@click.argument("name")
+@click.option("--population", default=None)
+@click.option("--results", is_flag=True, default=False, help="Also delete stored results")
+def incremental_reset(name, population, results):
+    removed = reset_computation(name, population, results)
+    print("Removed {removed} watermarks".format(removed=removed))
+
+
+#Register Background Jobs
+register_job_type(
+    "incremental.run",
+    lambda job: run_computation(job.parameters["computation"], job.parameters.get("population"), progress=lambda message: None),
+    concurrency=1
+)
@@ -1,20 +1,96 @@
+import csv
 import json
+from concurrent.futures import ProcessPoolExecutor
 from os import urandom, makedirs
-from os.path import isdir, join, dirname
+from os.path import isdir, join, dirname, splitext
 
 import click
-import pymongo
 from flask import Blueprint, current_app
+from pymongo.errors import BulkWriteError
 from urllib.parse import quote_plus
 from werkzeug.security import generate_password_hash
 
-from pbshm.db import db_connect
+from pbshm.db import db_connect, sync_indexes, report_index_usage
 from pbshm.mechanic import create_new_structure_collection
 
+#Constants
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+PASSWORD_SALT_LENGTH = 128
+DUPLICATE_KEY_ERROR = 11000
+
 #Create the Initialisation Blueprint
 bp = Blueprint("initialisation", __name__, cli_group="init")
 bp.cli.chain = True
 
+
+def hash_password(password):
+    """
+    Hashes a password with the method used for every user account.
+    """
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD, salt_length=PASSWORD_SALT_LENGTH)
+
+
+def load_user_schema():
+    with open(join(dirname(__file__), "user-schema.json"), "r") as file:
+        return json.load(file)
+
+
+def validate_document(schema, document, path=""):
+    """
+    Validates a document locally against the subset of $jsonSchema used by
+    user-schema.json (bsonType, required, properties, length, items and
+    uniqueness). Returns a list of error messages, empty when valid.
+    """
+    errors = []
+    bson_types = {"object": dict, "string": str, "array": list, "bool": bool}
+    expected = schema.get("bsonType")
+    if expected in bson_types and not isinstance(document, bson_types[expected]):
+        return ["{path} must be of type {expected}".format(path=path or "document", expected=expected)]
+    if expected == "object":
+        for field in schema.get("required", []):
+            if field not in document:
+                errors.append("{field} is required".format(field=path + field))
+        for field, field_schema in schema.get("properties", {}).items():
+            if field in document:
+                errors.extend(validate_document(field_schema, document[field], path + field))
+    elif expected == "string":
+        if len(document) < schema.get("minLength", 0):
+            errors.append("{path} must be at least {length} characters".format(path=path, length=schema["minLength"]))
+        if "maxLength" in schema and len(document) > schema["maxLength"]:
+            errors.append("{path} must be at most {length} characters".format(path=path, length=schema["maxLength"]))
+    elif expected == "array":
+        if len(document) < schema.get("minItems", 0):
+            errors.append("{path} must have at least {count} items".format(path=path, count=schema["minItems"]))
+        if schema.get("uniqueItems") and len(set(map(str, document))) != len(document):
+            errors.append("{path} must not contain duplicate items".format(path=path))
+        for index, item in enumerate(document):
+            errors.extend(validate_document(schema.get("items", {}), item, "{path}[{index}]".format(path=path, index=index)))
+    return errors
+
+
+def read_user_rows(path, file_format=None):
+    """
+    Reads user rows from a CSV file (with emailAddress, password, firstName,
+    secondName and optional permissions separated by ';' and enabled columns)
+    or a JSON array of user objects.
+    """
+    file_format = file_format if file_format is not None else splitext(path)[1].lstrip(".").lower()
+    with open(path, "r", newline="") as file:
+        if file_format == "json":
+            rows = json.load(file)
+        elif file_format == "csv":
+            rows = []
+            for row in csv.DictReader(file):
+                row = {key: value for key, value in row.items() if value is not None and value != ""}
+                if "permissions" in row:
+                    row["permissions"] = [permission.strip() for permission in row["permissions"].split(";") if permission.strip()]
+                if "enabled" in row:
+                    row["enabled"] = row["enabled"].strip().lower() in ["true", "1", "yes", "y"]
+                rows.append(row)
+        else:
+            raise click.BadParameter("Unsupported user file format: {file_format}".format(file_format=file_format))
+    return [{"permissions": [], "enabled": True, **row} for row in rows]
+
 #Initialise Sub System: Config
 @bp.cli.command("config")
 @click.option("--hostname", prompt="Hostname", default="localhost")
@@ -60,9 +136,19 @@ def initialise_sub_system_db():
     db.create_collection(current_app.config["USER_COLLECTION"], validator={
         "$jsonSchema": schema
     })
-    db[current_app.config["USER_COLLECTION"]].create_index(
-        [("emailAddress", pymongo.ASCENDING)], unique=True
-    )
+    sync_indexes(["USER_COLLECTION"])
+
+#Initialise Sub System: Indexes
+@bp.cli.command("indexes")
+def initialise_sub_system_indexes():
+    #Create Missing Indexes and Report Drift
+    sync_indexes()
+
+#Initialise Sub System: Index Usage
+@bp.cli.command("index-usage")
+def initialise_sub_system_index_usage():
+    #Report Unused and Redundant Indexes
+    report_index_usage()
 
 #Initialise Sub System: New Root User
 @bp.cli.command("new-root-user")
@@ -75,9 +161,53 @@ def initialise_sub_system_new_root_user(email_address, password, first_name, sec
     db = db_connect()
     db[current_app.config["USER_COLLECTION"]].insert_one({
         "emailAddress": email_address,
-        "password": generate_password_hash(password, method="scrypt:32768:8:1", salt_length=128),
+        "password": hash_password(password),
         "firstName": first_name,
         "secondName": second_name,
         "permissions": ["root"],
         "enabled": True
     })
+
+#Initialise Sub System: Import Users
+@bp.cli.command("import-users")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "json"]), default=None)
+@click.option("--processes", type=int, default=None)
+@click.option("--batch-size", type=int, default=500)
+def initialise_sub_system_import_users(path, file_format, processes, batch_size):
+    #Validate Rows Locally
+    schema = load_user_schema()
+    fields = set(schema["properties"].keys())
+    valid, seen = [], set()
+    for number, row in enumerate(read_user_rows(path, file_format), start=1):
+        document = {key: value for key, value in row.items() if key in fields}
+        errors = validate_document(schema, document)
+        if document.get("emailAddress") in seen:
+            errors.append("emailAddress duplicates an earlier row")
+        if len(errors) > 0:
+            print("Row {number}: invalid, {errors}".format(number=number, errors="; ".join(errors)))
+            continue
+        seen.add(document["emailAddress"])
+        valid.append((number, document))
+    #Hash Passwords across a Process Pool
+    print("Hashing {count} passwords".format(count=len(valid)))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        hashes = executor.map(hash_password, [document["password"] for _, document in valid], chunksize=8)
+        for (_, document), password_hash in zip(valid, hashes):
+            document["password"] = password_hash
+    #Write Unordered Bulk Batches
+    users = db_connect()[current_app.config["USER_COLLECTION"]]
+    inserted = 0
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        try:
+            inserted += len(users.insert_many([document for _, document in batch], ordered=False).inserted_ids)
+        except BulkWriteError as error:
+            inserted += error.details["nInserted"]
+            for write_error in error.details["writeErrors"]:
+                number, document = batch[write_error["index"]]
+                if write_error["code"] == DUPLICATE_KEY_ERROR:
+                    print("Row {number}: duplicate, {email} already exists".format(number=number, email=document["emailAddress"]))
+                else:
+                    print("Row {number}: rejected, {message}".format(number=number, message=write_error["errmsg"]))
+    print("Imported {inserted} of {total} users".format(inserted=inserted, total=len(valid)))
@@ -0,0 +1 @@
+from pbshm.jobs.jobs import *
\ No newline at end of file
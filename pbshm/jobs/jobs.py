@@ -0,0 +1,311 @@
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+import bson
+import click
+import pymongo
+from bson import ObjectId, json_util
+from bson.errors import InvalidDocument, InvalidId
+from bson.json_util import RELAXED_JSON_OPTIONS
+from flask import Blueprint, abort, current_app, g, jsonify
+from pymongo import ReturnDocument
+
+from pbshm.authentication import authenticate_request
+from pbshm.db import db_connect, register_index, sync_indexes, user_document
+
+#Create the Jobs Blueprint
+bp = Blueprint("jobs", __name__, cli_group="jobs")
+
+#Registered Job Types
+JOB_TYPES = {}
+workers_lock = threading.Lock()
+
+
+def register_job_type(name, function, retries=0, concurrency=None):
+    """
+    Registers a job type. The function receives a JobContext and returns a
+    BSON encodable result. Failed jobs are retried up to retries times and at
+    most concurrency jobs of the type run at once across all workers.
+    """
+    JOB_TYPES[name] = {"function": function, "retries": retries, "concurrency": concurrency}
+    return function
+
+
+def job_type(name, retries=0, concurrency=None):
+    """
+    Decorator form of register_job_type.
+    """
+    def function_decorator(function):
+        return register_job_type(name, function, retries, concurrency)
+    return function_decorator
+
+
+#Jobs Indexes
+register_index("JOBS_COLLECTION", [
+    ("status", pymongo.ASCENDING), ("type", pymongo.ASCENDING), ("created", pymongo.ASCENDING)
+], "pbshm_jobs_queue")
+
+
+#Jobs Collection
+def jobs_collection():
+    if "jobs_collection" not in g:
+        g.jobs_collection = db_connect()[current_app.config["JOBS_COLLECTION"]]
+    return g.jobs_collection
+
+
+def enqueue_job(name, parameters=None):
+    """
+    Persists a job for a registered type and returns its id immediately.
+    """
+    if name not in JOB_TYPES:
+        raise KeyError("No job type registered with name: {name}".format(name=name))
+    now = datetime.now(timezone.utc)
+    result = jobs_collection().insert_one({
+        "type": name,
+        "parameters": parameters if parameters is not None else {},
+        "status": "queued",
+        "attempts": 0,
+        "progress": 0.0,
+        "message": None,
+        "result": None,
+        "error": None,
+        "user": g.user["_id"] if g.get("user") is not None else None,
+        "created": now,
+        "updated": now
+    })
+    if current_app.config["JOBS_IN_PROCESS_WORKERS"] > 0:
+        start_in_process_workers(current_app._get_current_object())
+    return str(result.inserted_id)
+
+
+class JobContext:
+    """
+    Handed to job functions: exposes the parameters and progress reporting.
+    """
+    def __init__(self, collection, job, ownership=None):
+        self.collection = collection
+        self.id = job["_id"]
+        self.parameters = job["parameters"]
+        self.attempt = job["attempts"]
+        self.ownership = ownership if ownership is not None else {"_id": self.id}
+
+    def progress(self, fraction, message=None):
+        self.collection.update_one(
+            self.ownership,
+            {"$set": {"progress": float(fraction), "message": message, "updated": datetime.now(timezone.utc)}}
+        )
+
+
+class JobWorker:
+    """
+    Runs queued jobs on a number of threads, each within its own app context.
+    """
+    def __init__(self, app, threads=1, types=None):
+        self.app = app
+        self.threads = threads
+        self.types = types
+        self.name = "{host}:{pid}".format(host=socket.gethostname(), pid=os.getpid())
+        self.stopping = threading.Event()
+        self.workers = []
+
+    def start(self):
+        with self.app.app_context():
+            sync_indexes(["JOBS_COLLECTION"], report=self.app.logger.info)
+        for index in range(self.threads):
+            worker = threading.Thread(target=self.run, name=f"pbshm-jobs-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        self.stopping.set()
+        for worker in self.workers:
+            worker.join()
+
+    def claim(self, collection):
+        """
+        Atomically claims the oldest queued (or stale running) job whose type
+        has not reached its concurrency limit.
+        """
+        now = datetime.now(timezone.utc)
+        stale = now - timedelta(seconds=self.app.config["JOBS_STALE_SECONDS"])
+        available = []
+        for name, definition in JOB_TYPES.items():
+            if self.types is not None and name not in self.types:
+                continue
+            if definition["concurrency"] is not None and collection.count_documents(
+                {"type": name, "status": "running", "updated": {"$gte": stale}}
+            ) >= definition["concurrency"]:
+                continue
+            available.append(name)
+        if len(available) == 0:
+            return None
+        job = collection.find_one_and_update(
+            {"type": {"$in": available}, "$or": [
+                {"status": "queued"},
+                {"status": "running", "updated": {"$lt": stale}}
+            ]},
+            {"$set": {"status": "running", "worker": self.name, "started": now, "updated": now}, "$inc": {"attempts": 1}},
+            sort=[("created", pymongo.ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None or not self.within_concurrency(collection, job, stale):
+            return None
+        return job
+
+    def within_concurrency(self, collection, job, stale):
+        """
+        The count before claiming only avoids needless claims: workers racing
+        past it each claim a job. Every claimant ranks the running jobs of the
+        type by start, so they agree on which keep running, and jobs ranked
+        past the limit are handed back to the queue.
+        """
+        concurrency = JOB_TYPES[job["type"]]["concurrency"]
+        if concurrency is None:
+            return True
+        running = [document["_id"] for document in collection.find(
+            {"type": job["type"], "status": "running", "updated": {"$gte": stale}}, {"_id": 1}
+        ).sort([("started", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]).limit(concurrency)]
+        if job["_id"] in running:
+            return True
+        collection.update_one(
+            {"_id": job["_id"], "worker": self.name, "status": "running"},
+            {"$set": {"status": "queued", "worker": None, "started": None}, "$inc": {"attempts": -1}}
+        )
+        return False
+
+    def heartbeat(self, collection, job, done):
+        """
+        Keeps a running job from being considered stale until it finishes.
+        """
+        while not done.wait(self.app.config["JOBS_STALE_SECONDS"] / 3):
+            collection.update_one(self.ownership(job), {"$set": {"updated": datetime.now(timezone.utc)}})
+
+    def ownership(self, job):
+        """
+        Matches the job only while this worker holds the attempt it claimed,
+        so a worker whose job went stale and was reclaimed cannot overwrite
+        the new owner's progress, status or result.
+        """
+        return {"_id": job["_id"], "worker": self.name, "attempts": job["attempts"]}
+
+    def execute(self, collection, job):
+        """
+        Runs a claimed job and stores its outcome. Returns False when the job
+        was reclaimed by another worker meanwhile, leaving its outcome alone.
+        """
+        definition = JOB_TYPES[job["type"]]
+        done = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(collection, job, done), daemon=True).start()
+        try:
+            result = definition["function"](JobContext(collection, job, self.ownership(job)))
+            try:
+                bson.encode({"result": result})
+                update = {"status": "complete", "progress": 1.0, "result": result, "error": None}
+            except (InvalidDocument, OverflowError) as error:
+                update = {"status": "failed", "error": "Job result cannot be stored: {error}".format(error=error)}
+        except Exception:
+            retry = job["attempts"] <= definition["retries"]
+            update = {"status": "queued" if retry else "failed", "error": traceback.format_exc()}
+        finally:
+            done.set()
+        update["updated"] = datetime.now(timezone.utc)
+        if collection.update_one(self.ownership(job), {"$set": update}).matched_count == 0:
+            self.app.logger.warning("Job %s was reclaimed from worker %s, discarding its outcome", job["_id"], self.name)
+            return False
+        return True
+
+    def run(self):
+        with self.app.app_context():
+            collection = jobs_collection()
+            while not self.stopping.is_set():
+                #Keep the thread alive through database errors, a job left running is reclaimed once stale
+                try:
+                    job = self.claim(collection)
+                    if job is None:
+                        self.stopping.wait(self.app.config["JOBS_POLL_INTERVAL"])
+                        continue
+                    self.execute(collection, job)
+                except Exception:
+                    self.app.logger.exception("Job worker %s failed, continuing", self.name)
+                    self.stopping.wait(self.app.config["JOBS_POLL_INTERVAL"])
+
+
+def start_in_process_workers(app):
+    """
+    Starts the in-process worker threads for the app, once.
+    """
+    if "pbshm_jobs_worker" not in app.extensions:
+        with workers_lock:
+            if "pbshm_jobs_worker" not in app.extensions:
+                worker = JobWorker(app, app.config["JOBS_IN_PROCESS_WORKERS"])
+                app.extensions["pbshm_jobs_worker"] = worker
+                worker.start()
+    return app.extensions["pbshm_jobs_worker"]
+
+
+def find_job(job_id, projection):
+    """
+    Returns the job if it was enqueued by the current user, or for root users
+    any job, otherwise responds 404.
+    """
+    try:
+        job = jobs_collection().find_one({"_id": ObjectId(job_id)}, projection)
+    except InvalidId:
+        abort(404)
+    if job is None:
+        abort(404)
+    if job.get("user") != g.user["_id"] and "root" not in (user_document(g.user["_id"]) or {}).get("permissions", []):
+        abort(404)
+    return job
+
+
+#Status View
+@bp.route("/<job_id>")
+@authenticate_request("jobs-view")
+def status(job_id):
+    job = find_job(job_id, {"result": 0, "parameters": 0})
+    return jsonify({
+        "id": str(job["_id"]),
+        "type": job["type"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "progress": job["progress"],
+        "message": job["message"],
+        "error": job["error"],
+        "created": job["created"].isoformat(),
+        "updated": job["updated"].isoformat()
+    })
+
+
+#Result View
+@bp.route("/<job_id>/result")
+@authenticate_request("jobs-view")
+def result(job_id):
+    job = find_job(job_id, {"status": 1, "result": 1, "user": 1})
+    if job["status"] != "complete":
+        return jsonify({"id": job_id, "status": job["status"]}), 409
+    #Results routinely hold BSON types such as ObjectId and datetime
+    return current_app.response_class(
+        json_util.dumps({"id": job_id, "status": job["status"], "result": job["result"]}, json_options=RELAXED_JSON_OPTIONS),
+        mimetype="application/json"
+    )
+
+
+#Run Worker
+@bp.cli.command("worker")
+@click.option("--threads", type=int, default=1)
+@click.option("--types", default=None, help="Comma separated job types to run, defaults to all")
+def jobs_worker(threads, types):
+    worker = JobWorker(current_app._get_current_object(), threads, types.split(",") if types else None)
+    worker.start()
+    print("Worker {name} running {threads} threads, press Ctrl+C to stop".format(name=worker.name, threads=threads))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping worker")
+        worker.stop()
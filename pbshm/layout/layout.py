@@ -1,7 +1,9 @@
 from flask import Blueprint, g, render_template, jsonify, current_app
 
+from pbshm.admission import admission_control
 from pbshm.authentication import authenticate_request
-from pbshm.db import default_collection
+from pbshm.db import Pipeline, default_collection, collection_data_version, read_profile_options
+from pbshm.response import conditional_response
 
 # Create the layout Blueprint
 bp = Blueprint(
@@ -43,23 +45,16 @@ def home():
 
 @bp.route("/diagnostics")
 @authenticate_request("layout-diagnostics")
+@conditional_response(lambda: collection_data_version(default_collection(current_app.config["DIAGNOSTICS_READ_PROFILE"])))
+@admission_control(concurrency=2, rate=1.0, burst=5)
 def diagnostics():
+    profile = current_app.config["DIAGNOSTICS_READ_PROFILE"]
     populations = {}
-    for document in default_collection().aggregate([
-        {"$project":{
-            "_id":1,
-            "name":1,
-            "population":1
-        }},
-        {"$group":{
-            "_id":"$population",
-            "structures":{"$addToSet":"$name"}
-        }},
-        {"$project":{
-            "_id":0,
-            "population":"$_id",
-            "structures":1
-        }}
-    ]):
+    for document in (
+        Pipeline()
+        .group("$population", structures={"$addToSet":"$name"})
+        .project({"_id":0, "population":"$_id", "structures":1})
+        .aggregate(default_collection(profile), cache="diagnostics", version=g.data_version, **read_profile_options(profile))
+    ):
         populations[document["population"]] = document["structures"]
     return jsonify({"status":f"Total populations found {len(populations)}, with a total of {sum([len(populations[population]) for population in populations])} unique structures", "details":populations})
@@ -0,0 +1 @@
+from pbshm.live.live import *
\ No newline at end of file
@@ -0,0 +1,220 @@
+import queue
+import threading
+import time
+
+from bson import json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+import pymongo
+from flask import Blueprint, Response, current_app, request, stream_with_context
+from pymongo.errors import OperationFailure, PyMongoError
+
+from pbshm.authentication import authenticate_request
+from pbshm.db import db_connect, register_index
+
+#Create the Live Blueprint
+bp = Blueprint("live", __name__)
+
+#Active Watchers
+watchers = {}
+watchers_lock = threading.Lock()
+
+#Errors meaning the deployment cannot run change streams: not a replica set, unknown $changeStream stage, command not supported
+CHANGE_STREAM_UNSUPPORTED = {40573, 40324, 115}
+
+#Live Indexes, serving the polling watcher's timestamp range
+register_index("DEFAULT_COLLECTION", [("timestamp", pymongo.ASCENDING)], "pbshm_live_timestamp")
+
+
+class Subscriber:
+    """
+    A single client of a watcher with a bounded queue. When the client falls
+    behind the oldest pending document is dropped rather than blocking the watcher.
+    """
+    def __init__(self, population=None, structure=None, channels=None, maxsize=100):
+        self.population = population
+        self.structure = structure
+        self.channels = set(channels) if channels else None
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def filter(self, document):
+        """
+        Returns the document reduced to the subscribed channels, or None when
+        it does not match the subscription.
+        """
+        if self.population is not None and document.get("population") != self.population:
+            return None
+        if self.structure is not None and document.get("name") != self.structure:
+            return None
+        if self.channels is not None:
+            channels = [channel for channel in document.get("channels", []) if channel.get("name") in self.channels]
+            if len(channels) == 0:
+                return None
+            document = {**document, "channels": channels}
+        return document
+
+    def publish(self, document):
+        document = self.filter(document)
+        if document is None:
+            return
+        while True:
+            try:
+                self.queue.put_nowait(document)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+class CollectionWatcher:
+    """
+    One database watcher per collection, shared by every subscriber. Uses a
+    change stream where available and falls back to polling structure
+    timestamps when the deployment cannot run change streams. Stops once it
+    has no subscribers.
+    """
+    def __init__(self, app, collection):
+        self.app = app
+        self.collection = collection
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name=f"pbshm-live-{collection}", daemon=True)
+
+    def subscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def active(self):
+        with watchers_lock, self.lock:
+            if len(self.subscribers) == 0:
+                if watchers.get(self.collection) is self:
+                    del watchers[self.collection]
+                return False
+            return True
+
+    def publish(self, document):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.publish(document)
+
+    def watch(self, collection):
+        """
+        Publishes inserts from a change stream. Raises OperationFailure when
+        change streams are not supported by the deployment.
+        """
+        with collection.watch([{"$match": {"operationType": "insert"}}], max_await_time_ms=1000) as stream:
+            while self.active():
+                change = stream.try_next()
+                if change is not None:
+                    self.publish(change["fullDocument"])
+
+    def poll(self, collection):
+        """
+        Publishes documents whose structure timestamp is at or after the
+        latest seen less LIVE_POLL_OVERLAP seconds, so documents inserted out
+        of order within the overlap are still published. Documents already
+        published within the overlap are skipped by _id.
+        """
+        overlap = int(self.app.config["LIVE_POLL_OVERLAP"] * 1000000000)
+        latest = collection.find_one({}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", pymongo.DESCENDING)])
+        since = latest["timestamp"] if latest is not None else None
+        #Documents present when polling starts are not new
+        seen = {} if since is None else {
+            document["_id"]: document["timestamp"]
+            for document in collection.find({"timestamp": {"$gte": since - overlap}}, {"_id": 1, "timestamp": 1})
+        }
+        while self.active():
+            for document in collection.find({} if since is None else {"timestamp": {"$gte": since - overlap}}).sort("timestamp", pymongo.ASCENDING):
+                if document["_id"] in seen:
+                    continue
+                seen[document["_id"]] = document["timestamp"]
+                since = document["timestamp"] if since is None else max(since, document["timestamp"])
+                self.publish(document)
+            if since is not None:
+                seen = {document_id: timestamp for document_id, timestamp in seen.items() if timestamp >= since - overlap}
+            time.sleep(self.app.config["LIVE_POLL_INTERVAL"])
+
+    def run(self):
+        with self.app.app_context():
+            collection = db_connect()[self.collection]
+            use_change_stream = self.app.config["LIVE_CHANGE_STREAMS"]
+            while self.active():
+                try:
+                    if use_change_stream:
+                        self.watch(collection)
+                    else:
+                        self.poll(collection)
+                except OperationFailure as error:
+                    if use_change_stream and error.code in CHANGE_STREAM_UNSUPPORTED:
+                        use_change_stream = False
+                        continue
+                    self.app.logger.exception("Live feed watcher for %s failed, reconnecting", self.collection)
+                    time.sleep(self.app.config["LIVE_POLL_INTERVAL"])
+                except PyMongoError:
+                    self.app.logger.exception("Live feed watcher for %s failed, reconnecting", self.collection)
+                    time.sleep(self.app.config["LIVE_POLL_INTERVAL"])
+
+
+def subscribe(collection, subscriber):
+    """
+    Attaches a subscriber to the shared watcher of a collection, starting the
+    watcher if none is running.
+    """
+    app = current_app._get_current_object()
+    with watchers_lock:
+        watcher = watchers.get(collection)
+        if watcher is None:
+            watcher = CollectionWatcher(app, collection)
+            watchers[collection] = watcher
+            watcher.subscribe(subscriber)
+            watcher.thread.start()
+        else:
+            watcher.subscribe(subscriber)
+    return watcher
+
+
+def event_stream(watcher, subscriber, heartbeat):
+    """
+    Yields server-sent events for the subscriber until the client disconnects.
+    """
+    try:
+        while True:
+            try:
+                document = subscriber.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield "id: {id}\ndata: {data}\n\n".format(
+                id=document.get("_id", ""),
+                data=json_util.dumps(document, json_options=RELAXED_JSON_OPTIONS)
+            )
+    finally:
+        watcher.unsubscribe(subscriber)
+
+
+#Feed View
+@bp.route("/feed")
+@authenticate_request("live-feed")
+def feed():
+    subscriber = Subscriber(
+        request.args.get("population"),
+        request.args.get("structure"),
+        request.args.getlist("channel"),
+        current_app.config["LIVE_QUEUE_SIZE"]
+    )
+    watcher = subscribe(current_app.config["DEFAULT_COLLECTION"], subscriber)
+    response = Response(
+        stream_with_context(event_stream(watcher, subscriber, current_app.config["LIVE_HEARTBEAT"])),
+        mimetype="text/event-stream"
+    )
+    response.cache_control.no_cache = True
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
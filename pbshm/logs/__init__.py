@@ -0,0 +1 @@
+from pbshm.logs.logs import *
\ No newline at end of file
@@ -0,0 +1,178 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from os.path import join
+
+from flask import Blueprint, current_app, g, request, request_started
+from flask.logging import default_handler
+
+#Create the Logs Blueprint
+bp = Blueprint("logs", __name__)
+
+#Access Logger
+access_logger = logging.getLogger("pbshm.access")
+
+#Queue Handlers, stopped once at exit and reset in forked children
+queue_handlers = weakref.WeakSet()
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as single line JSON objects, including any structured
+    fields passed through extra={"fields": {...}}.
+    """
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the background listener without ever blocking the
+    caller. Records are dropped and counted when the queue is full. The
+    listener thread starts with the first record in each process, so workers
+    forked from a preloaded app drain their own queue.
+    """
+    def __init__(self, log_queue, listener):
+        super().__init__(log_queue)
+        self.listener = listener
+        self.dropped = 0
+        self.pid = None
+        self.listener_lock = threading.Lock()
+        queue_handlers.add(self)
+
+    def start_listener(self):
+        with self.listener_lock:
+            if self.pid != os.getpid():
+                self.listener.start()
+                self.pid = os.getpid()
+
+    def stop_listener(self):
+        with self.listener_lock:
+            if self.pid == os.getpid():
+                self.listener.stop()
+            self.pid = None
+
+    def reset_after_fork(self):
+        """
+        Replaces the queue and lock inherited from the parent, as its listener
+        thread does not survive the fork.
+        """
+        self.queue = self.listener.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.listener._thread = None
+        self.listener_lock = threading.Lock()
+        self.pid = None
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def stop_listeners():
+    for handler in list(queue_handlers):
+        handler.stop_listener()
+
+
+def reset_listeners():
+    for handler in list(queue_handlers):
+        handler.reset_after_fork()
+
+
+atexit.register(stop_listeners)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_listeners)
+
+
+def create_log_handlers(app):
+    """
+    Returns the handlers run on the listener thread: stderr, and a file in the
+    instance folder when LOG_FILENAME is set.
+    """
+    formatter = JSONFormatter() if app.config["LOG_JSON"] else logging.Formatter("[%(asctime)s] %(levelname)s in %(name)s: %(message)s")
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if app.config["LOG_FILENAME"] is not None:
+        handlers.append(logging.FileHandler(join(app.instance_path, app.config["LOG_FILENAME"])))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def configure_logging(app):
+    """
+    Routes the app and access loggers through a bounded queue drained by a
+    background listener thread, so slow log destinations never add latency
+    to requests. Replaces the handler of any previously created app, whose
+    listener is stopped once although both loggers share it.
+    """
+    log_queue = queue.Queue(maxsize=app.config["LOG_QUEUE_SIZE"])
+    listener = QueueListener(log_queue, *create_log_handlers(app), respect_handler_level=True)
+    handler = NonBlockingQueueHandler(log_queue, listener)
+    loggers = (app.logger, access_logger)
+    existing = {existing for logger in loggers for existing in logger.handlers if isinstance(existing, NonBlockingQueueHandler)}
+    for logger in loggers:
+        for previous in existing:
+            logger.removeHandler(previous)
+        logger.removeHandler(default_handler)
+        logger.addHandler(handler)
+        logger.setLevel(app.config["LOG_LEVEL"])
+    for previous in existing:
+        previous.stop_listener()
+    access_logger.propagate = False
+    app.extensions["pbshm_logging"] = handler
+    return handler
+
+
+@bp.record_once
+def register_logging(state):
+    configure_logging(state.app)
+    request_started.connect(start_request_timer, state.app)
+
+
+def start_request_timer(sender, **extra):
+    g.request_started = time.perf_counter()
+
+
+def sampled(response):
+    """
+    Server errors are always logged; other requests at LOG_ACCESS_SAMPLE_RATE.
+    """
+    return response.status_code >= 500 or random.random() < current_app.config["LOG_ACCESS_SAMPLE_RATE"]
+
+
+#Access Log
+@bp.after_app_request
+def log_access(response):
+    if not current_app.config["LOG_ACCESS"] or "request_started" not in g or not sampled(response):
+        return response
+    counter = g.get("query_counter")
+    access_logger.info("%s %s %d", request.method, request.path, response.status_code, extra={"fields": {
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "duration_ms": round((time.perf_counter() - g.request_started) * 1000, 3),
+        "user": g.user["_id"] if g.get("user") is not None else None,
+        "queries": counter.total if counter is not None else None
+    }})
+    return response
@@ -1 +1,2 @@
-from pbshm.mechanic.mechanic import *
\ No newline at end of file
+from pbshm.mechanic.mechanic import *
+from pbshm.mechanic.upgrade import *
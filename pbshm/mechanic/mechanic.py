@@ -2,11 +2,12 @@ import json
 from datetime import datetime
 
 import click
-import pymongo
 from flask import Blueprint
 from urllib.request import urlopen
 
-from pbshm.db import db_connect
+from pbshm.db import create_declared_indexes, db_connect
+from pbshm.jobs import register_job_type
+from pbshm.mechanic.upgrade import apply_schema, copy_collection, validate_collection
 
 #Constants
 REPO_OWNER = "dynamics-research-group"
@@ -40,8 +41,12 @@ def mechanic_available_versions():
 def mechanic_new_collection(version, collection):
     create_new_structure_collection(collection, version)
 
-#Create New Structure Collection
-def create_new_structure_collection(collection, version="latest"):
+#Download Schema
+def download_schema(version="latest"):
+    """
+    Downloads the compiled MongoDB $jsonSchema for a PBSHM Schema release,
+    returning None when the release or its asset cannot be found.
+    """
     #Retrieve Asset List
     print("Retrieving list of assets for {version}".format(version=version))
     download_url = ""
@@ -59,27 +64,87 @@ def create_new_structure_collection(collection, version="latest"):
     #Ensure Download URL
     if download_url == "":
         print("Sorry, we were unable to find the correct asset for version: {version}".format(version=version))
-        return
+        return None
     #Download Schema
     print("Downloading {version} schema from {url}".format(version=version, url=download_url))
     with urlopen(download_url) as response:
         if response.getcode() != 200:
             print("An error occured while trying to download the PBSHM Schema version: {version}".format(version=version))
+            return None
+        raw = response.read()
+        return json.loads(raw.decode("utf-8"))
+
+#Install Structure Collection
+def install_structure_collection(collection, schema):
+    #Create Collection
+    db = db_connect()
+    db.create_collection(collection, validator={
+        "$jsonSchema": schema
+    })
+    #Create Indexes
+    print("Creating default indexes")
+    create_declared_indexes("DEFAULT_COLLECTION", collection)
+
+#Create New Structure Collection
+def create_new_structure_collection(collection, version="latest"):
+    """
+    Downloads and installs a schema version into a new collection. Returns
+    whether the collection was installed.
+    """
+    schema = download_schema(version)
+    if schema is not None:
+        print("Installing {version} into {collection}".format(version=version, collection=collection))
+        install_structure_collection(collection, schema)
+    print("Complete")
+    return schema is not None
+
+#New Structure Collection Job
+def new_structure_collection_job(job):
+    collection, version = job.parameters["collection"], job.parameters.get("version", "latest")
+    if not create_new_structure_collection(collection, version):
+        raise RuntimeError("Unable to download version: {version} of the PBSHM Schema".format(version=version))
+    return collection
+
+#Upgrade Structure Collection
+@bp.cli.command("upgrade")
+@click.argument("collection")
+@click.option("--version", default="latest")
+@click.option("--target", default=None, help="Copy the documents into this new collection instead of upgrading in place")
+@click.option("--transform", "transform_name", default=None, help="Registered transform applied to each document copied")
+@click.option("--validation-level", type=click.Choice(["moderate", "strict"]), default="moderate")
+@click.option("--partitions", type=int, default=None)
+@click.option("--processes", type=int, default=None)
+@click.option("--batch-size", type=int, default=None)
+@click.option("--resume/--restart", default=True)
+def mechanic_upgrade(collection, version, target, transform_name, validation_level, partitions, processes, batch_size, resume):
+    schema = download_schema(version)
+    if schema is None:
+        return
+    db = db_connect()
+    if target is None:
+        #Upgrade in Place
+        print("Applying {version} to {collection}".format(version=version, collection=collection))
+        apply_schema(collection, schema, validation_level)
+        documents, invalid, failing = validate_collection(collection, schema, partitions, processes)
+        print("{invalid} of {documents} documents do not satisfy {version}".format(invalid=invalid, documents=documents, version=version))
+        for identifier in failing:
+            print("Invalid document: {id}".format(id=identifier))
+    else:
+        #Copy into a New Collection
+        if target in db.list_collection_names():
+            apply_schema(target, schema, validation_level)
         else:
-            raw = response.read()
-            schema = json.loads(raw.decode("utf-8"))
-            print("Installing {version} into {collection}".format(version=version, collection=collection))
-            #Create Collection
-            db = db_connect()
-            db.create_collection(collection, validator={
-                "$jsonSchema": schema
-            })
-            #Create Indexes
-            print("Creating default indexes")
-            db[collection].create_index([
-                ("population", pymongo.ASCENDING),
-                ("name", pymongo.ASCENDING),
-                ("timestamp", pymongo.ASCENDING),
-                ("channels.name", pymongo.ASCENDING)
-            ], name="pbshm_framework_channel", unique=True)
+            print("Installing {version} into {collection}".format(version=version, collection=target))
+            install_structure_collection(target, schema)
+        copied, rejected, failing = copy_collection(collection, target, transform_name, partitions, processes, batch_size, resume)
+        print("Copied {copied} documents, {rejected} rejected by {version}".format(copied=copied, rejected=rejected, version=version))
+        for identifier, message in failing:
+            print("Rejected document {id}: {message}".format(id=identifier, message=message))
     print("Complete")
+
+#Register Background Jobs
+register_job_type(
+    "mechanic.new-structure-collection",
+    new_structure_collection_job,
+    concurrency=1
+)
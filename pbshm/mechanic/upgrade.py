@@ -0,0 +1,286 @@
+import time
+from concurrent.futures import as_completed
+
+from flask import current_app
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from pbshm.db import db_connect, worker_collections, worker_pool
+
+#Registered Transforms
+TRANSFORMS = {}
+
+
+def register_transform(name, function):
+    """
+    Registers a document transform for copying a structure collection into a
+    new schema version. The function receives one document and returns the
+    upgraded document, or None to leave it out of the new collection. It must be
+    defined at module level so worker processes can import it.
+    """
+    TRANSFORMS[name] = function
+    return function
+
+
+def transform(name):
+    """
+    Decorator form of register_transform.
+    """
+    def function_decorator(function):
+        return register_transform(name, function)
+    return function_decorator
+
+
+def id_partitions(collection, partitions):
+    """
+    Splits a collection into _id ranges of roughly equal size using a random
+    sample of ids, so the collection is never scanned to plan the work.
+    Returns the inner boundaries; n boundaries describe n + 1 ranges.
+    """
+    if partitions <= 1:
+        return []
+    oversampling = 10
+    sample = sorted(document["_id"] for document in collection.aggregate([
+        {"$sample": {"size": partitions * oversampling}},
+        {"$project": {"_id": 1}}
+    ]))
+    return sorted(set(sample[index] for index in range(oversampling, len(sample), oversampling)))
+
+
+def partition_ranges(boundaries):
+    bounds = [None] + list(boundaries) + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def partition_query(lower, upper, after=None):
+    """
+    Returns the query selecting the documents of an _id range, optionally only
+    those after the last checkpointed _id.
+    """
+    query = {}
+    if after is not None:
+        query["$gt"] = after
+    elif lower is not None:
+        query["$gte"] = lower
+    if upper is not None:
+        query["$lt"] = upper
+    return {"_id": query} if len(query) > 0 else {}
+
+
+def validate_partition(schema, lower, upper, examples=5):
+    """
+    Counts the documents of a range and those failing the schema, evaluated on
+    the server with the $jsonSchema query operator. Returns the counts and the
+    ids of a few failing documents.
+    """
+    query = partition_query(lower, upper)
+    total = worker_collections["source"].count_documents(query)
+    invalid = worker_collections["source"].count_documents({**query, "$nor": [{"$jsonSchema": schema}]})
+    failing = [document["_id"] for document in worker_collections["source"].find(
+        {**query, "$nor": [{"$jsonSchema": schema}]}, {"_id": 1}
+    ).limit(examples)] if invalid > 0 else []
+    return total, invalid, failing
+
+
+def write_batch(key, documents, last):
+    """
+    Upserts one batch of documents into the target collection and checkpoints
+    the last _id read. Returns the number written and (id, message) pairs for the
+    documents the target rejected, such as those failing its validator.
+    """
+    written, rejected = 0, []
+    if len(documents) > 0:
+        try:
+            result = worker_collections["target"].bulk_write([
+                ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents
+            ], ordered=False)
+            written = result.upserted_count + result.matched_count
+        except BulkWriteError as error:
+            written = error.details["nUpserted"] + error.details["nMatched"]
+            rejected = [(documents[write_error["index"]]["_id"], write_error["errmsg"]) for write_error in error.details["writeErrors"]]
+    worker_collections["checkpoints"].update_one({"_id": key}, {"$set": {"last": last}, "$inc": {"copied": written, "rejected": len(rejected)}}, upsert=True)
+    return written, rejected
+
+
+def copy_partition(key, function, lower, upper, batch_size, examples=5):
+    """
+    Transforms and copies one range into the target collection with unordered
+    bulk upserts, checkpointing after every batch so an interrupted copy
+    resumes where it stopped. Returns the number of documents copied, the
+    number rejected and (id, message) pairs for a few of the rejections.
+    """
+    checkpoint = worker_collections["checkpoints"].find_one({"_id": key}) or {}
+    if checkpoint.get("complete"):
+        return 0, 0, []
+    copied, rejected, failing, documents, last = 0, 0, [], [], checkpoint.get("last")
+    for document in worker_collections["source"].find(partition_query(lower, upper, last)).sort("_id", 1).batch_size(batch_size):
+        last = document["_id"]
+        upgraded = function(document) if function is not None else document
+        if upgraded is not None:
+            upgraded["_id"] = document["_id"]
+            documents.append(upgraded)
+        if len(documents) >= batch_size:
+            written, failures = write_batch(key, documents, last)
+            copied, rejected, failing, documents = copied + written, rejected + len(failures), (failing + failures)[:examples], []
+    written, failures = write_batch(key, documents, last)
+    worker_collections["checkpoints"].update_one({"_id": key}, {"$set": {"complete": True}}, upsert=True)
+    return copied + written, rejected + len(failures), (failing + failures)[:examples]
+
+
+def run_partitions(task, partitions, source, target, describe, progress, processes=None):
+    """
+    Runs a task for every partition across a spawned process pool, reporting
+    progress as each partition completes. Returns the results in completion order.
+    """
+    results, started = [], time.monotonic()
+    with worker_pool(processes, {"source": source, "target": target, "checkpoints": current_app.config["MECHANIC_CHECKPOINT_COLLECTION"]}) as executor:
+        futures = [executor.submit(task, *parameters) for parameters in partitions]
+        try:
+            for index, future in enumerate(as_completed(futures), start=1):
+                results.append(future.result())
+                progress("{index}/{total} partitions, {summary}, {elapsed:.1f}s".format(
+                    index=index, total=len(partitions), summary=describe(results), elapsed=time.monotonic() - started
+                ))
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
+
+
+def apply_schema(collection, schema, validation_level="moderate"):
+    """
+    Applies a $jsonSchema validator to an existing collection via collMod.
+    The moderate level leaves existing invalid documents updatable until they
+    have been fixed or migrated.
+    """
+    db_connect().command("collMod", collection, validator={"$jsonSchema": schema}, validationLevel=validation_level)
+
+
+def validate_collection(collection, schema, partitions=None, processes=None, progress=print):
+    """
+    Validates every existing document of a collection against a schema in
+    parallel _id partitions. Returns the number of documents, the number
+    failing and the ids of a few failing documents.
+    """
+    partitions = partitions if partitions is not None else current_app.config["MECHANIC_PARTITIONS"]
+    ranges = partition_ranges(id_partitions(db_connect()[collection], partitions))
+    progress("Validating {collection} in {count} partitions".format(collection=collection, count=len(ranges)))
+    results = run_partitions(
+        validate_partition,
+        [(schema, lower, upper) for lower, upper in ranges], collection, None,
+        lambda results: "{documents} documents, {invalid} invalid".format(
+            documents=sum(result[0] for result in results), invalid=sum(result[1] for result in results)
+        ),
+        progress, processes
+    )
+    return sum(result[0] for result in results), sum(result[1] for result in results), [identifier for result in results for identifier in result[2]]
+
+
+def reusable_plan(plan, transform_name):
+    """
+    Whether a stored partition plan belongs to an interrupted copy which can
+    be resumed: it has not completed and used the same transform.
+    """
+    return plan is not None and not plan.get("complete", False) and plan.get("transform") == transform_name
+
+
+def change_stream_token(collection):
+    """
+    Returns a change stream resume token marking the current point in the
+    collection's history, or None when the server does not support change
+    streams (a standalone server rather than a replica set).
+    """
+    try:
+        with collection.watch(max_await_time_ms=1) as stream:
+            stream.try_next()
+            return stream.resume_token
+    except OperationFailure:
+        return None
+
+
+def replay_changes(source, target, function, token, examples=5):
+    """
+    Applies the changes made to the source since the token to the target, so
+    documents written to ranges already copied are not lost. Returns the
+    number of changes applied, the number the target rejected, (id, message)
+    pairs for a few of the rejections and the token to continue from.
+    """
+    replayed, rejected, failing = 0, 0, []
+    with source.watch(full_document="updateLookup", start_after=token, max_await_time_ms=1000) as stream:
+        while stream.alive:
+            change = stream.try_next()
+            if change is None:
+                break
+            token = stream.resume_token
+            if change["operationType"] in ("drop", "rename", "dropDatabase", "invalidate"):
+                break
+            if change["operationType"] not in ("insert", "replace", "update", "delete"):
+                continue
+            identifier = change["documentKey"]["_id"]
+            document = change.get("fullDocument")
+            upgraded = None if document is None else (function(document) if function is not None else document)
+            try:
+                if upgraded is None:
+                    target.delete_one({"_id": identifier})
+                else:
+                    upgraded["_id"] = identifier
+                    target.replace_one({"_id": identifier}, upgraded, upsert=True)
+            except OperationFailure as error:
+                rejected, failing = rejected + 1, (failing + [(identifier, str(error))])[:examples]
+            replayed += 1
+    return replayed, rejected, failing, token
+
+
+def copy_collection(source, target, transform_name=None, partitions=None, processes=None, batch_size=None, resume=True, progress=print):
+    """
+    Copies a collection into another through an optional registered transform
+    in parallel _id partitions. The partition plan and per-partition progress
+    are checkpointed so an interrupted copy resumes where it stopped; a
+    completed copy or one with a different transform starts over. Changes
+    made to the source during the copy are then replayed from a change
+    stream. Without change streams (standalone servers) the source must not
+    be written to during the copy. Returns the number of documents copied,
+    the number the target rejected and (id, message) pairs for a few of the
+    rejections.
+    """
+    if transform_name is not None and transform_name not in TRANSFORMS:
+        raise KeyError("No transform registered with name: {name}".format(name=transform_name))
+    function = TRANSFORMS[transform_name] if transform_name is not None else None
+    partitions = partitions if partitions is not None else current_app.config["MECHANIC_PARTITIONS"]
+    batch_size = batch_size if batch_size is not None else current_app.config["MECHANIC_BATCH_SIZE"]
+    db = db_connect()
+    checkpoints = db[current_app.config["MECHANIC_CHECKPOINT_COLLECTION"]]
+    plan_key = {"source": source, "target": target}
+    #Reuse the Partition Plan of an Interrupted Copy
+    plan = checkpoints.find_one({"_id": plan_key}) if resume else None
+    if not reusable_plan(plan, transform_name):
+        checkpoints.delete_many({"_id.source": source, "_id.target": target})
+        #Mark the point to replay changes from before reading any document
+        plan = {
+            "_id": plan_key, "transform": transform_name, "complete": False,
+            "token": change_stream_token(db[source]),
+            "boundaries": id_partitions(db[source], partitions)
+        }
+        checkpoints.insert_one(plan)
+    if plan.get("token") is None:
+        progress("Change streams are unavailable, {source} must not be written to during the copy".format(source=source))
+    ranges = partition_ranges(plan["boundaries"])
+    progress("Copying {source} into {target} in {count} partitions".format(source=source, target=target, count=len(ranges)))
+    results = run_partitions(
+        copy_partition,
+        [({**plan_key, "partition": index}, function, lower, upper, batch_size) for index, (lower, upper) in enumerate(ranges)],
+        source, target,
+        lambda results: "{copied} documents copied, {rejected} rejected".format(
+            copied=sum(result[0] for result in results), rejected=sum(result[1] for result in results)
+        ),
+        progress, processes
+    )
+    copied, rejected, failing = sum(result[0] for result in results), sum(result[1] for result in results), [failure for result in results for failure in result[2]]
+    #Replay Changes made During the Copy
+    if plan.get("token") is not None:
+        replayed, replay_rejected, replay_failing, token = replay_changes(db[source], db[target], function, plan["token"])
+        checkpoints.update_one({"_id": plan_key}, {"$set": {"token": token}})
+        progress("Replayed {replayed} changes made during the copy".format(replayed=replayed))
+        rejected, failing = rejected + replay_rejected, failing + replay_failing
+    checkpoints.update_one({"_id": plan_key}, {"$set": {"complete": True}})
+    return copied, rejected, failing
@@ -0,0 +1 @@
+from pbshm.response.response import *
\ No newline at end of file
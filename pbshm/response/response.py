@@ -0,0 +1,139 @@
+import gzip
+import hashlib
+from functools import wraps
+
+from flask import Blueprint, current_app, g, make_response, request, request_started
+
+from pbshm.db import start_counting, stop_counting
+
+try:
+    from compression import zstd
+    zstd_compress = lambda data, level: zstd.compress(data, level=level)
+except ImportError:
+    try:
+        import zstandard
+        zstd_compress = lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)
+    except ImportError:
+        zstd_compress = None
+
+#Create the Response Blueprint
+bp = Blueprint("response", __name__)
+
+
+def available_encodings():
+    """
+    Returns the content encodings this server can produce, in order of preference.
+    """
+    return (["zstd"] if zstd_compress is not None else []) + ["gzip"]
+
+
+def compress_content(data, encoding):
+    """
+    Compresses data with the given content encoding using the configured level.
+    """
+    if encoding == "zstd":
+        return zstd_compress(data, current_app.config["COMPRESSION_ZSTD_LEVEL"])
+    return gzip.compress(data, compresslevel=current_app.config["COMPRESSION_GZIP_LEVEL"])
+
+
+#Compress Responses
+@bp.after_app_request
+def compress_response(response):
+    if not current_app.config["COMPRESSION_ENABLED"]:
+        return response
+    response.vary.add("Accept-Encoding")
+    #Skip Responses which cannot or should not be compressed
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200 or response.status_code in (204, 206, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in current_app.config["COMPRESSION_MIMETYPES"]
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config["COMPRESSION_MIN_SIZE"]:
+        return response
+    #Negotiate Encoding
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+    response.set_data(compress_content(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    #Compressed representations are not byte identical, so strong validators become weak
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+#Count Database Commands per Request
+@bp.record_once
+def connect_query_counter(state):
+    request_started.connect(start_query_counter, state.app)
+
+
+def start_query_counter(sender, **extra):
+    g.query_counter, g.query_counter_token = start_counting()
+
+
+@bp.after_app_request
+def report_query_count(response):
+    counter = g.get("query_counter")
+    if counter is None:
+        return response
+    budget = current_app.config["QUERY_BUDGET"]
+    if budget is not None and counter.total > budget:
+        current_app.logger.warning(
+            "%s issued %d database commands, over the budget of %d: %s", request.endpoint, counter.total, budget,
+            ", ".join("{site} x{count}".format(site=site, count=count) for site, count in counter.call_sites.most_common())
+        )
+    if current_app.debug or current_app.config["QUERY_COUNT_HEADER"]:
+        response.headers["X-PBSHM-Queries"] = counter.summary()
+    return response
+
+
+@bp.teardown_app_request
+def stop_query_counter(exception=None):
+    token = g.pop("query_counter_token", None)
+    if token is not None:
+        stop_counting(token)
+
+
+#Conditional Response
+def conditional_response(data_version):
+    """
+    View decorator which answers with 304 Not Modified, without running the
+    view, when the client already holds the current representation.
+
+    data_version is a callable returning a cheap signal which changes whenever
+    the underlying data changes, either a value or a tuple whose first item is
+    the value, such as pbshm.db.collection_data_version. Only an ETag is sent:
+    the newest document's creation time does not move when documents are
+    deleted, so it cannot serve as Last-Modified. The value is kept in
+    g.data_version so the view can reuse it rather than compute it again.
+    """
+    def view_decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            #Compute Validator
+            version = data_version()
+            if isinstance(version, tuple):
+                version = version[0]
+            g.data_version = version
+            user_id = g.user["_id"] if g.get("user") is not None else ""
+            etag = hashlib.sha256(
+                "|".join([request.endpoint or "", request.full_path, user_id, str(version)]).encode()
+            ).hexdigest()
+            #Return Not Modified
+            if request.if_none_match.contains_weak(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            #Attach Validator
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapped
+    return view_decorator
@@ -0,0 +1 @@
+from pbshm.rolling.rolling import *
\ No newline at end of file
@@ -0,0 +1,254 @@
+import numpy as np
+
+from pbshm.db import collection_data_version, default_collection, db_connect
+
+#Constants
+STATISTICS = ["count", "mean", "variance", "std", "rms", "min", "max", "peak_to_peak"]
+
+
+def window_bounds(window, window_type):
+    """
+    Returns the $setWindowFields window for a trailing window ending at the
+    current document: a timestamp range in nanoseconds or a number of documents.
+    """
+    if window_type == "range":
+        return {"range": [-window, 0]}
+    elif window_type == "documents":
+        return {"documents": [-(window - 1), 0]}
+    raise ValueError("Unsupported window type: {window_type}".format(window_type=window_type))
+
+
+def rolling_pipeline(population, structure, channels, window, statistics=None, start=None, end=None, window_type="range", statistic="mean"):
+    """
+    Builds a pipeline which computes trailing window statistics per channel
+    with $setWindowFields, partitioned by channel name and ordered by timestamp.
+    """
+    statistics = STATISTICS if statistics is None else statistics
+    for name in statistics:
+        if name not in STATISTICS:
+            raise ValueError("Unsupported statistic: {name}".format(name=name))
+    match = {"population": population, "name": structure, "channels.name": {"$in": list(channels)}}
+    if start is not None or end is not None:
+        match["timestamp"] = {}
+        if start is not None: match["timestamp"]["$gte"] = start
+        if end is not None: match["timestamp"]["$lt"] = end
+    bounds = window_bounds(window, window_type)
+    #Accumulators computed inside the window
+    accumulators = {
+        "count": {"$count": {}},
+        "mean": {"$avg": "$value"},
+        "std": {"$stdDevPop": "$value"},
+        "mean_square": {"$avg": "$value_squared"},
+        "min": {"$min": "$value"},
+        "max": {"$max": "$value"}
+    }
+    required = set()
+    for name in statistics:
+        required.update({
+            "variance": ["std"], "rms": ["mean_square"], "peak_to_peak": ["min", "max"]
+        }.get(name, [name]))
+    #Statistics derived from the accumulators
+    derived = {
+        "variance": {"$multiply": ["$std", "$std"]},
+        "rms": {"$sqrt": "$mean_square"},
+        "peak_to_peak": {"$subtract": ["$max", "$min"]}
+    }
+    return [
+        {"$match": match},
+        {"$project": {"_id": 0, "timestamp": 1, "channels": 1}},
+        {"$unwind": "$channels"},
+        {"$match": {"channels.name": {"$in": list(channels)}}},
+        {"$project": {
+            "timestamp": 1,
+            "channel": "$channels.name",
+            "value": {"$cond": [
+                {"$isNumber": "$channels.value"},
+                "$channels.value",
+                f"$channels.value.{statistic}"
+            ]}
+        }},
+        {"$match": {"value": {"$type": "number"}}},
+        {"$set": {"value_squared": {"$multiply": ["$value", "$value"]}}},
+        {"$setWindowFields": {
+            "partitionBy": "$channel",
+            "sortBy": {"timestamp": 1},
+            "output": {name: {**accumulators[name], "window": bounds} for name in sorted(required)}
+        }},
+        {"$project": {
+            "_id": 0,
+            "channel": 1,
+            "timestamp": 1,
+            **{name: derived[name] if name in derived else 1 for name in statistics}
+        }},
+        {"$sort": {"channel": 1, "timestamp": 1}}
+    ]
+
+
+def rolling_statistics(population, structure, channels, window, statistics=None, start=None, end=None, window_type="range", persist=None, collection=None):
+    """
+    Computes trailing window statistics next to the data. Returns a dictionary
+    of channel name to a dictionary of arrays (timestamp plus one per statistic).
+    When persist names a collection, results are stored in it and reused by
+    later calls with the same arguments until the data version of the
+    structure collection changes, see pbshm.db.collection_data_version.
+    """
+    collection = default_collection() if collection is None else collection
+    statistics = STATISTICS if statistics is None else statistics
+    if persist is not None:
+        version, _ = collection_data_version(collection)
+        results = persisted_rolling_statistics(population, structure, channels, window, statistics, start, end, window_type, version, persist)
+        if results is not None:
+            return results
+    pipeline = rolling_pipeline(population, structure, channels, window, statistics, start, end, window_type)
+    results = {}
+    for document in collection.aggregate(pipeline, allowDiskUse=True):
+        series = results.setdefault(document["channel"], {"timestamp": [], **{name: [] for name in statistics}})
+        series["timestamp"].append(document["timestamp"])
+        for name in statistics:
+            value = document.get(name)
+            series[name].append(np.nan if value is None else value)
+    results = series_arrays(results)
+    if persist is not None:
+        persist_rolling_statistics(population, structure, channels, window, statistics, start, end, window_type, version, results, persist)
+    return results
+
+
+def series_arrays(results):
+    return {
+        channel: {
+            name: np.array(values, dtype=np.int64 if name == "timestamp" else np.float64)
+            for name, values in series.items()
+        }
+        for channel, series in results.items()
+    }
+
+
+def rolling_key(population, structure, channel, window, window_type, start, end):
+    """
+    Identifies the persisted statistics of one channel. The start bound is
+    part of the key as it truncates the first windows.
+    """
+    return {
+        "population": population, "name": structure, "channel": channel,
+        "window": window, "window_type": window_type, "start": start, "end": end
+    }
+
+
+def persisted_rolling_statistics(population, structure, channels, window, statistics, start, end, window_type, version, collection_name):
+    """
+    Returns the rolling statistics persisted for every channel at the given
+    data version, or None when any channel is missing, stale or was persisted
+    without one of the statistics.
+    """
+    persisted = db_connect()[collection_name]
+    keys = [rolling_key(population, structure, channel, window, window_type, start, end) for channel in channels]
+    markers = {marker["_id"]["channel"]: marker for marker in persisted.find({"_id": {"$in": keys}})}
+    for channel in channels:
+        marker = markers.get(channel)
+        if marker is None or marker["version"] != version or not set(statistics) <= set(marker["statistics"]):
+            return None
+    results = {}
+    for document in persisted.find({"run": {"$in": keys}}).sort([("run.channel", 1), ("timestamp", 1)]):
+        series = results.setdefault(document["run"]["channel"], {"timestamp": [], **{name: [] for name in statistics}})
+        series["timestamp"].append(document["timestamp"])
+        for name in statistics:
+            value = document.get(name)
+            series[name].append(np.nan if value is None else value)
+    return series_arrays(results)
+
+
+def persist_rolling_statistics(population, structure, channels, window, statistics, start, end, window_type, version, results, collection_name):
+    """
+    Replaces the persisted rolling statistics of each channel with the results
+    and marks them as computed at the given data version. Channels without
+    data are marked too, so they are not recomputed.
+    """
+    persisted = db_connect()[collection_name]
+    persisted.create_index([("run", 1), ("timestamp", 1)])
+    for channel in channels:
+        key = rolling_key(population, structure, channel, window, window_type, start, end)
+        #Unmark before replacing, so an interrupted write is recomputed rather than read back
+        persisted.delete_one({"_id": key})
+        persisted.delete_many({"run": key})
+        series = results.get(channel)
+        if series is not None and len(series["timestamp"]) > 0:
+            documents = []
+            for index, timestamp in enumerate(series["timestamp"].tolist()):
+                document = {"run": key, "timestamp": timestamp}
+                for name in statistics:
+                    value = float(series[name][index])
+                    document[name] = None if np.isnan(value) else value
+                documents.append(document)
+            persisted.insert_many(documents, ordered=False)
+        persisted.replace_one({"_id": key}, {"_id": key, "version": version, "statistics": list(statistics)}, upsert=True)
+
+
+def range_table(values, function):
+    """
+    Builds a sparse table for O(1) range minimum/maximum queries.
+    """
+    table = [values]
+    span = 1
+    while span * 2 <= len(values):
+        previous = table[-1]
+        table.append(function(previous[:len(previous) - span], previous[span:]))
+        span *= 2
+    return table
+
+
+def range_query(table, function, left, right):
+    """
+    Vectorised range query over inclusive [left, right] index arrays.
+    """
+    length = right - left + 1
+    level = np.floor(np.log2(np.maximum(length, 1))).astype(np.int64)
+    result = np.empty(len(left))
+    for k in np.unique(level):
+        mask = level == k
+        result[mask] = function(table[k][left[mask]], table[k][right[mask] - (1 << k) + 1])
+    return result
+
+
+def rolling_statistics_array(timestamps, values, window, statistics=None, window_type="range"):
+    """
+    Vectorised NumPy equivalent of rolling_statistics for local columnar data,
+    such as arrays returned by pbshm.db.load_channel_arrays. NaN samples are
+    ignored. Returns a dictionary of statistic name to array.
+    """
+    statistics = STATISTICS if statistics is None else statistics
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    length = len(values)
+    #Window start index for every sample
+    right = np.arange(length)
+    if window_type == "range":
+        left = np.searchsorted(timestamps, timestamps - window, side="left")
+    elif window_type == "documents":
+        left = np.maximum(right - (window - 1), 0)
+    else:
+        raise ValueError("Unsupported window type: {window_type}".format(window_type=window_type))
+    #Prefix sums over finite samples, centred to limit cancellation
+    finite = np.isfinite(values)
+    centre = values[finite].mean() if finite.any() else 0.0
+    centred = np.where(finite, values - centre, 0.0)
+    def window_sum(series):
+        prefix = np.concatenate(([0.0], np.cumsum(series)))
+        return prefix[right + 1] - prefix[left]
+    count = window_sum(finite.astype(np.float64))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_centred = window_sum(centred) / count
+        variance = np.maximum(window_sum(centred * centred) / count - mean_centred * mean_centred, 0.0)
+        mean_square = window_sum(np.where(finite, values * values, 0.0)) / count
+    results = {
+        "count": count,
+        "mean": mean_centred + centre,
+        "variance": variance,
+        "std": np.sqrt(variance),
+        "rms": np.sqrt(mean_square)
+    }
+    if "min" in statistics or "max" in statistics or "peak_to_peak" in statistics:
+        minimum = range_query(range_table(np.where(finite, values, np.inf), np.minimum), np.minimum, left, right) if length > 0 else np.empty(0)
+        maximum = range_query(range_table(np.where(finite, values, -np.inf), np.maximum), np.maximum, left, right) if length > 0 else np.empty(0)
+        minimum[count == 0], maximum[count == 0] = np.nan, np.nan
+        results.update({"min": minimum, "max": maximum, "peak_to_peak": maximum - minimum})
+    return {name: results[name] for name in statistics}
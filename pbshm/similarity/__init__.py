@@ -0,0 +1 @@
+from pbshm.similarity.similarity import *
\ No newline at end of file
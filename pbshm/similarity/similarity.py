@@ -0,0 +1,281 @@
+import os
+import threading
+import warnings
+from datetime import datetime, timedelta, timezone
+from os.path import exists, join
+
+import click
+import numpy as np
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from pbshm.authentication import authenticate_request
+from pbshm.db import db_connect
+from pbshm.jobs import register_job_type
+
+#Create the Similarity Blueprint
+bp = Blueprint("similarity", __name__, cli_group="similarity")
+
+#Loaded Indexes
+indexes_lock = threading.Lock()
+
+
+class SimilarityIndex:
+    """
+    Fixed-length feature vectors keyed by structure and window start, searched
+    by blocked brute force in NumPy. Every dimension is standardised by the
+    mean and spread seen when the index was built, so no single feature value
+    dominates the Euclidean distance.
+    """
+    def __init__(self, dimensions, mean=None, scale=None):
+        self.dimensions = list(dimensions)
+        self.mean = np.zeros(len(self.dimensions)) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.scale = np.ones(len(self.dimensions)) if scale is None else np.asarray(scale, dtype=np.float64)
+        self.vectors = np.empty((0, len(self.dimensions)), dtype=np.float32)
+        self.starts = np.empty(0, dtype=np.int64)
+        self.codes = np.empty(0, dtype=np.int64)
+        self.structures = []
+        self.structure_codes = {}
+        self.positions = {}
+        self.groups = None
+        self.updated = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def standardise(self, vectors):
+        vectors = (np.asarray(vectors, dtype=np.float64) - self.mean) / self.scale
+        return np.nan_to_num(vectors, nan=0.0, posinf=0.0, neginf=0.0).astype(np.float32)
+
+    def structure_code(self, population, name):
+        key = (population, name)
+        if key not in self.structure_codes:
+            self.structure_codes[key] = len(self.structures)
+            self.structures.append(key)
+        return self.structure_codes[key]
+
+    def upsert(self, keys, vectors):
+        """
+        Adds or replaces the vectors of (population, name, start) keys.
+        """
+        vectors = self.standardise(vectors)
+        appended, rows = [], []
+        for row, (population, name, start) in enumerate(keys):
+            position = self.positions.get((population, name, start))
+            if position is None:
+                self.positions[(population, name, start)] = len(self.starts) + len(appended)
+                appended.append((self.structure_code(population, name), start))
+                rows.append(row)
+            else:
+                self.vectors[position] = vectors[row]
+        if len(appended) > 0:
+            self.vectors = np.vstack([self.vectors, vectors[rows]])
+            self.codes = np.concatenate([self.codes, np.array([code for code, _ in appended], dtype=np.int64)])
+            self.starts = np.concatenate([self.starts, np.array([start for _, start in appended], dtype=np.int64)])
+            self.groups = None
+
+    def structure_vector(self, population, name, start=None):
+        """
+        Returns the standardised vector of a structure for the window starting
+        at start, or of its latest window, or None when it is not indexed.
+        """
+        if start is not None:
+            position = self.positions.get((population, name, start))
+            return None if position is None else self.vectors[position]
+        code = self.structure_codes.get((population, name))
+        if code is None:
+            return None
+        rows = np.flatnonzero(self.codes == code)
+        return self.vectors[rows[np.argmax(self.starts[rows])]]
+
+    def grouping(self):
+        """
+        Returns the rows ordered by structure with the start of each structure's
+        segment and its code, computed once until the index changes.
+        """
+        if self.groups is None:
+            order = np.argsort(self.codes, kind="stable")
+            codes = self.codes[order]
+            segments = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]])) if len(codes) > 0 else np.empty(0, dtype=np.int64)
+            self.groups = (order, segments, codes[segments])
+        return self.groups
+
+    def nearest(self, vector, k=10, exclude=None, block_size=65536):
+        """
+        Returns up to k (population, name, start, distance) tuples for the
+        structures closest to a standardised vector, each represented by its
+        closest window. Distances are computed in blocks to bound memory.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        distances = np.empty(len(self.starts), dtype=np.float32)
+        for lower in range(0, len(self.starts), block_size):
+            difference = self.vectors[lower:lower + block_size] - vector
+            distances[lower:lower + block_size] = np.einsum("ij,ij->i", difference, difference)
+        if len(distances) == 0:
+            return []
+        #Closest Window per Structure
+        order, segments, codes = self.grouping()
+        best = np.minimum.reduceat(distances[order], segments)
+        if exclude is not None and exclude in self.structure_codes:
+            best[codes == self.structure_codes[exclude]] = np.inf
+        candidates = np.flatnonzero(np.isfinite(best))
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(best[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(best[candidates], kind="stable")]
+        results = []
+        for segment in candidates:
+            rows = order[segments[segment]:segments[segment + 1] if segment + 1 < len(segments) else len(order)]
+            row = rows[np.argmin(distances[rows])]
+            population, name = self.structures[codes[segment]]
+            results.append((population, name, int(self.starts[row]), float(np.sqrt(best[segment]))))
+        return results
+
+    def save(self, path):
+        temporary = "{path}.{pid}.tmp.npz".format(path=path, pid=os.getpid())
+        np.savez(
+            temporary,
+            dimensions=np.array(self.dimensions, dtype=np.str_),
+            mean=self.mean, scale=self.scale,
+            vectors=self.vectors, starts=self.starts, codes=self.codes,
+            populations=np.array([population for population, _ in self.structures], dtype=np.str_),
+            names=np.array([name for _, name in self.structures], dtype=np.str_),
+            updated=np.array([-1 if self.updated is None else int(self.updated.timestamp() * 1000000)], dtype=np.int64)
+        )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(data["dimensions"].tolist(), data["mean"], data["scale"])
+            index.vectors, index.starts, index.codes = data["vectors"], data["starts"], data["codes"]
+            for population, name in zip(data["populations"].tolist(), data["names"].tolist()):
+                index.structure_code(population, name)
+            updated = int(data["updated"][0])
+        index.positions = {
+            (*index.structures[code], int(start)): position
+            for position, (code, start) in enumerate(zip(index.codes.tolist(), index.starts.tolist()))
+        }
+        index.updated = None if updated < 0 else datetime.fromtimestamp(updated / 1000000, timezone.utc)
+        return index
+
+
+def index_path(feature_name, window):
+    return join(current_app.instance_path, current_app.config["SIMILARITY_FILENAME"].format(feature=feature_name, window=window))
+
+
+def feature_documents(feature_name, window, since=None):
+    """
+    Returns the feature collection documents of a feature extracted over
+    windows of window nanoseconds, optionally only
+    those extracted since the given time less SIMILARITY_WATERMARK_OVERLAP
+    seconds, so writes landing out of order around the watermark are still
+    read. Upserts into the index are idempotent, so rereading is harmless.
+    """
+    query = {"feature": feature_name, "window": window}
+    if since is not None:
+        query["extracted"] = {"$gte": since - timedelta(seconds=current_app.config["SIMILARITY_WATERMARK_OVERLAP"])}
+    return db_connect()[current_app.config["FEATURE_COLLECTION"]].find(
+        query, {"_id": 0, "population": 1, "name": 1, "start": 1, "values": 1, "extracted": 1}
+    )
+
+
+def update_similarity_index(feature_name, window, rebuild=False):
+    """
+    Brings the persisted index of a feature over windows of window
+    nanoseconds up to date with the feature
+    collection, reading only documents extracted since the last update unless
+    rebuilding. A rebuild also recomputes the standardisation. Returns the index.
+    """
+    path = index_path(feature_name, window)
+    index = SimilarityIndex.load(path) if exists(path) and not rebuild else None
+    documents = list(feature_documents(feature_name, window, index.updated if index is not None else None))
+    if index is None:
+        dimensions = sorted({name for document in documents for name in document["values"]})
+        matrix = np.array([[document["values"].get(name, np.nan) for name in dimensions] for document in documents], dtype=np.float64).reshape(len(documents), len(dimensions))
+        mean, scale = np.zeros(len(dimensions)), np.ones(len(dimensions))
+        if len(documents) > 0:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                mean, scale = np.nanmean(matrix, axis=0), np.nanstd(matrix, axis=0)
+        index = SimilarityIndex(dimensions, np.nan_to_num(mean), np.where(np.isfinite(scale) & (scale > 0), scale, 1.0))
+    else:
+        matrix = np.array([[document["values"].get(name, np.nan) for name in index.dimensions] for document in documents], dtype=np.float64).reshape(len(documents), len(index.dimensions))
+    index.upsert([(document["population"], document["name"], document["start"]) for document in documents], matrix)
+    if len(documents) > 0:
+        latest = max(document["extracted"] for document in documents)
+        latest = latest if latest.tzinfo is not None else latest.replace(tzinfo=timezone.utc)
+        index.updated = latest if index.updated is None else max(index.updated, latest)
+    if not os.path.isdir(current_app.instance_path):
+        os.makedirs(current_app.instance_path)
+    index.save(path)
+    return index
+
+
+def similarity_index(feature_name, window):
+    """
+    Returns the index of a feature and window loaded from the instance
+    folder, reloading it when another process has persisted a newer version.
+    """
+    path = index_path(feature_name, window)
+    if not exists(path):
+        return None
+    loaded = current_app.extensions.setdefault("pbshm_similarity", {})
+    modified = os.stat(path).st_mtime_ns
+    key = (feature_name, window)
+    if key not in loaded or loaded[key][0] != modified:
+        with indexes_lock:
+            if key not in loaded or loaded[key][0] != modified:
+                loaded[key] = (modified, SimilarityIndex.load(path))
+    return loaded[key][1]
+
+
+def similar_structures(feature_name, window, population, name, k=10, start=None):
+    """
+    Returns the k structures whose feature vectors are closest to the given
+    structure's vector for one window (its latest by default), or None when
+    the feature or structure is not indexed.
+    """
+    index = similarity_index(feature_name, window)
+    if index is None:
+        return None
+    vector = index.structure_vector(population, name, start)
+    if vector is None:
+        return None
+    return index.nearest(vector, k, (population, name), current_app.config["SIMILARITY_BLOCK_SIZE"])
+
+
+#Similar Structures View
+@bp.route("/<feature_name>/<population>/<structure>")
+@authenticate_request("similarity-query")
+def similar(feature_name, population, structure):
+    window = request.args.get("window", None, type=float)
+    if window is None:
+        abort(400, description="The window length in seconds is required")
+    k = request.args.get("k", current_app.config["SIMILARITY_DEFAULT_K"], type=int)
+    start = request.args.get("start", None, type=int)
+    results = similar_structures(feature_name, int(window * 1000000000), population, structure, max(1, k), start)
+    if results is None:
+        abort(404)
+    return jsonify([
+        {"population": result_population, "name": result_name, "start": result_start, "distance": distance}
+        for result_population, result_name, result_start, distance in results
+    ])
+
+
+#Update Similarity Index
+@bp.cli.command("update")
+@click.argument("feature_name")
+@click.option("--window", type=float, required=True, help="Window length in seconds the feature was extracted over")
+@click.option("--rebuild", is_flag=True, default=False)
+def similarity_update(feature_name, window, rebuild):
+    index = update_similarity_index(feature_name, int(window * 1000000000), rebuild)
+    print("Indexed {count} windows of {structures} structures across {dimensions} dimensions".format(
+        count=len(index), structures=len(index.structures), dimensions=len(index.dimensions)
+    ))
+
+
+#Register Background Jobs
+register_job_type(
+    "similarity.update",
+    lambda job: len(update_similarity_index(job.parameters["feature"], job.parameters["window"], job.parameters.get("rebuild", False))),
+    concurrency=1
+)
@@ -5,6 +5,9 @@ from flask import Blueprint
 #Create the timekeeper Blueprint
 bp = Blueprint("timekeeper", __name__)
 
+#Calendar units supported by $dateTrunc and $dateAdd
+CALENDAR_UNITS = ["year", "quarter", "month", "week", "day", "hour", "minute", "second", "millisecond"]
+
 # Convert datetime to nanoseconds since epoch
 def datetime_to_nanoseconds_since_epoch(timestamp: datetime):
     if timestamp.tzinfo is None:
@@ -22,6 +25,54 @@ def nanoseconds_since_epoch_to_datetime(nanoseconds):
     else:
         raise TypeError("Input nanoseconds must be a real-valued integer.")
 
+# Aggregation expression converting a nanoseconds since epoch field into a BSON date (millisecond precision)
+def nanoseconds_to_date_expression(field="$timestamp"):
+    return {"$toDate": {"$toLong": {"$floor": {"$divide": [field, 1000000]}}}}
+
+# Aggregation expression converting a BSON date expression into nanoseconds since epoch
+def date_to_nanoseconds_expression(date):
+    return {"$multiply": [{"$toLong": date}, 1000000]}
+
+# Aggregation expression truncating a nanoseconds since epoch field to the start of its calendar unit as a BSON date
+def truncate_date_expression(field="$timestamp", unit="day", timezone="UTC", bin_size=1, start_of_week="monday"):
+    if unit not in CALENDAR_UNITS:
+        raise ValueError("Unsupported calendar unit: {unit}".format(unit=unit))
+    if not isinstance(bin_size, int) or bin_size < 1:
+        raise ValueError("Bin size must be a positive integer.")
+    expression = {
+        "date": nanoseconds_to_date_expression(field),
+        "unit": unit,
+        "binSize": bin_size,
+        "timezone": timezone
+    }
+    if unit == "week":
+        expression["startOfWeek"] = start_of_week
+    return {"$dateTrunc": expression}
+
+# Aggregation expression truncating a nanoseconds since epoch field to the start of its calendar unit in nanoseconds
+def truncate_nanoseconds_expression(field="$timestamp", unit="day", timezone="UTC", bin_size=1, start_of_week="monday"):
+    return date_to_nanoseconds_expression(truncate_date_expression(field, unit, timezone, bin_size, start_of_week))
+
+# Aggregation expression computing the [start, end) bucket boundaries, in nanoseconds, containing a nanoseconds since epoch field
+def bucket_boundaries_expression(field="$timestamp", unit="day", timezone="UTC", bin_size=1, start_of_week="monday"):
+    start = truncate_date_expression(field, unit, timezone, bin_size, start_of_week)
+    return {"$let": {
+        "vars": {"start": start},
+        "in": {
+            "start": date_to_nanoseconds_expression("$$start"),
+            "end": date_to_nanoseconds_expression({"$dateAdd": {
+                "startDate": "$$start", "unit": unit, "amount": bin_size, "timezone": timezone
+            }})
+        }
+    }}
+
+# Aggregation $group stage rolling up documents per calendar unit, keyed by the bucket start in nanoseconds
+def calendar_group_stage(accumulators, field="$timestamp", unit="day", timezone="UTC", bin_size=1, start_of_week="monday"):
+    return {"$group": {
+        "_id": truncate_nanoseconds_expression(field, unit, timezone, bin_size, start_of_week),
+        **accumulators
+    }}
+
 #Convert View
 @bp.route("/convert/<int:nanoseconds>/<unit>")
 def convert_nanoseconds(nanoseconds, unit):
@@ -7,6 +7,7 @@ import pymongo
 import pytest
 
 from pbshm.app import create_app
+from pbshm.db import assert_max_queries
 
 @pytest.hookimpl(tryfirst=True, hookwrapper=False)
 def pytest_sessionstart():
@@ -64,8 +65,22 @@ def pytest_collection_modifyitems(items):
     MODULE_ORDER = [
         "tests.test_initialisation",
         "tests.test_authentication",
+        "tests.test_db",
+        "tests.test_assets",
+        "tests.test_response",
+        "tests.test_jobs",
         "tests.test_mechanic",
-        "tests.test_timekeeper"
+        "tests.test_timekeeper",
+        "tests.test_admission",
+        "tests.test_correlation",
+        "tests.test_downsample",
+        "tests.test_features",
+        "tests.test_graphs",
+        "tests.test_incremental",
+        "tests.test_live",
+        "tests.test_logs",
+        "tests.test_rolling",
+        "tests.test_similarity"
     ]
     module_mapping = {item: item.module.__name__ for item in items}
 
@@ -118,3 +133,14 @@ def authenticated_client(client, app) -> FlaskClient:
                 }
             )
         yield client
+
+@pytest.fixture
+def max_queries():
+    """
+    Asserts the maximum number of database commands issued within a block,
+    reporting the collections and call sites when exceeded:
+
+        with max_queries(1):
+            authenticated_client.get("/layout/home")
+    """
+    return assert_max_queries
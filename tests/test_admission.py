@@ -0,0 +1,78 @@
+import threading
+
+from pbshm.admission import ConcurrencyLimiter, TokenBucket, admission_control, admission_metrics
+
+
+class TestConcurrencyLimiter:
+    def test_rejects_when_saturated(self):
+        """
+        Requests over the cap should be rejected once the wait times out.
+        """
+        limiter = ConcurrencyLimiter(1)
+        assert limiter.acquire(0.01)
+        assert not limiter.acquire(0.01)
+        limiter.release()
+        assert limiter.acquire(0.01)
+        assert (limiter.admitted, limiter.rejected) == (2, 1)
+
+    def test_queued_request_admitted(self):
+        """
+        A queued request should be admitted when a slot frees within its wait.
+        """
+        limiter = ConcurrencyLimiter(1)
+        limiter.acquire(0)
+        threading.Timer(0.05, limiter.release).start()
+        assert limiter.acquire(2)
+
+
+class TestTokenBucket:
+    def test_burst_then_retry_after(self):
+        """
+        A client should be allowed its burst and then told when to retry.
+        """
+        bucket = TokenBucket(rate=1.0, burst=2)
+        assert bucket.take("user") == 0
+        assert bucket.take("user") == 0
+        assert 0 < bucket.take("user") <= 1
+        assert bucket.take("other") == 0
+
+    def test_refilled_buckets_pruned(self, monkeypatch):
+        """
+        Buckets which have refilled to burst should be dropped once a refill
+        period has passed, while those still refilling are kept.
+        """
+        now = [100.0]
+        monkeypatch.setattr("pbshm.admission.admission.time.monotonic", lambda: now[0])
+        bucket = TokenBucket(rate=1.0, burst=2)
+        for client in range(100):
+            bucket.take(client)
+        now[0] += 1.5
+        bucket.take("busy")
+        bucket.take("busy")
+        now[0] += 0.6
+        bucket.take("latest")
+        assert set(bucket.buckets) == {"busy", "latest"}
+
+
+class TestAdmissionControl:
+    def test_rate_limited_response(self, app, client):
+        """
+        Exceeding the per-user rate should answer 429 with Retry-After and be
+        reported in the metrics.
+        """
+        app.add_url_rule("/unittest-admission", "unittest_admission", admission_control(rate=0.001, burst=1)(lambda: "ok"))
+        assert client.get("/unittest-admission").status_code == 200
+        response = client.get("/unittest-admission")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"]
+        assert admission_metrics(app)["unittest_admission"]["rejected_rate_limited"] == 1
+
+    def test_saturated_response(self, app, client):
+        """
+        A request finding the endpoint saturated should answer 503 with Retry-After.
+        """
+        app.config["ADMISSION_LIMITS"] = {"unittest_saturated": {"concurrency": 0}}
+        app.add_url_rule("/unittest-saturated", "unittest_saturated", admission_control(concurrency=1, timeout=0.01)(lambda: "ok"))
+        response = client.get("/unittest-saturated")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(app.config["ADMISSION_RETRY_AFTER"])
@@ -0,0 +1,57 @@
+import re
+
+from tests.auxiliary import response_code_successful
+
+asset_pattern = re.compile(r'(?:href|src)="(/assets/layout\.static/[^"]+)"')
+
+
+class TestFingerprintedAssets:
+    def test_login_uses_fingerprinted_urls(self, client):
+        """
+        Static files referenced by the layout should be rewritten into
+        fingerprinted asset URLs.
+        """
+        response = client.get("/authentication/login")
+        assert response_code_successful(response) == 1
+        urls = asset_pattern.findall(response.get_data(as_text=True))
+        assert len(urls) > 0
+        assert any(re.search(r"style\.[0-9a-f]{12}\.css$", url) for url in urls)
+
+    def test_fingerprinted_asset_is_immutable(self, client):
+        """
+        Fingerprinted assets should be served with long lived immutable caching.
+        """
+        urls = asset_pattern.findall(client.get("/authentication/login").get_data(as_text=True))
+        response = client.get(urls[0])
+        assert response.status_code == 200
+        assert response.cache_control.immutable
+        assert response.cache_control.max_age == 31536000
+
+    def test_precompressed_gzip(self, client):
+        """
+        Text assets should be served precompressed when the client accepts gzip.
+        """
+        urls = asset_pattern.findall(client.get("/authentication/login").get_data(as_text=True))
+        css_url = next(url for url in urls if url.endswith(".css"))
+        response = client.get(css_url, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.vary
+
+    def test_unknown_fingerprint(self, client):
+        """
+        Requests for fingerprints that are not in the manifest should 404.
+        """
+        response = client.get("/assets/layout.static/style.000000000000.css")
+        assert response.status_code == 404
+
+
+class TestVendorBootstrap:
+    def test_rejects_other_versions(self, runner, monkeypatch):
+        """
+        Versions other than the one whose integrity hashes the layout pins
+        should be rejected before anything is downloaded.
+        """
+        monkeypatch.setattr("pbshm.assets.assets.urlopen", lambda url: (_ for _ in ()).throw(AssertionError(url)))
+        result = runner.invoke(args=["assets", "vendor-bootstrap", "--version", "5.0.0"])
+        assert result.exit_code == 0
+        assert "only Bootstrap" in result.output
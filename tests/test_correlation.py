@@ -0,0 +1,140 @@
+import numpy as np
+
+from pbshm.correlation import (
+    accumulate_moments, correlation_query, decode_moments, encode_moments, merge_completed_windows, merge_moments,
+    moments_matrix, query_key, window_moments
+)
+
+
+def pairwise_correlation(matrix):
+    columns = matrix.shape[1]
+    expected = np.full((columns, columns), np.nan)
+    for i in range(columns):
+        for j in range(columns):
+            rows = np.isfinite(matrix[:, i]) & np.isfinite(matrix[:, j])
+            if rows.sum() >= 2:
+                expected[i, j] = np.corrcoef(matrix[rows, i], matrix[rows, j])[0, 1]
+    return expected
+
+
+class TestWindowMoments:
+    def test_matches_numpy(self):
+        """
+        Blocked moments should give the same correlation and covariance as
+        NumPy for complete data, whatever the block size.
+        """
+        matrix = np.random.default_rng(1).normal(size=(200, 7)) + np.arange(7) * 1000.0
+        for block_size in (1, 3, 7, 64):
+            moments = window_moments(matrix, block_size)
+            assert np.allclose(moments_matrix(moments), np.corrcoef(matrix, rowvar=False))
+            assert np.allclose(moments_matrix(moments, "covariance"), np.cov(matrix, rowvar=False))
+
+    def test_pairwise_missing(self):
+        """
+        Each pair should only use the rows where both channels have values.
+        """
+        rng = np.random.default_rng(2)
+        matrix = rng.normal(size=(120, 5))
+        matrix[rng.random(matrix.shape) < 0.2] = np.nan
+        matrix[:, 4] = np.nan
+        matrix[0, 4] = 1.0
+        moments = window_moments(matrix, 2)
+        assert np.allclose(moments_matrix(moments), pairwise_correlation(matrix), equal_nan=True)
+        assert np.isnan(moments_matrix(moments)[4, 0])
+
+    def test_merge_windows(self):
+        """
+        Merging the moments of consecutive windows should equal computing the
+        moments over all of their rows at once.
+        """
+        rng = np.random.default_rng(3)
+        matrix = rng.normal(size=(300, 4)) * [1.0, 2.0, 3.0, 4.0] + [0.0, 10.0, -5.0, 100.0]
+        matrix[rng.random(matrix.shape) < 0.1] = np.nan
+        merged = merge_moments(merge_moments(window_moments(matrix[:100]), window_moments(matrix[100:250])), window_moments(matrix[250:]))
+        whole = window_moments(matrix)
+        for name in whole:
+            assert np.allclose(merged[name], whole[name])
+
+
+def stored_window(start, columns, matrix):
+    return {"start": start, "columns": columns, "moments": encode_moments(window_moments(matrix))}
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self, key=lambda document: document[field] * direction))
+
+
+class FakeCollection:
+    def __init__(self, documents=None):
+        self.documents = documents or []
+
+    def matches(self, document, query):
+        bounds = query.get("start", {})
+        return ("$lt" not in bounds or document["start"] < bounds["$lt"]) and ("$gt" not in bounds or document["start"] > bounds["$gt"])
+
+    def find(self, query, projection=None):
+        return FakeCursor(document for document in self.documents if self.matches(document, query))
+
+    def find_one(self, query, projection=None, sort=None):
+        documents = self.find(query)
+        if sort is not None:
+            documents = documents.sort(*sort[0])
+        return documents[0] if len(documents) > 0 else None
+
+    def replace_one(self, query, document, upsert=False):
+        self.documents = [document]
+
+
+class TestAccumulateMoments:
+    def test_new_columns(self):
+        """
+        Windows introducing new columns should accumulate to the moments of
+        the union of their columns, missing where a column had no data.
+        """
+        rng = np.random.default_rng(4)
+        first, second = rng.normal(size=(50, 2)), rng.normal(size=(60, 3))
+        columns, total, last = accumulate_moments([
+            stored_window(0, [["a", "x"], ["a", "y"]], first),
+            stored_window(10, [["a", "y"], ["b", "x"], ["a", "x"]], second)
+        ])
+        assert columns == [["a", "x"], ["a", "y"], ["b", "x"]]
+        assert last == 10
+        whole = np.full((110, 3), np.nan)
+        whole[:50, :2] = first
+        whole[50:] = second[:, [2, 0, 1]]
+        for name, values in window_moments(whole).items():
+            assert np.allclose(total[name], values)
+
+
+class TestMergeCompletedWindows:
+    def test_running_total(self):
+        """
+        The running total should hold every window but the latest and only
+        merge windows arriving after it on the next update.
+        """
+        rng = np.random.default_rng(5)
+        matrix = rng.normal(size=(400, 2))
+        columns = [["a", "x"], ["a", "y"]]
+        correlations = FakeCollection([stored_window(start * 10, columns, matrix[start * 100:start * 100 + 100]) for start in range(3)])
+        totals = FakeCollection()
+        assert merge_completed_windows("key", {}, correlations, totals) == 10
+        assert totals.documents[0]["merged"] == 10
+        for name, values in window_moments(matrix[:200]).items():
+            assert np.allclose(decode_moments(totals.documents[0])[name], values)
+        assert merge_completed_windows("key", {}, correlations, totals) is None
+        correlations.documents.append(stored_window(30, columns, matrix[300:]))
+        assert merge_completed_windows("key", {}, correlations, totals) == 20
+        for name, values in window_moments(matrix[:300]).items():
+            assert np.allclose(decode_moments(totals.documents[0])[name], values)
+
+
+class TestCorrelationQuery:
+    def test_key_is_canonical(self):
+        """
+        The order structures and channels are given in should not change the key.
+        """
+        first = correlation_query("bridges", 3600, 1, ["bridge-2", "bridge-1"], ["strain", "acceleration"])
+        second = correlation_query("bridges", 3600, 1, ["bridge-1", "bridge-2"], ["acceleration", "strain"])
+        assert query_key(first) == query_key(second)
+        assert query_key(first) != query_key(correlation_query("bridges", 3600, 2))
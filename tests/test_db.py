@@ -0,0 +1,514 @@
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+from flask import Flask, g
+from pymongo.read_preferences import SecondaryPreferred
+from werkzeug.exceptions import Unauthorized
+
+from pbshm.app import create_app
+from pbshm.db import db_connect, default_collection, read_profile_options
+from pbshm.db import initialise_worker, mongo_client, silo_collection, silo_registry, user_silos, worker_collections
+from pbshm.db import index_drift, redundant_indexes
+from pbshm.db import MemoryCacheBackend, DiskCacheBackend, SharedCacheBackend, QueryCache, cached_query, named_cache
+from pbshm.db import align_channels, channel_query_pipeline, channel_value
+from pbshm.db import BatchLoader, request_loader
+from pbshm.db import Pipeline, plan_summary
+
+
+class TestMemoryCacheBackend:
+    def test_round_trip(self):
+        """
+        A stored value should be returned for the same key and version.
+        """
+        cache = QueryCache(MemoryCacheBackend(1024), 0)
+        cache.set("key", "v1", [{"population": "bridges"}])
+        assert cache.get("key", "v1") == [{"population": "bridges"}]
+
+    def test_version_change_invalidates(self):
+        """
+        A change in the collection data version should invalidate the entry.
+        """
+        cache = QueryCache(MemoryCacheBackend(1024), 0)
+        cache.set("key", "v1", [1, 2, 3])
+        assert cache.get("key", "v2") is None
+        assert cache.get("key", "v1") is None
+
+    def test_ttl_expiry(self):
+        """
+        Entries should expire once their time to live has passed.
+        """
+        cache = QueryCache(MemoryCacheBackend(1024), 0)
+        cache.set("key", "v1", [1, 2, 3], ttl=0.01)
+        time.sleep(0.02)
+        assert cache.get("key", "v1") is None
+
+    def test_lru_eviction_bounds_memory(self):
+        """
+        The least recently used entries should be evicted to stay within bounds.
+        """
+        backend = MemoryCacheBackend(256)
+        cache = QueryCache(backend, 0)
+        for index in range(32):
+            cache.set(str(index), "v1", list(range(10)))
+            cache.get("0", "v1")
+        assert backend.size <= 256
+        assert cache.get("0", "v1") is not None
+        assert cache.get("1", "v1") is None
+
+    def test_cached_none_is_hit(self):
+        """
+        A cached None should be returned as a hit rather than the miss default.
+        """
+        cache, miss = QueryCache(MemoryCacheBackend(1024), 0), object()
+        cache.set("key", "v1", None)
+        assert cache.get("key", "v1", miss) is None
+        assert cache.get("other", "v1", miss) is miss
+        assert cache.hits == 1 and cache.misses == 1
+
+
+class TestDiskCacheBackend:
+    def test_round_trip(self, tmp_path):
+        """
+        A stored value should be readable from a second backend on the same file.
+        """
+        QueryCache(DiskCacheBackend(str(tmp_path / "cache.sqlite"), 4096), 0).set("key", "v1", {"a": 1})
+        assert QueryCache(DiskCacheBackend(str(tmp_path / "cache.sqlite"), 4096), 0).get("key", "v1") == {"a": 1}
+
+    def test_eviction_bounds_size(self, tmp_path):
+        """
+        The on-disk cache should evict entries once the size bound is exceeded.
+        """
+        cache = QueryCache(DiskCacheBackend(str(tmp_path / "cache.sqlite"), 512), 0)
+        for index in range(32):
+            cache.set(str(index), "v1", list(range(10)))
+        assert cache.get("31", "v1") is not None
+        assert cache.get("0", "v1") is None
+
+    def test_connections_closed(self, tmp_path):
+        """
+        Every operation should close the connection it opened.
+        """
+        backend = DiskCacheBackend(str(tmp_path / "cache.sqlite"), 4096)
+        connections, connect = [], backend.connect
+        backend.connect = lambda: connections.append(connect()) or connections[-1]
+        cache = QueryCache(backend, 0)
+        cache.set("key", "v1", {"a": 1})
+        assert cache.get("key", "v1") == {"a": 1}
+        backend.delete("key")
+        backend.clear()
+        assert len(connections) == 4
+        for connection in connections:
+            with pytest.raises(sqlite3.ProgrammingError):
+                connection.execute("SELECT 1")
+
+
+class TestSharedCacheBackend:
+    def test_shared_between_backends(self, tmp_path):
+        """
+        A value stored through one mapping should be readable through another
+        mapping of the same file, as it would be from another worker.
+        """
+        path = str(tmp_path / "cache.mmap")
+        QueryCache(SharedCacheBackend(path, 4096, 16), 0).set("key", "v1", {"a": 1})
+        assert QueryCache(SharedCacheBackend(path, 4096, 16), 0).get("key", "v1") == {"a": 1}
+
+    def test_overwritten_entries_evicted(self, tmp_path):
+        """
+        Once the data area wraps, the oldest entries should be gone and the
+        newest still readable.
+        """
+        cache = QueryCache(SharedCacheBackend(str(tmp_path / "cache.mmap"), 512, 64), 0)
+        for index in range(32):
+            cache.set(str(index), "v1", list(range(10)))
+        assert cache.get("31", "v1") == list(range(10))
+        assert cache.get("0", "v1") is None
+
+    def test_clear_invalidates_every_mapping(self, tmp_path):
+        """
+        Clearing through one mapping should invalidate entries for all of them.
+        """
+        path = str(tmp_path / "cache.mmap")
+        first, second = QueryCache(SharedCacheBackend(path, 4096, 16), 0), QueryCache(SharedCacheBackend(path, 4096, 16), 0)
+        first.set("key", "v1", [1, 2, 3])
+        second.clear()
+        assert first.get("key", "v1") is None
+        first.set("key", "v1", [4])
+        assert second.get("key", "v1") == [4]
+
+    def test_layout_change_leaves_live_mapping(self, tmp_path):
+        """
+        Opening the cache with a different size should start an empty cache in
+        a new file while an existing mapping of the old layout keeps working.
+        """
+        path = str(tmp_path / "cache.mmap")
+        first = QueryCache(SharedCacheBackend(path, 1024 * 1024, 16), 0)
+        first.set("key", "v1", 1)
+        assert QueryCache(SharedCacheBackend(path, 4096, 16), 0).get("key", "v1") is None
+        first.set("other", "v1", list(range(1000)))
+        assert first.get("other", "v1") == list(range(1000))
+        assert QueryCache(SharedCacheBackend(path, 1024 * 1024, 16), 0).get("key", "v1") == 1
+
+
+class TestNamedCache:
+    def test_shared_between_apps(self, tmp_path):
+        """
+        A named cache configured as shared should see the writes and
+        invalidations made through another process's mapping of the same file.
+        """
+        apps = [Flask(__name__, instance_path=str(tmp_path)) for _ in range(2)]
+        for app in apps:
+            app.config["CACHES"] = {"users": {"backend": "shared", "max_bytes": 4096, "slots": 16}}
+        with apps[0].app_context():
+            first = named_cache("users")
+        with apps[1].app_context():
+            second = named_cache("users")
+        assert first is not second
+        first.set("user", "", {"enabled": True})
+        assert second.get("user", "") == {"enabled": True}
+        second.backend.delete("user")
+        assert first.get("user", "") is None
+
+    def test_defaults_to_memory(self, tmp_path):
+        """
+        A cache without configuration should be held in memory per process.
+        """
+        app = Flask(__name__, instance_path=str(tmp_path))
+        app.config["CACHES"] = {}
+        with app.app_context():
+            assert isinstance(named_cache("diagnostics").backend, MemoryCacheBackend)
+            assert named_cache("diagnostics") is named_cache("diagnostics")
+
+
+class VersionedCollection:
+    """
+    Minimal stand-in counting the data version checks of a collection.
+    """
+    full_name = "unittest.structures"
+
+    def __init__(self):
+        self.checks = 0
+
+    def find_one(self, filter, projection=None, sort=None):
+        self.checks += 1
+        return None
+
+
+class TestCachedQuery:
+    def test_version_checked_once_per_request(self, tmp_path):
+        """
+        Cached queries of one request should check the collection data version once.
+        """
+        app = Flask(__name__, instance_path=str(tmp_path))
+        app.config.update({"CACHES": {}, "QUERY_CACHE_ENABLED": True, "QUERY_CACHE_VERSION_CHECK": True})
+        collection = VersionedCollection()
+        with app.test_request_context():
+            for key in ["first", "second", "first"]:
+                assert cached_query(collection, key, lambda: key, cache="unittest") == key
+            assert collection.checks == 1
+        with app.test_request_context():
+            cached_query(collection, "first", lambda: "first", cache="unittest")
+            assert collection.checks == 2
+
+
+class TestChannelLoader:
+    def test_pipeline_filters_channels(self):
+        """
+        Requested channel names should be matched and filtered on the server.
+        """
+        pipeline = channel_query_pipeline("bridges", "bridge-1", 0, 100, ["strain"])
+        assert pipeline[0]["$match"] == {
+            "population": "bridges", "name": "bridge-1",
+            "timestamp": {"$gte": 0, "$lt": 100}, "channels.name": {"$in": ["strain"]}
+        }
+        assert pipeline[1] == {"$sort": {"timestamp": 1}}
+
+    def test_channel_value(self):
+        """
+        Numeric values are returned directly and summary objects by statistic.
+        """
+        assert channel_value(4, "mean") == 4.0
+        assert channel_value({"min": 1, "mean": 2.5}, "mean") == 2.5
+        assert np.isnan(channel_value("text", "mean"))
+
+    def test_align_channels(self):
+        """
+        Channels should be interpolated onto the common grid, with NaN outside
+        the range of their samples.
+        """
+        timestamps = np.array([1700000000000000000, 1700000000000000010, 1700000000000000020], dtype=np.int64)
+        values = {"a": np.array([0.0, 1.0, 2.0]), "b": np.array([np.nan, 4.0, 6.0])}
+        grid, aligned = align_channels(timestamps, values, 5)
+        assert grid.dtype == np.int64
+        assert list(grid - grid[0]) == [0, 5, 10, 15, 20]
+        assert np.allclose(aligned["a"], [0.0, 0.5, 1.0, 1.5, 2.0])
+        assert np.isnan(aligned["b"][0])
+        assert np.allclose(aligned["b"][2:], [4.0, 5.0, 6.0])
+
+
+class TestReadProfiles:
+    def test_analytics_profile_collection(self, app):
+        """
+        The analytics profile should route reads to secondaries with its read concern.
+        """
+        with app.test_request_context():
+            collection = default_collection("analytics")
+            assert collection.read_preference.mode == SecondaryPreferred().mode
+            assert collection.read_preference.max_staleness == app.config["READ_PROFILES"]["analytics"]["max_staleness"]
+            assert default_collection("analytics") is collection
+
+    def test_profile_options(self, app):
+        """
+        The profile should provide maxTimeMS for individual operations.
+        """
+        with app.test_request_context():
+            assert read_profile_options("analytics") == {"maxTimeMS": app.config["READ_PROFILES"]["analytics"]["max_time_ms"]}
+            assert read_profile_options(None) == {}
+
+    def test_configured_profiles_merged(self):
+        """
+        Configured profiles should be merged over the built-in ones, so the
+        analytics profile remains available.
+        """
+        app = create_app(test_config={"READ_PROFILES": {"reporting": {"read_preference": "secondary"}}})
+        assert set(app.config["READ_PROFILES"]) == {"analytics", "reporting"}
+
+    def test_unknown_profile(self, app):
+        """
+        Requesting an unconfigured profile should raise.
+        """
+        with app.test_request_context():
+            with pytest.raises(KeyError):
+                default_collection("unittest-missing")
+
+
+class TestSilos:
+    def test_shared_client_per_uri(self, app):
+        """
+        Requests should share one client per cluster instead of creating their own.
+        """
+        with app.test_request_context():
+            first = db_connect().client
+        with app.test_request_context():
+            assert db_connect().client is first
+            assert mongo_client(app.config["MONGODB_URI"]) is first
+
+    def test_worker_collections_share_client(self, app):
+        """
+        Worker processes should resolve their collections through the shared client, leaving unused roles as None.
+        """
+        initialise_worker(app.config["MONGODB_URI"], app.config["PBSHM_DATABASE"], {"source": app.config["DEFAULT_COLLECTION"], "target": None})
+        assert worker_collections["source"].name == app.config["DEFAULT_COLLECTION"]
+        assert worker_collections["source"].database.client is mongo_client(app.config["MONGODB_URI"])
+        assert worker_collections["target"] is None
+
+    def test_default_silo_always_available(self, app):
+        """
+        The default collection should always be accessible as the default silo.
+        """
+        with app.test_request_context():
+            g.user = None
+            assert user_silos() == ["default"]
+            assert silo_collection("default").name == app.config["DEFAULT_COLLECTION"]
+
+    def test_configured_silo_requires_permission(self, app):
+        """
+        A configured silo should be refused to users without its permission.
+        """
+        app.config["SILOS"] = {"unittest_silo": {"collection": "unittest_silo_structures"}}
+        with app.test_request_context():
+            g.user = None
+            assert silo_registry()["unittest_silo"]["permission"] == "silo-unittest_silo"
+            with pytest.raises(Unauthorized):
+                silo_collection("unittest_silo")
+
+
+class TestIndexRegistry:
+    declared = [
+        {"collection": "USER_COLLECTION", "keys": [("emailAddress", 1)], "name": "emailAddress_1", "options": {"unique": True}},
+        {"collection": "USER_COLLECTION", "keys": [("enabled", 1)], "name": "enabled_1", "options": {}}
+    ]
+
+    def test_missing_index(self):
+        """
+        Declared indexes without an index on the same keys should be missing.
+        """
+        missing, drifted, undeclared = index_drift(self.declared, {"_id_": {"key": [("_id", 1)]}})
+        assert [index["name"] for index in missing] == ["emailAddress_1", "enabled_1"]
+        assert drifted == [] and undeclared == []
+
+    def test_drifted_and_undeclared(self):
+        """
+        Option differences should be drift and unknown indexes undeclared.
+        """
+        missing, drifted, undeclared = index_drift(self.declared, {
+            "_id_": {"key": [("_id", 1)]},
+            "emailAddress_1": {"key": [("emailAddress", 1)]},
+            "enabled_1": {"key": [("enabled", 1)]},
+            "firstName_1": {"key": [("firstName", 1)]}
+        })
+        assert missing == []
+        assert drifted[0][0]["name"] == "emailAddress_1"
+        assert undeclared == ["firstName_1"]
+
+    def test_redundant_prefix(self):
+        """
+        An index whose keys prefix another index should be redundant unless unique.
+        """
+        indexes = {
+            "_id_": [("_id", 1)],
+            "population_1": [("population", 1)],
+            "population_1_name_1": [("population", 1), ("name", 1)],
+            "unique_population": [("population", 1)]
+        }
+        assert redundant_indexes(indexes, {"unique_population"}) == [("population_1", "population_1_name_1")]
+
+
+class CountingCollection:
+    """
+    Minimal stand-in recording each find issued by a loader.
+    """
+    full_name = "unittest.structures"
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        ((field, condition),) = query.items()
+        return [document for document in self.documents if document.get(field) in condition["$in"]]
+
+
+class TestBatchLoader:
+    documents = [
+        {"_id": 1, "name": "bridge-1", "population": "bridges"},
+        {"_id": 2, "name": "bridge-2", "population": "bridges"},
+        {"_id": 3, "name": "turbine-1", "population": "turbines"}
+    ]
+
+    def test_deferred_loads_coalesced(self):
+        """
+        Lookups queued before the first access should be fetched in one $in query.
+        """
+        collection = CountingCollection(self.documents)
+        loader = BatchLoader(collection)
+        rows = [loader.load(identifier) for identifier in [1, 2, 4]]
+        assert [row.get("name") for row in rows] == ["bridge-1", "bridge-2", None]
+        assert len(collection.queries) == 1
+        assert sorted(collection.queries[0]["_id"]["$in"]) == [1, 2, 4]
+
+    def test_memoised(self):
+        """
+        Values already loaded should not be queried again.
+        """
+        collection = CountingCollection(self.documents)
+        loader = BatchLoader(collection)
+        loader.load_many([1, 2])
+        assert loader.load(1)["name"] == "bridge-1"
+        assert loader.load_many([2, 3])[1]["name"] == "turbine-1"
+        assert collection.queries[1] == {"_id": {"$in": [3]}}
+
+    def test_many(self):
+        """
+        With many every matching document should be returned.
+        """
+        loader = BatchLoader(CountingCollection(self.documents), "population", many=True)
+        assert [document["_id"] for document in loader.load("bridges").value] == [1, 2]
+        assert loader.load("towers").value == []
+
+    def test_request_scoped(self, app):
+        """
+        The same loader should be shared within a request and not across requests.
+        """
+        collection = CountingCollection(self.documents)
+        with app.test_request_context():
+            assert request_loader(collection) is request_loader(collection)
+            first = request_loader(collection)
+        with app.test_request_context():
+            assert request_loader(collection) is not first
+
+
+class TestPipeline:
+    def test_matches_hoisted_and_merged(self):
+        """
+        Structure, time and channel matches added after other stages should be
+        merged into a single leading match.
+        """
+        stages = (
+            Pipeline()
+            .sort(timestamp=1)
+            .channels(["strain"])
+            .structures("bridges", "bridge-1")
+            .time_range(0, 100)
+            .build()
+        )
+        assert stages[0] == {"$match": {
+            "channels.name": {"$in": ["strain"]},
+            "population": "bridges",
+            "name": "bridge-1",
+            "timestamp": {"$gte": 0, "$lt": 100}
+        }}
+        assert stages[1] == {"$sort": {"timestamp": 1}}
+
+    def test_match_not_moved_past_group(self):
+        """
+        A match on a grouped field must stay after the group.
+        """
+        stages = Pipeline().group("$population", count={"$sum": 1}).match(count={"$gt": 1}).build()
+        assert "$group" in stages[-2] and "$match" in stages[-1]
+
+    def test_match_not_moved_past_computed_field(self):
+        """
+        A match on a field computed by an earlier stage must stay after it.
+        """
+        stages = Pipeline().stage({"$set": {"name": {"$toUpper": "$name"}}}).match(name="BRIDGE-1").build()
+        assert "$set" in stages[0]
+
+    def test_projection_pushed_down(self):
+        """
+        Only the fields read by the group should be projected after the match.
+        """
+        stages = (
+            Pipeline()
+            .structures("bridges")
+            .group("$name", documents={"$sum": 1}, latest={"$max": "$timestamp"})
+            .build()
+        )
+        assert stages[1] == {"$project": {"name": 1, "timestamp": 1, "_id": 0}}
+
+    def test_projection_keeps_accumulator_sort_fields(self):
+        """
+        Fields only named in the sortBy of a $top accumulator must be projected.
+        """
+        stages = Pipeline().structures("b").group("$name", latest={"$top": {"sortBy": {"timestamp": -1}, "output": "$channels"}}).build()
+        assert stages[1] == {"$project": {"channels": 1, "name": 1, "timestamp": 1, "_id": 0}}
+
+    def test_projection_keeps_lookup_variables(self):
+        """
+        Fields only referenced by the let variables of a $lookup must be projected.
+        """
+        stages = (
+            Pipeline()
+            .structures("b")
+            .stage({"$lookup": {"from": "events", "let": {"t": "$timestamp"}, "pipeline": [{"$match": {"$expr": {"$eq": ["$start", "$$t"]}}}], "as": "events"}})
+            .group("$name", events={"$push": "$events"})
+            .build()
+        )
+        assert stages[1] == {"$project": {"events": 1, "name": 1, "timestamp": 1, "_id": 0}}
+
+    def test_no_projection_when_document_returned(self):
+        """
+        Pipelines returning whole documents should not gain a projection.
+        """
+        stages = Pipeline().structures("bridges").sort(timestamp=-1).limit(5).build()
+        assert not any("$project" in stage for stage in stages)
+
+    def test_plan_summary(self):
+        """
+        Collection scans and index names should be found anywhere in a plan.
+        """
+        plan = {"stages": [{"$cursor": {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "pbshm_framework_channel"}}}}}]}
+        assert plan_summary(plan) == (False, {"pbshm_framework_channel"})
+        assert plan_summary({"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}) == (True, set())
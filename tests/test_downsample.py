@@ -0,0 +1,65 @@
+import numpy as np
+
+from pbshm.downsample import bucket_pipeline, downsample_channel, lttb
+
+
+class TestLTTB:
+    def test_returns_threshold_points(self):
+        """
+        The reduction should return exactly threshold ordered indices including
+        the first and last points.
+        """
+        x = np.arange(10000)
+        indices = lttb(x, np.sin(x / 300), 100)
+        assert len(indices) == 100
+        assert indices[0] == 0 and indices[-1] == 9999
+        assert np.all(np.diff(indices) > 0)
+
+    def test_keeps_spike(self):
+        """
+        A single outlying sample should be preserved by the reduction.
+        """
+        x = np.arange(10000)
+        y = np.zeros(10000)
+        y[5000] = 10.0
+        assert 5000 in lttb(x, y, 50)
+
+    def test_short_series_unchanged(self):
+        """
+        A series shorter than the threshold should be returned in full.
+        """
+        assert list(lttb(np.arange(5), np.arange(5), 10)) == [0, 1, 2, 3, 4]
+
+
+class TestBucketPipeline:
+    def test_match_leads_pipeline(self):
+        """
+        The pipeline should start with an index friendly match on the range.
+        """
+        pipeline = bucket_pipeline("bridges", "bridge-1", "strain", 0, 1000, 10)
+        assert pipeline[0]["$match"]["timestamp"] == {"$gte": 0, "$lt": 1000}
+        assert pipeline[0]["$match"]["channels.name"] == "strain"
+
+    def test_bucket_width(self):
+        """
+        The bucket width should divide the range into the requested number of buckets.
+        """
+        pipeline = bucket_pipeline("bridges", "bridge-1", "strain", 0, 1000, 10)
+        group_id = pipeline[3]["$group"]["_id"]["$toLong"]["$divide"]
+        assert group_id[1] == 100
+
+
+class TestDownsampleChannel:
+    def test_empty_structure_keys(self, monkeypatch):
+        """
+        An empty structure should give the same keys as any other bucket
+        result, with empty arrays.
+        """
+        monkeypatch.setattr("pbshm.downsample.downsample.channel_time_range", lambda *args: None)
+        monkeypatch.setattr("pbshm.downsample.downsample.cached_aggregate", lambda collection, pipeline: [
+            {"timestamp": 5, "min": 1.0, "max": 2.0, "mean": 1.5, "count": 2}
+        ])
+        empty = downsample_channel("bridges", "bridge-1", "strain", method="bucket", collection=object())
+        result = downsample_channel("bridges", "bridge-1", "strain", 0, 10, method="bucket", collection=object())
+        assert set(empty) == set(result)
+        assert all(len(values) == 0 for values in empty.values())
@@ -0,0 +1,53 @@
+import numpy as np
+
+from pbshm.features import FEATURES, feature, feature_partitions, task_key
+
+
+@feature("unittest_mean", channels=["strain"])
+def unittest_mean(timestamps, values):
+    return {"mean": np.nanmean(values["strain"])}
+
+
+class StructureSpans:
+    """
+    Minimal stand-in returning the per-structure time spans the partitioner asks for.
+    """
+    def aggregate(self, pipeline, **kwargs):
+        return [{"_id": {"population": "bridges", "name": "bridge-1"}, "start": 5, "end": 99}]
+
+
+class TestRegisterFeature:
+    def test_decorator_registers(self):
+        """
+        The decorator should register the function and its channels.
+        """
+        assert FEATURES["unittest_mean"]["function"] is unittest_mean
+        assert FEATURES["unittest_mean"]["channels"] == ["strain"]
+
+
+class TestFeaturePartitions:
+    def test_windows_aligned(self):
+        """
+        Windows should be aligned to multiples of the window size and grouped
+        into tasks per structure.
+        """
+        tasks = feature_partitions(StructureSpans(), 25, windows_per_task=2)
+        assert [task["windows"] for task in tasks] == [[0, 25], [50, 75]]
+        assert all(task["name"] == "bridge-1" for task in tasks)
+
+    def test_range_limits(self):
+        """
+        Start and end should restrict the windows considered.
+        """
+        tasks = feature_partitions(StructureSpans(), 25, start=30, end=60)
+        assert [task["windows"] for task in tasks] == [[25, 50]]
+
+
+class TestTaskKey:
+    def test_window_in_key(self):
+        """
+        Tasks of the same feature at different window lengths should not share
+        a checkpoint even when their first windows coincide.
+        """
+        task = {"population": "bridges", "name": "bridge-1", "windows": [0, 3600]}
+        assert task_key("unittest_mean", 3600, task) != task_key("unittest_mean", 7200, task)
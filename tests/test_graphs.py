@@ -0,0 +1,99 @@
+from pbshm.graphs import compare_group, invariant_key, isomorphic, model_hash, model_invariants
+
+
+def beam_model(names, supports=("ground", "ground"), joint="perfect"):
+    """
+    A beam of two elements joined to each other and to two supports.
+    """
+    return {
+        "name": "beam",
+        "description": "Two element beam",
+        "population": "beams",
+        "irreducibleElement": {
+            "elements": [
+                {"name": names[0], "type": "regular", "contextual": {"type": "beam"}, "geometry": {"type": "beam"}},
+                {"name": names[1], "type": "regular", "contextual": {"type": "beam"}, "geometry": {"type": "beam"}},
+                {"name": names[2], "type": supports[0]},
+                {"name": names[3], "type": supports[1]}
+            ],
+            "relationships": [
+                {"name": "joint", "type": joint, "elements": [{"name": names[0]}, {"name": names[1]}]},
+                {"name": "left", "type": "boundary", "elements": [{"name": names[2]}, {"name": names[0]}]},
+                {"name": "right", "type": "boundary", "elements": [{"name": names[1]}, {"name": names[3]}]}
+            ]
+        }
+    }
+
+
+class TestModelInvariants:
+    def test_invariants(self):
+        """
+        Histograms and degree sequence should describe the model graph.
+        """
+        invariants = model_invariants(beam_model(["a", "b", "c", "d"]))
+        assert invariants["element_count"] == 4
+        assert invariants["relationship_count"] == 3
+        assert invariants["relationship_types"] == {"relationship:boundary": 2, "relationship:perfect": 1}
+        assert invariants["degree_sequence"] == [2, 2, 1, 1]
+
+    def test_flattened_model(self):
+        """
+        Models holding their elements and relationships directly should give
+        the same invariants as the schema's irreducibleElement form.
+        """
+        model = beam_model(["a", "b", "c", "d"])
+        flattened = {"name": model["name"], **model["irreducibleElement"]}
+        assert model_invariants(flattened) == model_invariants(model)
+
+    def test_renaming_preserves_colour_hash(self):
+        """
+        Renaming and reordering elements should not change the invariants,
+        though it does change the document hash.
+        """
+        first = beam_model(["a", "b", "c", "d"])
+        second = beam_model(["x", "y", "z", "w"])
+        second["irreducibleElement"]["elements"].reverse()
+        assert model_hash(first) != model_hash(second)
+        assert invariant_key(model_invariants(first)) == invariant_key(model_invariants(second))
+        assert isomorphic(model_invariants(first), model_invariants(second))
+
+    def test_different_relationship_not_isomorphic(self):
+        """
+        Changing a relationship type should separate the models.
+        """
+        first = model_invariants(beam_model(["a", "b", "c", "d"]))
+        second = model_invariants(beam_model(["a", "b", "c", "d"], joint="connection"))
+        assert not isomorphic(first, second)
+
+    def test_non_document_fields(self):
+        """
+        Elements whose contextual, geometry or material are not documents should be labelled without them.
+        """
+        model = beam_model(["a", "b", "c", "d"])
+        model["irreducibleElement"]["elements"][0].update({"contextual": "beam", "geometry": None, "material": []})
+        assert model_invariants(model)["labels"][0] == "element:regular:::"
+
+    def test_large_model(self):
+        """
+        Matching should not be limited by the recursion limit on large models.
+        """
+        names = ["element-{index}".format(index=index) for index in range(2000)]
+        pairs = {
+            "elements": [{"name": name, "type": "regular"} for name in names],
+            "relationships": [{"type": "perfect", "elements": [first, second]} for first, second in zip(names[0::2], names[1::2])]
+        }
+        reordered = {"elements": list(reversed(pairs["elements"])), "relationships": list(reversed(pairs["relationships"]))}
+        assert isomorphic(model_invariants(pairs), model_invariants(reordered))
+
+
+class TestCompareGroup:
+    def test_classes(self):
+        """
+        Isomorphic models should be collected into the same class.
+        """
+        group = [
+            (("bridge-1", "beam"), model_invariants(beam_model(["a", "b", "c", "d"]))),
+            (("bridge-2", "beam"), model_invariants(beam_model(["e", "f", "g", "h"]))),
+            (("bridge-3", "beam"), model_invariants(beam_model(["a", "b", "c", "d"], supports=("ground", "regular"))))
+        ]
+        assert compare_group(group) == [[("bridge-1", "beam"), ("bridge-2", "beam")], [("bridge-3", "beam")]]
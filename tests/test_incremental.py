@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+from flask import Flask
+
+from pbshm.incremental import COMPUTATIONS, compute_windows, pending_windows, register_computation, run_computation
+
+
+def unittest_peak(timestamps, values):
+    return {"peak": float(np.nanmax(values["strain"]))}
+
+
+@pytest.fixture
+def peak_computation():
+    register_computation("unittest_peak", unittest_peak, window=10, channels=["strain"])
+    yield COMPUTATIONS["unittest_peak"]
+    COMPUTATIONS.pop("unittest_peak", None)
+
+
+class FakeCollection:
+    def __init__(self, documents=None):
+        self.documents = documents or []
+        self.calls = []
+
+    def aggregate(self, pipeline, **kwargs):
+        self.calls.append(("aggregate", pipeline))
+        return iter(self.documents)
+
+    def find_one(self, query, projection=None, sort=None):
+        self.calls.append(("find_one", query))
+        return {"timestamp": 13}
+
+    def find(self, query, projection=None):
+        self.calls.append(("find", query))
+        return iter(self.documents)
+
+    def bulk_write(self, operations, ordered=True):
+        self.calls.append(("bulk_write", operations))
+
+    def update_one(self, query, update, upsert=False):
+        self.calls.append(("update_one", query, update))
+
+
+class TestRegisterComputation:
+    def test_registers(self, peak_computation):
+        """
+        Registering should store the function and its window.
+        """
+        assert peak_computation["function"] is unittest_peak
+        assert peak_computation["window"] == 10
+
+
+class TestPendingWindows:
+    def test_first_run(self):
+        """
+        Without a watermark every complete window from the first timestamp
+        should be pending, aligned to multiples of the window size.
+        """
+        assert pending_windows(None, 13, 45, 10) == [10, 20, 30]
+
+    def test_after_watermark(self):
+        """
+        Only complete windows after the watermark should be pending.
+        """
+        assert pending_windows(30, 13, 45, 10) == [30]
+        assert pending_windows(40, 13, 45, 10) == []
+        assert pending_windows(30, 13, 70, 10) == [30, 40, 50, 60]
+
+    def test_lateness(self):
+        """
+        A window should wait until data has arrived lateness past its end.
+        """
+        assert pending_windows(30, 13, 45, 10, lateness=6) == []
+        assert pending_windows(30, 13, 45, 10, lateness=5) == [30]
+
+
+class TestComputeWindows:
+    def test_keyed_documents(self, monkeypatch, peak_computation):
+        """
+        Each window with data should produce a document keyed by computation,
+        structure and window start; empty windows should produce nothing.
+        """
+        timestamps = np.array([10, 15, 31, 35], dtype=np.int64)
+        monkeypatch.setattr("pbshm.incremental.incremental.load_channel_arrays", lambda *args, **kwargs: (timestamps, {"strain": np.array([1.0, 4.0, 2.0, 3.0])}))
+        documents = compute_windows("unittest_peak", peak_computation, "bridges", "bridge-1", [10, 20, 30], None)
+        assert [document["_id"] for document in documents] == [
+            {"computation": "unittest_peak", "population": "bridges", "name": "bridge-1", "start": start} for start in (10, 30)
+        ]
+        assert [document["values"]["peak"] for document in documents] == [4.0, 3.0]
+
+
+class TestRunComputation:
+    def run(self, monkeypatch, watermarks):
+        collection = FakeCollection([{"_id": {"population": "bridges", "name": "bridge-1"}, "latest": 45}])
+        collections = {"results": FakeCollection(), "watermarks": FakeCollection(watermarks)}
+        monkeypatch.setattr("pbshm.incremental.incremental.default_collection", lambda: collection)
+        monkeypatch.setattr("pbshm.incremental.incremental.db_connect", lambda: collections)
+        monkeypatch.setattr("pbshm.incremental.incremental.load_channel_arrays", lambda *args, **kwargs: (
+            np.array([13, 25, 31], dtype=np.int64), {"strain": np.array([1.0, 2.0, 3.0])}
+        ))
+        app = Flask(__name__)
+        app.config.update(INCREMENTAL_COLLECTION="results", INCREMENTAL_WATERMARK_COLLECTION="watermarks", INCREMENTAL_WINDOWS_PER_LOAD=2)
+        with app.app_context():
+            processed = run_computation("unittest_peak", progress=lambda message: None)
+        return processed, collection, collections
+
+    def test_first_run(self, monkeypatch, peak_computation):
+        """
+        Without a watermark the first timestamp should be looked up once and
+        every complete window written in batches before the watermark advances.
+        """
+        processed, collection, collections = self.run(monkeypatch, [])
+        assert processed == 3
+        assert [call[0] for call in collection.calls] == ["aggregate", "find_one"]
+        written = [call for call in collections["results"].calls if call[0] == "bulk_write"]
+        assert [len(call[1]) for call in written] == [2, 1]
+        watermarks = [call[2]["$set"]["watermark"] for call in collections["watermarks"].calls if call[0] == "update_one"]
+        assert watermarks == [30, 40]
+
+    def test_watermark_skips_first(self, monkeypatch, peak_computation):
+        """
+        With a watermark only the latest timestamps should be read, and only
+        the windows after it processed.
+        """
+        processed, collection, collections = self.run(monkeypatch, [{
+            "_id": {"computation": "unittest_peak", "population": "bridges", "name": "bridge-1"}, "watermark": 30
+        }])
+        assert processed == 1
+        assert [call[0] for call in collection.calls] == ["aggregate"]
@@ -239,4 +239,67 @@ class TestInitialiseSubSystemNewRootUser:
         users = user_collection().count_documents({})
         assert result.output
         assert result.exit_code == 0  # Doesn't raise an error when adding the same name
-        assert users == 2  # The user with the same email shouldn't have been added.
\ No newline at end of file
+        assert users == 2  # The user with the same email shouldn't have been added.
+
+
+@pytest.mark.dependency(depends=["TestInitialiseSubSystemDB"])
+class TestInitialiseSubSystemIndexes:
+    @pytest.mark.dependency()
+    def test_cli_call(self, runner):
+        """
+        Tests for successful execution.
+        """
+        result = runner.invoke(args=["init", "indexes"])
+        assert result.exit_code == 0
+
+    @pytest.mark.dependency(depends=["TestInitialiseSubSystemIndexes::test_cli_call"])
+    def test_sync_is_idempotent(self, runner):
+        """
+        Running the sync again should not report any missing or drifted indexes.
+        """
+        result = runner.invoke(args=["init", "indexes"])
+        assert result.exit_code == 0
+        assert "creating" not in result.output
+        assert "drifted" not in result.output
+
+    @pytest.mark.dependency(depends=["TestInitialiseSubSystemIndexes::test_cli_call"])
+    def test_index_usage_report(self, runner):
+        """
+        Tests for successful execution of the index usage report.
+        """
+        result = runner.invoke(args=["init", "index-usage"])
+        assert result.exit_code == 0
+
+
+@pytest.mark.dependency(depends=["TestInitialiseSubSystemDB"])
+class TestInitialiseSubSystemImportUsers:
+    @pytest.mark.dependency()
+    def test_cli_call(self, runner, tmp_path):
+        """
+        Imports a JSON file containing a valid user, an invalid user, a row
+        duplicating an earlier row and a row duplicating an existing user.
+        """
+        path = tmp_path / "users.json"
+        path.write_text(json.dumps([
+            {"emailAddress": "imported.user@pbshm.test", "password": "ImportedPassword", "firstName": "Imported", "secondName": "User"},
+            {"emailAddress": "short", "password": "ImportedPassword", "firstName": "Invalid", "secondName": "User"},
+            {"emailAddress": "imported.user@pbshm.test", "password": "ImportedPassword", "firstName": "Repeated", "secondName": "User"},
+            {"emailAddress": os.environ["PBSHM_USERNAME"], "password": "ImportedPassword", "firstName": "Existing", "secondName": "User"}
+        ]))
+        result = runner.invoke(args=["init", "import-users", str(path), "--processes", "2"])
+        assert result.exit_code == 0
+        assert "Row 2: invalid" in result.output
+        assert "Row 3: invalid, emailAddress duplicates an earlier row" in result.output
+        assert "Row 4: duplicate" in result.output
+        assert "Imported 1 of 2 users" in result.output
+
+    @pytest.mark.dependency(depends=["TestInitialiseSubSystemImportUsers::test_cli_call"])
+    def test_user_password_hashed(self):
+        """
+        The imported user should be stored with a hashed password and defaults.
+        """
+        user = user_collection().find_one({"emailAddress": "imported.user@pbshm.test"})
+        assert user is not None
+        assert user["password"].startswith("scrypt:")
+        assert user["permissions"] == []
+        assert user["enabled"] == True
@@ -0,0 +1,170 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+import pytest
+
+from pbshm.jobs import JobWorker, enqueue_job, jobs_collection, register_job_type
+
+attempts = []
+
+
+def unittest_add(job):
+    job.progress(0.5, "Adding")
+    return job.parameters["a"] + job.parameters["b"]
+
+
+def unittest_flaky(job):
+    attempts.append(job.attempt)
+    if len(attempts) < 2:
+        raise RuntimeError("First attempt fails")
+    return "recovered"
+
+
+def unittest_unencodable(job):
+    return object()
+
+
+register_job_type("unittest-add", unittest_add)
+register_job_type("unittest-flaky", unittest_flaky, retries=1)
+register_job_type("unittest-unencodable", unittest_unencodable)
+register_job_type("unittest-single", unittest_add, concurrency=1)
+
+
+def wait_for_job(app, job_id, timeout=10):
+    """
+    Polls the job until it leaves the queue or the timeout elapses.
+    """
+    deadline = time.monotonic() + timeout
+    with app.app_context():
+        while time.monotonic() < deadline:
+            job = jobs_collection().find_one({"_id": ObjectId(job_id)})
+            if job["status"] in ["complete", "failed"]:
+                return job
+            time.sleep(0.1)
+    return job
+
+
+@pytest.fixture
+def worker(app):
+    app.config.update({"JOBS_COLLECTION": "unittest_jobs", "JOBS_POLL_INTERVAL": 0.1})
+    worker = JobWorker(app, 1, ["unittest-add", "unittest-flaky", "unittest-unencodable"])
+    worker.start()
+    yield worker
+    worker.stop()
+
+
+class TestJobQueue:
+    def test_job_completes(self, app, worker):
+        """
+        An enqueued job should be executed by the worker and store its result.
+        """
+        with app.app_context():
+            job_id = enqueue_job("unittest-add", {"a": 1, "b": 2})
+        job = wait_for_job(app, job_id)
+        assert job["status"] == "complete"
+        assert job["result"] == 3
+        assert job["progress"] == 1.0
+
+    def test_job_retried(self, app, worker):
+        """
+        A failing job should be requeued until its retries are exhausted.
+        """
+        with app.app_context():
+            job_id = enqueue_job("unittest-flaky")
+        job = wait_for_job(app, job_id)
+        assert job["status"] == "complete"
+        assert job["attempts"] == 2
+
+    def test_unknown_job_type(self, app):
+        """
+        Enqueuing an unregistered job type should raise.
+        """
+        with app.app_context():
+            with pytest.raises(KeyError):
+                enqueue_job("unittest-missing")
+
+    def test_unencodable_result_fails(self, app, worker):
+        """
+        A result which cannot be stored should fail the job rather than the worker.
+        """
+        with app.app_context():
+            job_id = enqueue_job("unittest-unencodable")
+        job = wait_for_job(app, job_id)
+        assert job["status"] == "failed"
+        assert "cannot be stored" in job["error"]
+
+    def test_worker_survives_errors(self, app, worker, monkeypatch):
+        """
+        An error while claiming should be logged and the worker keep running.
+        """
+        claim = worker.claim
+        failures = []
+        def failing_claim(collection):
+            if len(failures) == 0:
+                failures.append(True)
+                raise RuntimeError("Transient failure")
+            return claim(collection)
+        monkeypatch.setattr(worker, "claim", failing_claim)
+        with app.app_context():
+            job_id = enqueue_job("unittest-add", {"a": 2, "b": 2})
+        assert wait_for_job(app, job_id)["status"] == "complete"
+        assert len(failures) == 1
+
+    def test_concurrency_race_requeues(self, app):
+        """
+        A job claimed past its type's concurrency limit by a racing worker
+        should be handed back to the queue.
+        """
+        app.config.update({"JOBS_COLLECTION": "unittest_jobs"})
+        worker = JobWorker(app, 1, ["unittest-single"])
+        now = datetime.now(timezone.utc)
+        with app.app_context():
+            collection = jobs_collection()
+            collection.insert_one({"type": "unittest-single", "status": "running", "started": now - timedelta(seconds=5), "updated": now, "attempts": 1})
+            job = {"_id": ObjectId(), "type": "unittest-single", "status": "running", "worker": worker.name, "started": now, "updated": now, "attempts": 1}
+            collection.insert_one(job)
+            assert not worker.within_concurrency(collection, job, now - timedelta(seconds=60))
+            requeued = collection.find_one({"_id": job["_id"]})
+            collection.delete_many({"type": "unittest-single"})
+        assert requeued["status"] == "queued"
+        assert requeued["attempts"] == 0
+
+    def test_reclaimed_job_not_overwritten(self, app):
+        """
+        A worker whose job was reclaimed by another should leave the new
+        owner's status and result alone.
+        """
+        app.config.update({"JOBS_COLLECTION": "unittest_jobs"})
+        worker = JobWorker(app, 1, ["unittest-add"])
+        now = datetime.now(timezone.utc)
+        job = {"_id": ObjectId(), "type": "unittest-add", "parameters": {"a": 1, "b": 1}, "status": "running", "worker": worker.name, "started": now, "updated": now, "attempts": 1, "result": None}
+        with app.app_context():
+            collection = jobs_collection()
+            collection.insert_one({**job, "worker": "unittest-other", "attempts": 2})
+            assert not worker.execute(collection, job)
+            stored = collection.find_one({"_id": job["_id"]})
+            collection.delete_one({"_id": job["_id"]})
+        assert stored["status"] == "running"
+        assert stored["result"] is None
+
+
+class TestJobViews:
+    def test_result_with_bson_types(self, app, authenticated_client):
+        """
+        Results holding BSON types such as ObjectId and datetime should be
+        returned as JSON.
+        """
+        app.config.update({"JOBS_COLLECTION": "unittest_jobs"})
+        now = datetime.now(timezone.utc)
+        job_id = ObjectId()
+        with app.app_context():
+            jobs_collection().insert_one({
+                "_id": job_id, "type": "unittest-add", "status": "complete", "attempts": 1, "user": None,
+                "result": {"document": ObjectId(), "completed": now}, "created": now, "updated": now
+            })
+        response = authenticated_client.get("/jobs/{id}/result".format(id=job_id))
+        with app.app_context():
+            jobs_collection().delete_one({"_id": job_id})
+        assert response.status_code == 200
+        assert set(response.get_json()["result"]) == {"document", "completed"}
@@ -0,0 +1,117 @@
+from flask import Flask
+from pymongo.errors import OperationFailure
+
+from pbshm.live import CollectionWatcher, Subscriber
+
+
+def structure_document(index, population="bridges", name="bridge-1"):
+    return {
+        "_id": index,
+        "population": population,
+        "name": name,
+        "channels": [{"name": "strain", "value": index}, {"name": "temperature", "value": 20}]
+    }
+
+
+class TestSubscriber:
+    def test_filters_population_and_structure(self):
+        """
+        Only documents matching the subscription should be queued.
+        """
+        subscriber = Subscriber("bridges", "bridge-1")
+        subscriber.publish(structure_document(1))
+        subscriber.publish(structure_document(2, population="turbines"))
+        subscriber.publish(structure_document(3, name="bridge-2"))
+        assert subscriber.queue.qsize() == 1
+        assert subscriber.queue.get()["_id"] == 1
+
+    def test_filters_channels(self):
+        """
+        Documents should be reduced to the subscribed channels.
+        """
+        subscriber = Subscriber(channels=["strain"])
+        subscriber.publish(structure_document(1))
+        assert [channel["name"] for channel in subscriber.queue.get()["channels"]] == ["strain"]
+
+    def test_bounded_queue_drops_oldest(self):
+        """
+        A slow client should lose its oldest documents instead of blocking the watcher.
+        """
+        subscriber = Subscriber(maxsize=2)
+        for index in range(5):
+            subscriber.publish(structure_document(index))
+        assert subscriber.dropped == 3
+        assert [subscriber.queue.get()["_id"] for _ in range(2)] == [3, 4]
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self, key=lambda document: document[field] * direction))
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection=None):
+        lower = query.get("timestamp", {}).get("$gte")
+        return FakeCursor(document for document in self.documents if lower is None or document["timestamp"] >= lower)
+
+    def find_one(self, query, projection=None, sort=None):
+        documents = self.find(query).sort(*sort[0])
+        return documents[0] if len(documents) > 0 else None
+
+
+class RecordingWatcher(CollectionWatcher):
+    """
+    Watcher publishing into a list and stopping after the given hooks ran,
+    one per poll.
+    """
+    def __init__(self, hooks):
+        app = Flask(__name__)
+        app.config.update(LIVE_POLL_INTERVAL=0, LIVE_POLL_OVERLAP=10 / 1000000000, LIVE_CHANGE_STREAMS=True)
+        super().__init__(app, "unittest")
+        self.hooks = list(hooks)
+        self.published = []
+
+    def active(self):
+        if len(self.hooks) == 0:
+            return False
+        self.hooks.pop(0)()
+        return True
+
+    def publish(self, document):
+        self.published.append(document["_id"])
+
+
+class TestCollectionWatcher:
+    def test_poll_publishes_late_inserts(self):
+        """
+        Polling should publish new documents once, including a document
+        inserted late with an older _id and timestamp within the overlap,
+        but not the documents present when polling started.
+        """
+        collection = FakeCollection([{"_id": 1, "timestamp": 100}])
+        watcher = RecordingWatcher([
+            lambda: collection.documents.append({"_id": 5, "timestamp": 110}),
+            lambda: collection.documents.append({"_id": 2, "timestamp": 105}),
+            lambda: None
+        ])
+        watcher.poll(collection)
+        assert watcher.published == [5, 2]
+
+    def test_fallback_only_when_unsupported(self, monkeypatch):
+        """
+        Only the error codes meaning change streams are unsupported should
+        switch the watcher to polling.
+        """
+        watcher = RecordingWatcher([lambda: None] * 3)
+        calls = []
+        def watch(collection):
+            calls.append("watch")
+            raise OperationFailure("unittest", code=11600 if len(calls) == 1 else 40573)
+        monkeypatch.setattr(watcher, "watch", watch)
+        monkeypatch.setattr(watcher, "poll", lambda collection: calls.append("poll"))
+        monkeypatch.setattr("pbshm.live.live.db_connect", lambda: {"unittest": None})
+        watcher.run()
+        assert calls == ["watch", "watch", "poll"]
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import queue
+
+from flask import Flask
+
+from pbshm.logs import JSONFormatter, NonBlockingQueueHandler, access_logger, configure_logging
+
+
+class CollectingHandler(logging.Handler):
+    """
+    Collects the records emitted on a logger.
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class IdleListener:
+    """
+    Listener which never drains its queue.
+    """
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def logging_app():
+    app = Flask(__name__)
+    app.config.update(LOG_QUEUE_SIZE=10, LOG_JSON=True, LOG_FILENAME=None, LOG_LEVEL="INFO")
+    return app
+
+
+class TestJSONFormatter:
+    def test_fields_included(self):
+        """
+        Structured fields should be merged into the JSON entry.
+        """
+        record = logging.LogRecord("pbshm.access", logging.INFO, __file__, 1, "GET %s", ("/",), None)
+        record.fields = {"status": 200, "queries": 2}
+        entry = json.loads(JSONFormatter().format(record))
+        assert entry["message"] == "GET /"
+        assert entry["status"] == 200
+        assert entry["queries"] == 2
+
+
+class TestNonBlockingQueueHandler:
+    def test_drops_when_full(self):
+        """
+        A full queue should drop records rather than block or raise.
+        """
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1), IdleListener())
+        for index in range(3):
+            handler.handle(logging.LogRecord("unittest", logging.INFO, __file__, 1, "entry", (), None))
+        assert handler.dropped == 2
+
+    def test_listener_started_lazily(self):
+        """
+        The listener should only start with the first record in a process,
+        and a forked child should start its own on a fresh queue.
+        """
+        handler = configure_logging(logging_app())
+        try:
+            assert handler.pid is None
+            handler.handle(logging.LogRecord("unittest", logging.INFO, __file__, 1, "entry", (), None))
+            assert handler.pid == os.getpid()
+            inherited = handler.queue
+            handler.listener.stop()
+            handler.reset_after_fork()
+            assert handler.pid is None and handler.queue is not inherited and handler.listener.queue is handler.queue
+        finally:
+            handler.stop_listener()
+
+    def test_replacing_app_stops_listener_once(self):
+        """
+        Creating a second app should stop the shared listener of the first once.
+        """
+        first = configure_logging(logging_app())
+        first.handle(logging.LogRecord("unittest", logging.INFO, __file__, 1, "entry", (), None))
+        second = configure_logging(logging_app())
+        try:
+            assert first.pid is None
+            assert first not in access_logger.handlers
+            assert access_logger.handlers.count(second) == 1
+        finally:
+            second.stop_listener()
+
+
+class TestAccessLog:
+    def test_access_entry(self, app, client):
+        """
+        Each request should produce an access entry with its endpoint, status and duration.
+        """
+        collector = CollectingHandler()
+        access_logger.addHandler(collector)
+        try:
+            client.get("/authentication/login")
+        finally:
+            access_logger.removeHandler(collector)
+        fields = collector.records[-1].fields
+        assert fields["endpoint"] == "authentication.login"
+        assert fields["status"] == 200
+        assert fields["duration_ms"] >= 0
+
+    def test_sampling(self, app, client):
+        """
+        With a sample rate of zero successful requests should not be logged.
+        """
+        app.config["LOG_ACCESS_SAMPLE_RATE"] = 0.0
+        collector = CollectingHandler()
+        access_logger.addHandler(collector)
+        try:
+            client.get("/authentication/login")
+        finally:
+            access_logger.removeHandler(collector)
+        assert collector.records == []
@@ -1,10 +1,14 @@
 import json
 import os
+from types import SimpleNamespace
 from urllib.request import urlopen
 
 import pymongo
 import pytest
 
+from pbshm.mechanic.mechanic import new_structure_collection_job
+from pbshm.mechanic.upgrade import reusable_plan
+
 # Global variables needed for tests.
 uri = f"mongodb://{os.environ['MONGODB_USERNAME']}:{os.environ['MONGODB_PASSWORD']}@{os.environ['MONGODB_HOST']}:{os.environ['MONGODB_PORT']}/{os.environ['MONGODB_AUTH_DB']}"
 db = pymongo.MongoClient(uri)[os.environ["MONGODB_DATA_DB"]]
@@ -141,4 +145,62 @@ class TestMechanicNewCollection:
         result = runner.invoke(args=test_args)
         assert result.exit_code == 1
         assert result.output
-        assert "unittest_nonexistent_schema" not in db.list_collection_names()
\ No newline at end of file
+        assert "unittest_nonexistent_schema" not in db.list_collection_names()
+
+class TestMechanicUpgrade:
+    @pytest.mark.dependency(depends=["TestMechanicNewCollection::test_latest_version_collection_created"])
+    def test_in_place_upgrade(self, runner):
+        """
+        Upgrading a collection in place should apply the schema and report
+        the validation of the existing documents.
+        """
+        test_args = ["mechanic", "upgrade", "unittest_new_collection", "--partitions", "2", "--processes", "1"]
+        result = runner.invoke(args=test_args)
+        assert result.exit_code == 0
+        assert "0 of 0 documents do not satisfy latest" in result.output
+        assert db["unittest_new_collection"].options()["validationLevel"] == "moderate"
+
+    @pytest.mark.dependency(depends=["TestMechanicNewCollection::test_latest_version_collection_created"])
+    def test_copy_upgrade(self, runner):
+        """
+        Upgrading into a target collection should install the schema into the
+        target and checkpoint the copy.
+        """
+        test_args = ["mechanic", "upgrade", "unittest_new_collection", "--target", "unittest_upgraded_collection", "--processes", "1"]
+        result = runner.invoke(args=test_args)
+        assert result.exit_code == 0
+        assert "Copied 0 documents" in result.output
+        assert db["unittest_upgraded_collection"].options()["validator"]["$jsonSchema"]
+        assert db["mechanic_checkpoints"].count_documents({"_id.target": "unittest_upgraded_collection"}) > 0
+
+class TestMechanicJobs:
+    def test_new_collection_job_fails_without_schema(self, monkeypatch):
+        """
+        The background job should raise, failing the job, when the schema
+        cannot be downloaded rather than reporting completion.
+        """
+        monkeypatch.setattr("pbshm.mechanic.mechanic.download_schema", lambda version: None)
+        job = SimpleNamespace(parameters={"collection": "unittest_missing_schema", "version": "v0.1"})
+        with pytest.raises(RuntimeError):
+            new_structure_collection_job(job)
+
+
+class TestMechanicCopyPlan:
+    def test_incomplete_plan_resumed(self):
+        """
+        An interrupted copy with the same transform should be resumed.
+        """
+        assert reusable_plan({"complete": False, "transform": "unittest"}, "unittest")
+
+    def test_complete_plan_restarted(self):
+        """
+        A completed copy should not be reused, or a later copy would copy nothing.
+        """
+        assert not reusable_plan({"complete": True, "transform": None}, None)
+        assert not reusable_plan(None, None)
+
+    def test_different_transform_restarted(self):
+        """
+        A plan started with a different transform should not be mixed with this one.
+        """
+        assert not reusable_plan({"complete": False, "transform": "unittest"}, "other")
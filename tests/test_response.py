@@ -0,0 +1,90 @@
+import gzip
+
+import pytest
+from bson import Int64
+
+from tests.auxiliary import default_collection
+
+
+@pytest.fixture
+def structure_document():
+    """
+    Seeds one structure document so the collection data version is computed
+    from data rather than short-circuited on an empty collection.
+    """
+    document_id = default_collection().insert_one(
+        {"version": "1.0.0", "name": "unittest-structure", "population": "unittest-population", "timestamp": Int64(0), "channels": []},
+        bypass_document_validation=True
+    ).inserted_id
+    yield document_id
+    default_collection().delete_one({"_id": document_id})
+
+
+class TestCompression:
+    def test_html_compressed_with_gzip(self, client):
+        """
+        HTML responses above the size threshold should be gzip compressed when
+        the client accepts it.
+        """
+        response = client.get("/authentication/login", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert b"<title>Login</title>" in gzip.decompress(response.data)
+
+    def test_identity_without_accept_encoding(self, client):
+        """
+        Clients which do not accept compression should receive the raw body.
+        """
+        response = client.get("/authentication/login")
+        assert "Content-Encoding" not in response.headers
+        assert b"<title>Login</title>" in response.data
+
+
+class TestConditionalResponse:
+    def test_diagnostics_has_validators(self, authenticated_client):
+        """
+        Diagnostics should return an ETag derived from the collection data version.
+        """
+        response = authenticated_client.get("/layout/diagnostics")
+        assert response.status_code == 200
+        assert response.headers.get("ETag") is not None
+
+    def test_diagnostics_not_modified(self, authenticated_client):
+        """
+        Repeating the request with the returned ETag should yield 304 Not Modified.
+        """
+        response = authenticated_client.get("/layout/diagnostics")
+        repeat = authenticated_client.get(
+            "/layout/diagnostics",
+            headers={"If-None-Match": response.headers["ETag"]}
+        )
+        assert repeat.status_code == 304
+        assert repeat.data == b""
+
+
+class TestQueryBudget:
+    def test_home_query_budget(self, authenticated_client, max_queries):
+        """
+        The home page should only look the user up once.
+        """
+        with max_queries(1):
+            response = authenticated_client.get("/layout/home")
+        assert response.status_code == 200
+
+    def test_diagnostics_query_budget(self, authenticated_client, max_queries, structure_document):
+        """
+        Diagnostics should need the user, the data version (the newest
+        document and the estimated count) computed once, and the aggregation.
+        """
+        with max_queries(4):
+            response = authenticated_client.get("/layout/diagnostics")
+        assert response.status_code == 200
+
+    def test_query_count_header(self, app, authenticated_client):
+        """
+        The query count header should be added when enabled.
+        """
+        app.config["QUERY_COUNT_HEADER"] = True
+        response = authenticated_client.get("/layout/home")
+        assert response.headers["X-PBSHM-Queries"].startswith("1; ")
+        assert app.config["USER_COLLECTION"] in response.headers["X-PBSHM-Queries"]
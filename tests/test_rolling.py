@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from pbshm.db import db_connect
+from pbshm.rolling import rolling_pipeline, rolling_statistics, rolling_statistics_array
+
+
+class TestRollingPipeline:
+    def test_window_fields(self):
+        """
+        The pipeline should partition by channel and use a trailing timestamp range.
+        """
+        pipeline = rolling_pipeline("bridges", "bridge-1", ["strain"], 1000, ["mean", "rms"])
+        window_stage = next(stage["$setWindowFields"] for stage in pipeline if "$setWindowFields" in stage)
+        assert window_stage["partitionBy"] == "$channel"
+        assert window_stage["output"]["mean"]["window"] == {"range": [-1000, 0]}
+        assert "mean_square" in window_stage["output"]
+
+    def test_unsupported_statistic(self):
+        """
+        Unknown statistics should be rejected before reaching the database.
+        """
+        with pytest.raises(ValueError):
+            rolling_pipeline("bridges", "bridge-1", ["strain"], 1000, ["median"])
+
+
+class TestRollingStatisticsArray:
+    def test_matches_naive_range_window(self):
+        """
+        The vectorised range window statistics should match a naive loop,
+        ignoring NaN samples.
+        """
+        generator = np.random.default_rng(0)
+        timestamps = np.cumsum(generator.integers(1, 10, 200))
+        values = generator.normal(5, 2, 200)
+        values[[3, 50]] = np.nan
+        results = rolling_statistics_array(timestamps, values, 30)
+        for index in range(len(values)):
+            window = values[(timestamps >= timestamps[index] - 30) & (timestamps <= timestamps[index])]
+            window = window[np.isfinite(window)]
+            assert results["count"][index] == len(window)
+            assert np.isclose(results["mean"][index], window.mean())
+            assert np.isclose(results["std"][index], window.std())
+            assert np.isclose(results["rms"][index], np.sqrt((window ** 2).mean()))
+            assert np.isclose(results["peak_to_peak"][index], window.max() - window.min())
+
+    def test_documents_window(self):
+        """
+        A documents window should cover the current and previous samples.
+        """
+        results = rolling_statistics_array(np.arange(5), np.array([1.0, 3.0, 2.0, 5.0, 4.0]), 2, ["max", "mean"], "documents")
+        assert list(results["max"]) == [1.0, 3.0, 3.0, 5.0, 5.0]
+        assert np.allclose(results["mean"], [1.0, 2.0, 2.5, 3.5, 4.5])
+
+
+class TestPersistedRollingStatistics:
+    def test_reused_until_data_changes(self, app, monkeypatch):
+        """
+        Persisted statistics should be read back instead of recomputed until
+        documents are added to the structure collection.
+        """
+        with app.app_context():
+            collection = db_connect()["unittest_rolling_structures"]
+            collection.drop()
+            collection.insert_many([
+                {"population": "bridges", "name": "bridge-1", "timestamp": timestamp, "channels": [{"name": "strain", "value": float(timestamp)}]}
+                for timestamp in range(10)
+            ])
+            arguments = ("bridges", "bridge-1", ["strain", "missing"], 3, ["mean", "max"])
+            computed = rolling_statistics(*arguments, persist="unittest_rolling_statistics", collection=collection)
+            aggregate = collection.aggregate
+            monkeypatch.setattr(collection, "aggregate", lambda *args, **kwargs: pytest.fail("Persisted statistics were recomputed"))
+            reused = rolling_statistics(*arguments, persist="unittest_rolling_statistics", collection=collection)
+            assert list(reused) == ["strain"]
+            for name in ["timestamp", "mean", "max"]:
+                assert np.array_equal(reused["strain"][name], computed["strain"][name])
+            monkeypatch.setattr(collection, "aggregate", aggregate)
+            collection.insert_one({"population": "bridges", "name": "bridge-1", "timestamp": 10, "channels": [{"name": "strain", "value": 10.0}]})
+            updated = rolling_statistics(*arguments, persist="unittest_rolling_statistics", collection=collection)
+            assert len(updated["strain"]["timestamp"]) == 11
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from flask import Flask
+
+from pbshm.similarity import SimilarityIndex, update_similarity_index
+
+
+def build_index():
+    index = SimilarityIndex(["mean", "peak"])
+    index.upsert([
+        ("bridges", "bridge-1", 0), ("bridges", "bridge-1", 10),
+        ("bridges", "bridge-2", 0), ("bridges", "bridge-3", 0),
+        ("turbines", "turbine-1", 0)
+    ], np.array([[0.0, 0.0], [1.0, 1.0], [1.1, 1.0], [5.0, 5.0], [0.1, 0.0]]))
+    return index
+
+
+class TestSimilarityIndex:
+    def test_nearest_structures(self):
+        """
+        Each structure should appear once, represented by its closest window,
+        and the query structure should be excluded.
+        """
+        index = build_index()
+        results = index.nearest(index.structure_vector("bridges", "bridge-1"), k=2, exclude=("bridges", "bridge-1"), block_size=2)
+        assert [(population, name) for population, name, _, _ in results] == [("bridges", "bridge-2"), ("turbines", "turbine-1")]
+        assert np.isclose(results[0][3], 0.1, atol=1e-6)
+
+    def test_latest_window(self):
+        """
+        Without a start the latest window of the structure should be used.
+        """
+        index = build_index()
+        assert np.allclose(index.structure_vector("bridges", "bridge-1"), [1.0, 1.0])
+        assert np.allclose(index.structure_vector("bridges", "bridge-1", 0), [0.0, 0.0])
+        assert index.structure_vector("bridges", "missing") is None
+
+    def test_upsert_replaces(self):
+        """
+        Upserting an existing key should replace its vector rather than add a row.
+        """
+        index = build_index()
+        index.upsert([("bridges", "bridge-3", 0)], np.array([[1.1, 1.05]]))
+        assert len(index) == 5
+        assert index.nearest(index.structure_vector("bridges", "bridge-2"), k=1, exclude=("bridges", "bridge-2"))[0][1] == "bridge-3"
+
+    def test_save_load(self, tmp_path):
+        """
+        A persisted index should load with the same vectors and keys.
+        """
+        index = build_index()
+        path = str(tmp_path / "similarity-unittest.npz")
+        index.save(path)
+        loaded = SimilarityIndex.load(path)
+        assert loaded.dimensions == ["mean", "peak"]
+        assert loaded.positions == index.positions
+        assert np.array_equal(loaded.vectors, index.vectors)
+        assert loaded.updated is None
+
+
+class FeatureDocuments:
+    """
+    Minimal stand-in for the feature collection supporting the extracted watermark query.
+    """
+    def __init__(self):
+        self.documents = []
+
+    def find(self, query, projection=None):
+        since = query.get("extracted", {}).get("$gte")
+        return [
+            dict(document) for document in self.documents
+            if document["feature"] == query["feature"] and document["window"] == query["window"] and (since is None or document["extracted"] >= since)
+        ]
+
+
+class TestUpdateSimilarityIndex:
+    def test_out_of_order_writes(self, tmp_path, monkeypatch):
+        """
+        A vector landing with an extracted time just before the watermark, as
+        a slower worker's write can, should still reach the index.
+        """
+        collection = FeatureDocuments()
+        monkeypatch.setattr("pbshm.similarity.similarity.db_connect", lambda: {"features": collection})
+        app = Flask("unittest", instance_path=str(tmp_path))
+        app.config.update(FEATURE_COLLECTION="features", SIMILARITY_FILENAME="similarity-{feature}-{window}.npz", SIMILARITY_WATERMARK_OVERLAP=300)
+        extracted = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        collection.documents.append({"feature": "rms", "window": 10, "population": "bridges", "name": "bridge-1", "start": 0, "values": {"rms": 1.0}, "extracted": extracted})
+        collection.documents.append({"feature": "rms", "window": 20, "population": "bridges", "name": "bridge-3", "start": 0, "values": {"rms": 3.0}, "extracted": extracted})
+        with app.app_context():
+            assert len(update_similarity_index("rms", 10)) == 1
+            collection.documents.append({"feature": "rms", "window": 10, "population": "bridges", "name": "bridge-2", "start": 0, "values": {"rms": 2.0}, "extracted": extracted - timedelta(seconds=5)})
+            index = update_similarity_index("rms", 10)
+        assert len(index) == 2
+        assert index.structure_vector("bridges", "bridge-2") is not None
+        assert index.structure_vector("bridges", "bridge-3") is None
+        assert index.updated == extracted
@@ -4,6 +4,7 @@ from zoneinfo import ZoneInfo
 import pytest
 
 from pbshm.timekeeper import datetime_to_nanoseconds_since_epoch, nanoseconds_since_epoch_to_datetime, convert_nanoseconds
+from pbshm.timekeeper import nanoseconds_to_date_expression, date_to_nanoseconds_expression, truncate_date_expression, truncate_nanoseconds_expression, bucket_boundaries_expression, calendar_group_stage
 
 
 class TestDatetimeToNanosecondsSinceEpoch:
@@ -188,4 +189,60 @@ class TestConvertNanoseconds:
         """
         with pytest.raises(Exception) as exc_info:
             convert_nanoseconds(int(1e9), "invalid")
-        assert str(exc_info.value) == "Unsupported unit"
\ No newline at end of file
+        assert str(exc_info.value) == "Unsupported unit"
+
+class TestAggregationExpressions:
+    def test_nanoseconds_to_date(self):
+        """
+        The date expression should convert nanoseconds to milliseconds.
+        """
+        expression = nanoseconds_to_date_expression("$timestamp")
+        assert expression == {"$toDate": {"$toLong": {"$floor": {"$divide": ["$timestamp", 1000000]}}}}
+
+    def test_date_to_nanoseconds(self):
+        """
+        The nanoseconds expression should scale milliseconds back up to nanoseconds.
+        """
+        assert date_to_nanoseconds_expression("$$date") == {"$multiply": [{"$toLong": "$$date"}, 1000000]}
+
+    def test_truncate_in_timezone(self):
+        """
+        Truncation should pass the unit, bin size and timezone to $dateTrunc.
+        """
+        expression = truncate_date_expression("$timestamp", "hour", "Europe/London", 6)["$dateTrunc"]
+        assert expression["unit"] == "hour"
+        assert expression["binSize"] == 6
+        assert expression["timezone"] == "Europe/London"
+        assert "startOfWeek" not in expression
+
+    def test_truncate_week_start(self):
+        """
+        Weekly truncation should include the start of the week.
+        """
+        expression = truncate_date_expression(unit="week", start_of_week="sunday")["$dateTrunc"]
+        assert expression["startOfWeek"] == "sunday"
+
+    def test_unsupported_unit(self):
+        """
+        Unknown calendar units and invalid bin sizes should raise errors.
+        """
+        with pytest.raises(ValueError):
+            truncate_date_expression(unit="fortnight")
+        with pytest.raises(ValueError):
+            truncate_date_expression(unit="day", bin_size=0)
+
+    def test_bucket_boundaries(self):
+        """
+        Bucket boundaries should provide a start and end in nanoseconds.
+        """
+        expression = bucket_boundaries_expression(unit="day", timezone="Europe/London")["$let"]
+        assert set(expression["in"].keys()) == {"start", "end"}
+        assert expression["in"]["end"]["$multiply"][0]["$toLong"]["$dateAdd"]["unit"] == "day"
+
+    def test_calendar_group_stage(self):
+        """
+        The group stage should key on the truncated bucket start and keep the accumulators.
+        """
+        stage = calendar_group_stage({"count": {"$sum": 1}}, unit="day")
+        assert stage["$group"]["count"] == {"$sum": 1}
+        assert stage["$group"]["_id"] == truncate_nanoseconds_expression(unit="day")